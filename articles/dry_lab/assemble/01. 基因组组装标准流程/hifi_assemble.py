@@ -6,12 +6,18 @@ import shutil
 import subprocess
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
 
 THREADS = 128
 READ_EXTENSIONS = (".fastq.gz", ".fq.gz", ".fastq", ".fq", ".bam")
 FASTQ_EXTENSIONS = (".fastq.gz", ".fq.gz", ".fastq", ".fq")
+COMPRESS_BLOCK = 32 * 1024 * 1024
+COMPRESS_MIN_BLOCK = 1024 * 1024
+COMPRESS_INFLIGHT = 512 * 1024 * 1024
+GFA_BUFFER = 16 * 1024 * 1024
+FASTA_WIDTH = 60
 
 
 def log_info(message):
@@ -177,35 +183,87 @@ def sample_stem(path):
     return os.path.splitext(name)[0]
 
 
+def compressor_command(threads):
+    """返回多线程 gzip 压缩命令（优先 pigz，其次 bgzip）；都没有时返回 None。"""
+    if shutil.which("pigz"):
+        return ["pigz", "-p", str(threads), "-1", "-c"]
+    if shutil.which("bgzip"):
+        return ["bgzip", "-@", str(threads), "-l", "1", "-c"]
+    return None
+
+
 def bam_to_fastq(bam_file, fastq_file, threads):
+    """samtools fastq 的输出直接经管道交给多线程压缩，不落地未压缩 FASTQ。"""
     log_info(f"  -> BAM 转 FASTQ：{bam_file}")
+    compressor = compressor_command(threads) if fastq_file.endswith(".gz") else None
     with open(fastq_file, "wb") as output:
-        subprocess.run(
-            ["samtools", "fastq", "-@", str(threads), bam_file],
-            stdout=output,
-            check=True,
+        if compressor is None:
+            subprocess.run(
+                ["samtools", "fastq", "-@", str(threads), bam_file],
+                stdout=output,
+                check=True,
+            )
+            return fastq_file
+        converter = subprocess.Popen(
+            ["samtools", "fastq", "-@", str(max(1, threads // 2)), bam_file],
+            stdout=subprocess.PIPE,
         )
+        compress = subprocess.Popen(compressor, stdin=converter.stdout, stdout=output)
+        converter.stdout.close()
+        compress_code = compress.wait()
+        convert_code = converter.wait()
+    if convert_code or compress_code:
+        os.remove(fastq_file)
+        raise subprocess.CalledProcessError(convert_code or compress_code, f"samtools fastq {bam_file}")
     return fastq_file
 
 
 def prepare_read(path, output_dir, threads, label=""):
-    """BAM 转 FASTQ；FASTQ/FQ（可 gzip）直接使用绝对路径。"""
+    """BAM 转压缩 FASTQ（无 pigz/bgzip 时为未压缩 FASTQ）；FASTQ/FQ（可 gzip）直接使用绝对路径。"""
     if path.lower().endswith(".bam"):
-        filename = f"{sample_stem(path)}{label}.fastq"
+        extension = ".fastq.gz" if compressor_command(threads) else ".fastq"
+        filename = f"{sample_stem(path)}{label}{extension}"
         return bam_to_fastq(path, os.path.join(output_dir, filename), threads)
     return os.path.abspath(path)
 
 
-def combine_ultralong_reads(paths, output_file):
-    """将多个超长读长 FASTQ/FQ（含 gzip）流式合并成 gzip FASTQ。"""
+def compress_blocks(source, destination, threads, block_size=COMPRESS_BLOCK, inflight=COMPRESS_INFLIGHT):
+    """把未压缩输入切块并行压缩，每块写成一个独立 gzip member 按顺序追加。
+
+    zlib 压缩时会释放 GIL，线程池即可占满多个核心。在途的未压缩数据按字节数限制在 inflight 以内：
+    线程很多时缩小块大小（不低于 1 MB），让每个线程仍有两个块可做，而不是让内存随线程数增长。
+    """
+    slots = max(1, threads * 2)
+    block_size = max(min(block_size, COMPRESS_MIN_BLOCK), min(block_size, inflight // slots))
+    slots = max(1, min(slots, inflight // block_size))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = []
+        while True:
+            block = source.read(block_size)
+            if block:
+                pending.append(pool.submit(gzip.compress, block, 1))
+            if pending and (not block or len(pending) >= slots):
+                destination.write(pending.pop(0).result())
+            if not block and not pending:
+                break
+
+
+def combine_ultralong_reads(paths, output_file, threads=1):
+    """将多个超长读长 FASTQ/FQ（含 gzip）合并成 gzip FASTQ。
+
+    gzip 允许多个 member 直接拼接，已压缩的输入按字节原样追加，不解压也不重新压缩；
+    未压缩的输入按块并行压缩后追加。
+    """
     if len(paths) == 1:
         return paths[0]
     log_info(f"  -> 合并 {len(paths)} 个超长读长文件：{output_file}")
-    with gzip.open(output_file, "wb") as destination:
+    with open(output_file, "wb") as destination:
         for path in paths:
-            opener = gzip.open if path.lower().endswith(".gz") else open
-            with opener(path, "rb") as source:
-                shutil.copyfileobj(source, destination, length=16 * 1024 * 1024)
+            with open(path, "rb") as source:
+                if path.lower().endswith(".gz"):
+                    shutil.copyfileobj(source, destination, length=16 * 1024 * 1024)
+                else:
+                    compress_blocks(source, destination, threads)
     return output_file
 
 
@@ -239,19 +297,75 @@ def run_hifiasm(
         subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, check=True)
 
 
+def n50(lengths):
+    half = sum(lengths) / 2
+    running = 0
+    for length in sorted(lengths, reverse=True):
+        running += length
+        if running >= half:
+            return length
+    return 0
+
+
 def extract_fasta(gfa_file, fasta_file):
+    """二进制缓冲读取 GFA 的 S 行，写出定宽换行的 FASTA 及 .fai，并同步统计 N50。
+
+    只切分前三列，序列不做额外解码；.fai 偏移在写出时累计，无需再读一遍 FASTA。
+    返回 {count, total, n50, longest}，找不到图文件时返回 None。
+    """
     if not os.path.exists(gfa_file):
         log_info(f"  -> 警告：找不到图文件 {gfa_file}，跳过提取。")
-        return
-    count = 0
-    with open(gfa_file, encoding="utf-8") as gfa, open(fasta_file, "w", encoding="utf-8") as fasta:
+        return None
+    lengths = []
+    offset = 0
+    with open(gfa_file, "rb", buffering=GFA_BUFFER) as gfa, \
+            open(fasta_file, "wb", buffering=GFA_BUFFER) as fasta, \
+            open(f"{fasta_file}.fai", "w", encoding="utf-8") as fai:
         for line in gfa:
-            if line.startswith("S\t"):
-                parts = line.rstrip().split("\t")
-                if len(parts) >= 3:
-                    fasta.write(f">{parts[1]}\n{parts[2]}\n")
-                    count += 1
-    log_info(f"  -> 从 {os.path.basename(gfa_file)} 提取 {count} 条 contig。")
+            if not line.startswith(b"S\t"):
+                continue
+            parts = line.rstrip(b"\r\n").split(b"\t", 3)
+            if len(parts) < 3 or parts[2] == b"*":
+                continue
+            name, sequence = parts[1], parts[2]
+            header = b">" + name + b"\n"
+            wrapped = b"\n".join(
+                sequence[start:start + FASTA_WIDTH]
+                for start in range(0, len(sequence), FASTA_WIDTH)
+            ) + b"\n"
+            fasta.write(header)
+            fasta.write(wrapped)
+            offset += len(header)
+            line_bases = min(len(sequence), FASTA_WIDTH)
+            fai.write(f"{name.decode()}\t{len(sequence)}\t{offset}\t{line_bases}\t{line_bases + 1}\n")
+            offset += len(wrapped)
+            lengths.append(len(sequence))
+    stats = {
+        "count": len(lengths),
+        "total": sum(lengths),
+        "n50": n50(lengths),
+        "longest": max(lengths, default=0),
+    }
+    log_info(
+        f"  -> 从 {os.path.basename(gfa_file)} 提取 {stats['count']} 条 contig，"
+        f"总长 {stats['total']:,} bp，N50 {stats['n50']:,} bp。"
+    )
+    return stats
+
+
+def extract_all_fasta(jobs, stats_file):
+    """并行提取 primary/alternate/单倍型等多个图，并把统计汇总写入一个表。"""
+    with ProcessPoolExecutor(max_workers=max(1, len(jobs))) as pool:
+        results = list(pool.map(extract_fasta, *zip(*jobs))) if jobs else []
+    with open(stats_file, "w", encoding="utf-8") as output:
+        output.write("fasta\tcontigs\ttotal_bp\tN50\tlongest\n")
+        for (_, fasta_file), stats in zip(jobs, results):
+            if stats is not None:
+                output.write(
+                    f"{os.path.basename(fasta_file)}\t{stats['count']}\t{stats['total']}"
+                    f"\t{stats['n50']}\t{stats['longest']}\n"
+                )
+    return results
 
 
 def main():
@@ -302,15 +416,40 @@ def main():
     os.makedirs(work_dir, exist_ok=True)
     log_info(f"总输出目录：{work_dir}")
 
+    # 所有 BAM 同时开始转换，按任务数平分核心；超长读长合并与 HiFi 转换重叠进行。
+    conversions = [
+        (path, os.path.join(work_dir, "00_ultralong_reads"), f".ul{index}")
+        for index, path in enumerate(ultralong_files, 1)
+    ]
+    conversions.extend(
+        (path, os.path.join(work_dir, sample_stem(path), "01_fastq"), "")
+        for path in hifi_files
+    )
+    conversions = [task for task in conversions if task[0].lower().endswith(".bam")]
+    convert_threads = max(1, threads // max(1, len(conversions)))
+    converter_pool = ThreadPoolExecutor(max_workers=max(1, len(conversions)))
+    converted = {}
+    for path, output_dir, label in conversions:
+        os.makedirs(output_dir, exist_ok=True)
+        converted[(path, label)] = converter_pool.submit(
+            prepare_read, path, output_dir, convert_threads, label
+        )
+    if conversions:
+        log_info(f"并行转换 {len(conversions)} 个 BAM，每个任务 {convert_threads} 核。")
+
     # 超长读长只准备一次，可作为所有所选 HiFi 样本的共同证据。
     prepared_ul = None
     if ultralong_files:
         ul_dir = os.path.join(work_dir, "00_ultralong_reads")
         os.makedirs(ul_dir, exist_ok=True)
-        prepared = [prepare_read(path, ul_dir, threads, f".ul{index}")
-                    for index, path in enumerate(ultralong_files, 1)]
+        prepared = [
+            converted[(path, f".ul{index}")].result()
+            if (path, f".ul{index}") in converted
+            else prepare_read(path, ul_dir, threads, f".ul{index}")
+            for index, path in enumerate(ultralong_files, 1)
+        ]
         prepared_ul = combine_ultralong_reads(
-            prepared, os.path.join(ul_dir, "ultralong.combined.fastq.gz")
+            prepared, os.path.join(ul_dir, "ultralong.combined.fastq.gz"), threads
         )
         log_info(f"超长读长证据已启用：{prepared_ul}")
     else:
@@ -338,7 +477,10 @@ def main():
         prefix = os.path.join(hifiasm_dir, sample_name)
 
         try:
-            hifi_input = prepare_read(hifi_file, fastq_dir, threads)
+            if (hifi_file, "") in converted:
+                hifi_input = converted[(hifi_file, "")].result()
+            else:
+                hifi_input = prepare_read(hifi_file, fastq_dir, threads)
             run_hifiasm(
                 hifi_input,
                 prefix,
@@ -370,15 +512,18 @@ def main():
                         ("bp.hap2.p_ctg.gfa", "hap2.fasta"),
                     ],
                 }[ploidy_mode]
-            for gfa_suffix, fasta_suffix in targets:
-                extract_fasta(
-                    f"{prefix}.{gfa_suffix}",
-                    os.path.join(fasta_dir, f"{sample_name}.{fasta_suffix}"),
-                )
+            extract_all_fasta(
+                [
+                    (f"{prefix}.{gfa_suffix}", os.path.join(fasta_dir, f"{sample_name}.{fasta_suffix}"))
+                    for gfa_suffix, fasta_suffix in targets
+                ],
+                os.path.join(fasta_dir, f"{sample_name}.stats.tsv"),
+            )
             log_info(f"样本 {sample_name} 完成：{fasta_dir}")
         except Exception as error:
             log_info(f"样本 {sample_name} 失败，继续下一样本。错误：{error}")
 
+    converter_pool.shutdown()
     print("-" * 64)
     log_info(f"全部任务结束：{work_dir}")
 
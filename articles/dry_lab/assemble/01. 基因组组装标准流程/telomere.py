@@ -4,7 +4,13 @@ import sys
 import glob
 import csv
 import argparse
-from collections import Counter
+import bisect
+import gzip
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 
 def reverse_complement(seq):
     """获取序列的反向互补序列"""
@@ -15,22 +21,367 @@ def get_circular_shifts(seq):
     """获取一个序列的所有循环位移"""
     return set(seq[i:] + seq[:i] for i in range(len(seq)))
 
-def parse_fasta(filepath):
-    """简单的FASTA解析器 (按条目生成，节约内存)"""
-    with open(filepath, 'r') as f:
-        header = ""
-        seq = []
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+def is_gzip(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(filepath):
+    """判断是否为 bgzip 压缩 (gzip 头部带 BC 扩展字段)"""
+    with open(filepath, 'rb') as f:
+        head = f.read(18)
+    return len(head) == 18 and head[:4] == BGZF_MAGIC and head[12:14] == b"BC"
+
+
+def scan_fai(handle):
+    """顺序扫描未压缩的 FASTA 字节流，生成 samtools 格式的 .fai 记录。
+
+    不保存序列本身，内存占用与基因组大小无关。
+    行长不一致 (无法按偏移随机读取) 时返回 None。
+    """
+    entries = []
+    name = None
+    length = offset = line_bases = line_width = 0
+    short_line_seen = False
+    position = 0
+    for line in handle:
+        line_len = len(line)
+        if line.startswith(b">"):
+            if name is not None:
+                entries.append((name, length, offset, line_bases, line_width))
+            name = line[1:].split()[0].decode()
+            length = line_bases = line_width = 0
+            offset = position + line_len
+            short_line_seen = False
+        elif name is not None:
+            bases = len(line.rstrip(b"\r\n"))
+            if bases:
+                if line_bases == 0:
+                    line_bases, line_width = bases, line_len
+                elif short_line_seen or bases > line_bases:
+                    return None
+                elif bases < line_bases or line_len != line_width:
+                    short_line_seen = True
+                length += bases
+        position += line_len
+    if name is not None:
+        entries.append((name, length, offset, line_bases, line_width))
+    return entries
+
+
+def read_fai(fai_path):
+    entries = []
+    with open(fai_path, 'r') as f:
         for line in f:
-            line = line.strip()
-            if line.startswith(">"):
-                if header:
-                    yield header, "".join(seq)
-                header = line[1:].split()[0]
-                seq = []
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 5:
+                entries.append((fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4])))
+    return entries
+
+
+def write_index(path, text_or_bytes):
+    """尽量把索引写在 FASTA 旁边；目录不可写时只在内存中使用。"""
+    try:
+        mode = 'wb' if isinstance(text_or_bytes, bytes) else 'w'
+        with open(path, mode) as f:
+            f.write(text_or_bytes)
+    except OSError:
+        pass
+
+
+def index_is_fresh(index_path, filepath):
+    return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(filepath)
+
+
+def bgzf_block_size(extra):
+    """从 gzip 扩展字段中解析 BGZF 块总长 (BSIZE + 1)"""
+    pos = 0
+    while pos + 4 <= len(extra):
+        sub_len = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b"BC":
+            return struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + sub_len
+    return None
+
+
+def load_gzi(filepath):
+    """读取或构建 bgzip 的 .gzi 索引：[(压缩偏移, 解压偏移), ...]。
+
+    构建时只读取每个 BGZF 块的头部和尾部 ISIZE，不解压数据。
+    """
+    gzi_path = filepath + ".gzi"
+    blocks = [(0, 0)]
+    if index_is_fresh(gzi_path, filepath):
+        with open(gzi_path, 'rb') as f:
+            count = struct.unpack("<Q", f.read(8))[0]
+            for _ in range(count):
+                blocks.append(struct.unpack("<QQ", f.read(16)))
+        return blocks
+    compressed = uncompressed = 0
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        while compressed < size:
+            f.seek(compressed)
+            head = f.read(12)
+            if head[:4] != BGZF_MAGIC:
+                raise ValueError(f"{filepath} 不是完整的 bgzip 文件")
+            extra = f.read(struct.unpack("<H", head[10:12])[0])
+            block_size = bgzf_block_size(extra)
+            if block_size is None:
+                raise ValueError(f"{filepath} 缺少 BGZF 块大小字段")
+            f.seek(compressed + block_size - 4)
+            uncompressed += struct.unpack("<I", f.read(4))[0]
+            compressed += block_size
+            if compressed < size:
+                blocks.append((compressed, uncompressed))
+    payload = struct.pack("<Q", len(blocks) - 1) + b"".join(
+        struct.pack("<QQ", c, u) for c, u in blocks[1:]
+    )
+    write_index(gzi_path, payload)
+    return blocks
+
+
+class BgzfReader:
+    """按解压后偏移随机读取 bgzip 文件，只解压涉及的 BGZF 块。"""
+
+    def __init__(self, filepath):
+        self.handle = open(filepath, 'rb')
+        self.blocks = load_gzi(filepath)
+        self.starts = [u for _, u in self.blocks]
+        self.cached = (None, b"")
+
+    def close(self):
+        self.handle.close()
+
+    def block(self, index):
+        if self.cached[0] != index:
+            self.handle.seek(self.blocks[index][0])
+            head = self.handle.read(12)
+            extra_len = struct.unpack("<H", head[10:12])[0]
+            extra = self.handle.read(extra_len)
+            block_size = bgzf_block_size(extra)
+            data = self.handle.read(block_size - 12 - extra_len)
+            self.cached = (index, zlib.decompress(data[:-8], -15))
+        return self.cached[1]
+
+    def read(self, offset, size):
+        index = bisect.bisect_right(self.starts, offset) - 1
+        chunks = []
+        skip = offset - self.starts[index]
+        while size > 0 and index < len(self.blocks):
+            data = self.block(index)[skip:skip + size]
+            chunks.append(data)
+            size -= len(data)
+            skip = 0
+            index += 1
+        return b"".join(chunks)
+
+
+class PlainReader:
+    def __init__(self, filepath):
+        self.handle = open(filepath, 'rb')
+
+    def close(self):
+        self.handle.close()
+
+    def read(self, offset, size):
+        self.handle.seek(offset)
+        return self.handle.read(size)
+
+
+def read_region(reader, entry, start, end):
+    """按 .fai 偏移读取 [start, end) 区间的碱基，去掉换行。"""
+    _, _, offset, line_bases, line_width = entry
+    first = offset + (start // line_bases) * line_width + start % line_bases
+    last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+    raw = reader.read(first, last - first + 1)
+    return raw.replace(b"\n", b"").replace(b"\r", b"").decode().upper()
+
+
+def stream_contig_ends(filepath, window_size):
+    """无法随机读取时 (普通 gzip、行长不一致) 顺序读取，每条 contig 只保留两端窗口。"""
+    opener = gzip.open if is_gzip(filepath) else open
+    with opener(filepath, 'rb') as f:
+        header = None
+        head = None
+        buffer = bytearray()
+        length = 0
+        for line in f:
+            if line.startswith(b">"):
+                if header is not None:
+                    yield finish_contig(header, length, head, buffer, window_size)
+                header = line[1:].split()[0].decode()
+                head = None
+                buffer = bytearray()
+                length = 0
+                continue
+            bases = line.rstrip(b"\r\n")
+            length += len(bases)
+            buffer += bases
+            if head is None and len(buffer) >= window_size * 2:
+                head = bytes(buffer[:window_size])
+            if head is not None and len(buffer) > window_size * 4:
+                del buffer[:-window_size]
+        if header is not None:
+            yield finish_contig(header, length, head, buffer, window_size)
+
+
+def finish_contig(header, length, head, buffer, window_size):
+    if length < window_size * 2:
+        seq = buffer.decode().upper()
+        return header, length, seq, seq
+    return header, length, head.decode().upper(), buffer[-window_size:].decode().upper()
+
+
+def load_contig_index(filepath):
+    """返回可按偏移随机读取的 .fai 条目 (缺失时现场构建并写在文件旁)。
+
+    普通 gzip 或行长不一致时返回 None，调用方应只顺序读取一遍；
+    每个文件只判断一次，提示也只打印一次。
+    """
+    compressed = is_gzip(filepath)
+    if compressed and not is_bgzf(filepath):
+        return None
+    fai_path = filepath + ".fai"
+    if index_is_fresh(fai_path, filepath):
+        return read_fai(fai_path)
+    opener = gzip.open if compressed else open
+    with opener(filepath, 'rb') as f:
+        entries = scan_fai(f)
+    if entries is None:
+        print(f"  [提示] {os.path.basename(filepath)} 行长不一致，无法建立偏移索引，改为顺序读取。")
+        return None
+    write_index(fai_path, "".join("\t".join(map(str, entry)) + "\n" for entry in entries))
+    return entries
+
+
+def iter_contig_ends(filepath, window_size, entries):
+    """按 .fai 条目生成 (contig_id, 长度, 左端窗口, 右端窗口)，只读取每条 contig 两端。
+
+    支持未压缩与 bgzip 压缩的 FASTA；长度小于两倍窗口的 contig 两端窗口均为全长序列。
+    """
+    reader = BgzfReader(filepath) if is_gzip(filepath) else PlainReader(filepath)
+    try:
+        for entry in entries:
+            name, length = entry[0], entry[1]
+            if length == 0:
+                yield name, 0, "", ""
+            elif length < window_size * 2:
+                seq = read_region(reader, entry, 0, length)
+                yield name, length, seq, seq
             else:
-                seq.append(line.upper())
-        if header:
-            yield header, "".join(seq)
+                left = read_region(reader, entry, 0, window_size)
+                right = read_region(reader, entry, length - window_size, length)
+                yield name, length, left, right
+    finally:
+        reader.close()
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    BASE_CODES[_base] = _code
+    BASE_CODES[_base + 32] = _code
+MAX_CODED_K = 31
+DENSE_K = 12
+CHUNK_BASES = 4_000_000
+
+
+def encode_bases(seq):
+    """把序列编码为 0-3 的数组，非 ACGT 字符记为 4"""
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def kmer_codes(codes, k):
+    """滚动计算每个起点的 k-mer 整数编码 (2 bit/碱基)，返回 (编码, 是否不含 N)。
+
+    整段只做 k 次向量运算，成本与序列长度线性相关。
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[k:] == invalid[:n]
+    values = np.zeros(n, dtype=np.uint64)
+    masked = np.where(codes == 4, 0, codes).astype(np.uint64)
+    for offset in range(k):
+        values = (values << np.uint64(2)) | masked[offset:offset + n]
+    return values, valid
+
+
+def encode_kmer(kmer):
+    value = 0
+    for base in kmer:
+        value = value * 4 + "ACGT".index(base)
+    return value
+
+
+def decode_kmer(value, k):
+    bases = []
+    for _ in range(k):
+        bases.append("ACGT"[value & 3])
+        value >>= 2
+    return "".join(reversed(bases))
+
+
+def has_border(pattern):
+    """模式自身是否存在前后缀重叠 (决定非重叠计数能否直接用命中数)"""
+    return any(pattern[:i] == pattern[-i:] for i in range(1, len(pattern)))
+
+
+class MotifScanner:
+    """把正向 motif 与其反向互补的全部循环位移编译为一张查找表，一次扫描同时计数两条链。
+
+    所有循环位移等长，因此多模式匹配退化为 "滚动 k-mer 编码 + 查表"，
+    与 Aho-Corasick 自动机等价但可以整段向量化。
+    """
+
+    def __init__(self, motif_5, motif_3):
+        self.k = len(motif_5)
+        self.strands = []
+        for motif in (motif_5, motif_3):
+            shifts = sorted(get_circular_shifts(motif))
+            self.strands.append((
+                np.array([encode_kmer(x) for x in shifts], dtype=np.uint64),
+                [has_border(x) for x in shifts],
+            ))
+
+    @staticmethod
+    def usable(motif):
+        return bool(motif) and len(motif) <= MAX_CODED_K and set(motif) <= set("ACGT")
+
+    def hits(self, values, valid, strand):
+        """返回每个位置命中的循环位移编号，未命中为 -1"""
+        table, _ = self.strands[strand]
+        index = np.searchsorted(table, values).clip(max=len(table) - 1)
+        return np.where(valid & (table[index] == values), index, -1)
+
+    def count(self, sequence, strand):
+        """strand 为 0 统计 5'motif，为 1 统计 3'motif；取各循环位移非重叠计数的最大值"""
+        values, valid = kmer_codes(encode_bases(sequence), self.k)
+        labels = self.hits(values, valid, strand)
+        positions = np.flatnonzero(labels >= 0)
+        if len(positions) == 0:
+            return 0
+        counts = np.bincount(labels[positions], minlength=len(self.strands[strand][1]))
+        for shift, bordered in enumerate(self.strands[strand][1]):
+            if bordered and counts[shift]:
+                count = 0
+                next_free = -1
+                for position in positions[labels[positions] == shift]:
+                    if position >= next_free:
+                        count += 1
+                        next_free = position + self.k
+                counts[shift] = count
+        return int(counts.max())
+
+    def tandem_mask(self, values, valid):
+        """任一链任一循环位移命中的位置"""
+        return (self.hits(values, valid, 0) >= 0) | (self.hits(values, valid, 1) >= 0)
+
 
 def count_motif(sequence, motif):
     """统计序列中该motif及其所有循环位移出现的总次数（非重叠）"""
@@ -40,48 +391,182 @@ def count_motif(sequence, motif):
         best_count = max(best_count, sequence.count(shift))
     return best_count
 
-def find_global_motif(sequences, k):
-    """【新逻辑】在所有端部序列汇总中寻找最常见的串联k-mer"""
-    counts = Counter()
-    for seq in sequences:
-        kmers = [seq[i:i+k] for i in range(len(seq) - k + 1)]
-        counts.update(kmers)
-        
-    for kmer, _ in counts.most_common():
-        if len(set(kmer)) > 1: # 排除单碱基重复，如 AAAAAA
-            return kmer
-    return None
 
-def process_fasta(filepath, mode, window_size, min_count, motif_5=None, k_len=None):
-    """处理单个FASTA文件：先寻找全局Motif，再统一扫描"""
-    results = []
-    
-    # 用于存储提取出来的端部信息，避免重复读取大文件
-    # 格式: (contig_id, seq_len, left_window, right_window)
-    contigs_data = [] 
-    
-    left_windows_for_discovery = []
-    right_windows_for_discovery = []
-    
-    # 步骤 1: 遍历 FASTA，提取所有端部序列
-    for contig_id, seq in parse_fasta(filepath):
-        seq_len = len(seq)
-        
+class KmerTally:
+    """分批累计 k-mer 计数与首次出现位置，内存只与当前批次的窗口数有关"""
+
+    def __init__(self, k):
+        self.k = k
+        self.offset = 0
+        self.dense = k <= DENSE_K
+        if self.dense:
+            self.counts = np.zeros(4 ** k, dtype=np.int64)
+            self.first = np.full(4 ** k, np.iinfo(np.int64).max, dtype=np.int64)
+        else:
+            self.keys = np.zeros(0, dtype=np.uint64)
+            self.counts = np.zeros(0, dtype=np.int64)
+            self.first = np.zeros(0, dtype=np.int64)
+
+    def add(self, sequences):
+        """各窗口以 N 拼接，跨窗口及含 N 的 k-mer 不计入"""
+        if not sequences:
+            return
+        joined = ("N" if self.offset else "") + "N".join(sequences)
+        values, valid = kmer_codes(encode_bases(joined), self.k)
+        positions = np.flatnonzero(valid)
+        keys, index, counts = np.unique(values[positions], return_index=True, return_counts=True)
+        first = positions[index] + self.offset
+        self.offset += len(joined)
+        if self.dense:
+            slots = keys.astype(np.int64)
+            self.counts[slots] += counts
+            self.first[slots] = np.minimum(self.first[slots], first)
+            return
+        keys = np.concatenate((self.keys, keys))
+        counts = np.concatenate((self.counts, counts))
+        first = np.concatenate((self.first, first))
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+        self.first = np.full(len(self.keys), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(self.first, inverse, first)
+
+    def best(self):
+        """最常见的非单碱基重复 k-mer；并列时取最先出现者"""
+        keys = np.arange(4 ** self.k, dtype=np.uint64) if self.dense else self.keys
+        # 排除单碱基重复，如 AAAAAA
+        homopolymers = np.array([encode_kmer(base * self.k) for base in "ACGT"], dtype=np.uint64)
+        counts = np.where(np.isin(keys, homopolymers), 0, self.counts)
+        if len(counts) == 0 or counts.max() == 0:
+            return None
+        candidates = np.flatnonzero(counts == counts.max())
+        winner = candidates[np.argmin(self.first[candidates])]
+        return decode_kmer(int(keys[winner]), self.k)
+
+
+def discover_motif(contig_ends, window_size, k, side, window_budget):
+    """逐条读取一侧端部窗口寻找全局 motif，每批最多保留 window_budget 个窗口"""
+    if not 0 < k <= MAX_CODED_K:
+        return None
+    tally = KmerTally(k)
+    batch = []
+    for _, seq_len, left_win, right_win in contig_ends:
         if seq_len < window_size * 2:
-            print(f"  [提示] Contig {contig_id} 长度({seq_len})小于两倍搜索窗口，仍会扫描，但不参与全局 Motif 寻找。")
-            # 序列太短，直接把全长当做窗口存起来
-            contigs_data.append((contig_id, seq_len, seq, seq))
             continue
-            
-        left_win = seq[:window_size]
-        right_win = seq[-window_size:]
-        
-        contigs_data.append((contig_id, seq_len, left_win, right_win))
-        left_windows_for_discovery.append(left_win)
-        right_windows_for_discovery.append(right_win)
+        batch.append(left_win if side == 0 else right_win)
+        if len(batch) >= window_budget:
+            tally.add(batch)
+            batch = []
+    tally.add(batch)
+    return tally.best()
+
+
+class InterstitialTracker:
+    """逐块扫描单条 contig，记录串联 motif 连续命中区段 (跨块保持状态)"""
 
-    if not contigs_data:
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.carry = np.zeros(0, dtype=np.uint8)
+        self.position = 0
+        self.run_start = None
+        self.runs = []
+
+    def feed(self, chunk):
+        codes = np.concatenate((self.carry, encode_bases(chunk)))
+        start = self.position - len(self.carry)
+        values, valid = kmer_codes(codes, self.scanner.k)
+        mask = self.scanner.tandem_mask(values, valid)
+        if len(mask):
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+            for run_from, run_to in zip(edges[::2], edges[1::2]):
+                run_from = int(run_from) + start
+                run_to = int(run_to) + start
+                if self.run_start is not None and run_from == self.run_start[1]:
+                    run_from = self.run_start[0]
+                elif self.run_start is not None:
+                    self.runs.append(self.run_start)
+                self.run_start = (run_from, run_to)
+            if self.run_start is not None and self.run_start[1] < start + len(mask):
+                self.runs.append(self.run_start)
+                self.run_start = None
+        self.position += len(chunk)
+        self.carry = codes[-(self.scanner.k - 1):] if self.scanner.k > 1 else codes[:0]
+
+    def finish(self, window_size, min_count):
+        """只保留完全位于两端窗口之外、至少 min_count 个重复单元的区段"""
+        if self.run_start is not None:
+            self.runs.append(self.run_start)
+        k = self.scanner.k
+        arrays = 0
+        bases = 0
+        for run_from, run_to in self.runs:
+            span = run_to - run_from + k - 1
+            if span // k >= min_count and run_from >= window_size and run_from + span <= self.position - window_size:
+                arrays += 1
+                bases += span
+        return arrays, bases
+
+
+def scan_interstitial(filepath, scanner, window_size, min_count):
+    """顺序流式读取整条 contig，统计内部 (两端窗口之外) 的端粒样重复区段 (ITS)。
+
+    按块读取序列，内存与 contig 长度无关。返回 {contig_id: (区段数, 区段总长)}。
+    """
+    opener = gzip.open if is_gzip(filepath) else open
+    results = {}
+    with opener(filepath, 'rb') as f:
+        contig_id = None
+        tracker = None
+        buffer = bytearray()
+        for line in f:
+            if line.startswith(b">"):
+                if tracker is not None:
+                    tracker.feed(bytes(buffer))
+                    results[contig_id] = tracker.finish(window_size, min_count)
+                contig_id = line[1:].split()[0].decode()
+                tracker = InterstitialTracker(scanner)
+                buffer = bytearray()
+                continue
+            buffer += line.rstrip(b"\r\n")
+            if len(buffer) >= CHUNK_BASES:
+                tracker.feed(bytes(buffer))
+                buffer = bytearray()
+        if tracker is not None:
+            tracker.feed(bytes(buffer))
+            results[contig_id] = tracker.finish(window_size, min_count)
+    return results
+
+
+def process_fasta(filepath, mode, window_size, min_count, motif_5=None, k_len=None, interstitial=False,
+                  window_budget=10000):
+    """处理单个FASTA文件：先寻找全局Motif，再统一扫描
+
+    可随机读取时 contig 长度直接取自 .fai，端部窗口用到时再按偏移读取，
+    同一时刻最多只在内存中保留 window_budget 个窗口；普通 gzip 或行长不一致时
+    只顺序读取一遍，把长度和两端窗口一起留在内存中供后续步骤复用。
+    适合在进程池中同时处理多个组装。
+    """
+    results = []
+    name = os.path.basename(filepath)
+
+    # 步骤 1: 只判断一次能否按偏移读取，并取得 contig 长度
+    entries = load_contig_index(filepath)
+    if entries is None:
+        cached_ends = list(stream_contig_ends(filepath, window_size))
+        lengths = [(contig_id, seq_len) for contig_id, seq_len, _, _ in cached_ends]
+
+        def contig_ends():
+            return iter(cached_ends)
+    else:
+        lengths = [(entry[0], entry[1]) for entry in entries]
+
+        def contig_ends():
+            return iter_contig_ends(filepath, window_size, entries)
+
+    if not lengths:
         return []
+    for contig_id, seq_len in lengths:
+        if seq_len < window_size * 2:
+            print(f"  [提示] {name}: Contig {contig_id} 长度({seq_len})小于两倍搜索窗口，仍会扫描，但不参与全局 Motif 寻找。")
 
     # 步骤 2: 确定该 FASTA 文件的全局 Motif
     global_motif_5 = motif_5
@@ -89,34 +574,49 @@ def process_fasta(filepath, mode, window_size, min_count, motif_5=None, k_len=No
     
     if mode == 'denovo':
         # 把所有长 contig 的左端汇总，寻找最强信号
-        global_motif_5 = find_global_motif(left_windows_for_discovery, k_len)
+        global_motif_5 = discover_motif(contig_ends(), window_size, k_len, 0, window_budget)
         if global_motif_5:
             global_motif_3 = reverse_complement(global_motif_5)
         else:
             # 如果左端什么都没找到，尝试去所有右端找
-            global_motif_3 = find_global_motif(right_windows_for_discovery, k_len)
+            global_motif_3 = discover_motif(contig_ends(), window_size, k_len, 1, window_budget)
             if global_motif_3:
                 global_motif_5 = reverse_complement(global_motif_3)
             else:
-                print(f"  [警告] 在该文件中未能自动找到有效的长度为 {k_len} 的重复序列！跳过。")
+                print(f"  [警告] {name}: 未能自动找到有效的长度为 {k_len} 的重复序列！跳过。")
                 return []
     else:
         # fixed 模式
         if global_motif_5:
             global_motif_3 = reverse_complement(global_motif_5)
 
-    print(f"  [成功] 锁定该文件全局 Motif -> 5'端: {global_motif_5} | 3'端: {global_motif_3}")
+    print(f"  [成功] {name}: 锁定全局 Motif -> 5'端: {global_motif_5} | 3'端: {global_motif_3}")
 
-    # 步骤 3: 使用全局唯一的 Motif 统一扫描之前存下来的所有 Contig 端部
-    for contig_id, seq_len, left_win, right_win in contigs_data:
-        left_count = count_motif(left_win, global_motif_5)
-        right_count = count_motif(right_win, global_motif_3)
+    scanner = None
+    if MotifScanner.usable(global_motif_5):
+        scanner = MotifScanner(global_motif_5, global_motif_3)
+    elif interstitial:
+        print("  [提示] Motif 含非 ACGT 字符或过长，跳过内部重复扫描。")
+
+    its_counts = {}
+    if interstitial and scanner is not None:
+        print("  [提示] 正在顺序扫描 contig 内部的端粒样重复 (ITS)...")
+        its_counts = scan_interstitial(filepath, scanner, window_size, min_count)
+
+    # 步骤 3: 使用全局唯一的 Motif 再取一遍端部窗口统一扫描
+    for contig_id, seq_len, left_win, right_win in contig_ends():
+        if scanner is not None:
+            left_count = scanner.count(left_win, 0)
+            right_count = scanner.count(right_win, 1)
+        else:
+            left_count = count_motif(left_win, global_motif_5)
+            right_count = count_motif(right_win, global_motif_3)
         
         has_left = "Yes" if left_count >= min_count else "No"
         has_right = "Yes" if right_count >= min_count else "No"
         has_both = "Yes" if (has_left == "Yes" and has_right == "Yes") else "No"
         
-        results.append({
+        row = {
             'contig_id': contig_id,
             'contig_len': seq_len,
             'left_telo_count': left_count,
@@ -126,7 +626,10 @@ def process_fasta(filepath, mode, window_size, min_count, motif_5=None, k_len=No
             'has_both': has_both,
             'detected_5_motif': global_motif_5,
             'detected_3_motif': global_motif_3
-        })
+        }
+        if interstitial:
+            row['interstitial_arrays'], row['interstitial_bp'] = its_counts.get(contig_id, (0, 0))
+        results.append(row)
         
     return results
 
@@ -138,6 +641,10 @@ def main():
     parser.add_argument('-k', '--kmer', type=int, help="De novo模式的k-mer长度 (例如 6)")
     parser.add_argument('-w', '--window', type=int, default=1000, help="两端搜索范围(bp)，默认1000")
     parser.add_argument('-c', '--min_count', type=int, default=3, help="判定为存在的最小重复次数，默认3")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="同时处理的组装数 (进程数)，默认1；0 表示按 CPU 核数自动决定")
+    parser.add_argument('-b', '--window_budget', type=int, default=10000, help="每个进程一次最多在内存中保留的端部窗口数，默认10000")
+    parser.add_argument('-o', '--summary', help="多组装对比汇总表路径，默认脚本目录下 telomere_summary.csv")
+    parser.add_argument('-I', '--interstitial', action='store_true', help="额外扫描整条 contig 内部的端粒样重复 (ITS)")
     
     args = parser.parse_args()
     
@@ -145,11 +652,12 @@ def main():
     target_files = []
     script_dir = os.path.dirname(os.path.abspath(__file__))
     
-    local_fastas = (
-        glob.glob(os.path.join(script_dir, "*.fa")) + 
-        glob.glob(os.path.join(script_dir, "*.fasta")) + 
-        glob.glob(os.path.join(script_dir, "*.fna"))
-    )
+    local_fastas = [
+        path
+        for suffix in ("fa", "fasta", "fna")
+        for pattern in (f"*.{suffix}", f"*.{suffix}.gz")
+        for path in glob.glob(os.path.join(script_dir, pattern))
+    ]
 
     if is_interactive:
         print("====== 端粒批量扫描程序 (交互模式) ======")
@@ -186,6 +694,8 @@ def main():
             
         user_win = input("请输入两端搜索范围 (默认 1000，直接回车使用默认值): ").strip()
         args.window = int(user_win) if user_win else 1000
+        # 交互模式下多个文件自动并行
+        args.jobs = 0
 
     else:
         if args.input:
@@ -204,37 +714,127 @@ def main():
         print("未找到需要处理的文件！")
         return
 
-    print(f"\n即将处理 {len(target_files)} 个文件...")
-    
+    outputs = {}
     for fasta_file in target_files:
-        filename_only = os.path.basename(fasta_file)
-        print(f"\n>>> 正在分析: {filename_only}")
-        
-        out_csv = f"{os.path.splitext(fasta_file)[0]}_telomere.csv"
-        
-        results = process_fasta(
-            filepath=fasta_file,
-            mode=args.mode,
-            window_size=args.window,
-            min_count=args.min_count,
-            motif_5=args.seq5,
-            k_len=args.kmer
-        )
-        
-        if not results:
-            print(f"  [跳过] 未提取到有效 contig 或未找到 Motif，不生成 csv。")
-            continue
-            
-        fieldnames = ['contig_id', 'contig_len', 'left_telo_count', 'right_telo_count', 
-                      'has_left_telo', 'has_right_telo', 'has_both', 
-                      'detected_5_motif', 'detected_3_motif']
-                      
-        with open(out_csv, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        outputs.setdefault(telomere_csv(fasta_file), []).append(os.path.basename(fasta_file))
+    clashes = [names for names in outputs.values() if len(names) > 1]
+    if clashes:
+        print("错误：以下文件会写出同名的结果表，请改名后再运行：")
+        for names in clashes:
+            print("  " + ", ".join(sorted(names)))
+        return
+
+    jobs = args.jobs or min(len(target_files), os.cpu_count() or 1)
+    print(f"\n即将处理 {len(target_files)} 个文件 (并行进程: {min(jobs, len(target_files))})...")
+
+    options = {
+        'mode': args.mode,
+        'window_size': args.window,
+        'min_count': args.min_count,
+        'motif_5': args.seq5,
+        'k_len': args.kmer,
+        'interstitial': args.interstitial,
+        'window_budget': args.window_budget,
+    }
+    tasks = [(fasta_file, options) for fasta_file in sorted(target_files)]
+    summaries = []
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            futures = {pool.submit(analyze_file, task): task[0] for task in tasks}
+            for future in as_completed(futures):
+                summary = future.result()
+                if summary:
+                    summaries.append(summary)
+    else:
+        for task in tasks:
+            summary = analyze_file(task)
+            if summary:
+                summaries.append(summary)
+
+    if len(tasks) > 1 and summaries:
+        summaries.sort(key=lambda row: row['assembly'])
+        out_summary = args.summary or os.path.join(script_dir, "telomere_summary.csv")
+        with open(out_summary, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=SUMMARY_FIELDS)
             writer.writeheader()
-            writer.writerows(results)
-            
-        print(f"  [完成] 结果已保存至: {os.path.basename(out_csv)}")
+            writer.writerows(summaries)
+
+        print("\n====== T2T 完整性对比 ======")
+        print(f"{'assembly':<32}{'contigs':>9}{'T2T':>7}{'telo_ends':>11}{'T2T_bp%':>9}")
+        for row in summaries:
+            print(f"{row['assembly']:<32}{row['contigs']:>9}{row['t2t_contigs']:>7}"
+                  f"{row['telomere_ends']:>11}{row['t2t_bp_percent']:>9}")
+        print(f"\n[完成] 汇总表已保存至: {out_summary}")
+
+
+def assembly_name(fasta_file):
+    """结果表的文件名前缀：去掉 FASTA 扩展名，gzip 压缩的保留 _gz 后缀，避免与同名未压缩文件互相覆盖"""
+    base = os.path.basename(fasta_file)
+    if base.endswith(".gz"):
+        return os.path.splitext(base[:-3])[0] + "_gz"
+    return os.path.splitext(base)[0]
+
+
+def telomere_csv(fasta_file):
+    return os.path.join(os.path.dirname(fasta_file), f"{assembly_name(fasta_file)}_telomere.csv")
+
+
+def analyze_file(task):
+    """扫描单个组装并写出逐 contig 的 csv，返回该组装的 T2T 汇总行 (可在子进程中运行)"""
+    fasta_file, options = task
+    filename_only = os.path.basename(fasta_file)
+    print(f"\n>>> 正在分析: {filename_only}")
+
+    out_csv = telomere_csv(fasta_file)
+
+    results = process_fasta(filepath=fasta_file, **options)
+
+    if not results:
+        print(f"  [跳过] {filename_only}: 未提取到有效 contig 或未找到 Motif，不生成 csv。")
+        return None
+
+    fieldnames = ['contig_id', 'contig_len', 'left_telo_count', 'right_telo_count', 
+                  'has_left_telo', 'has_right_telo', 'has_both', 
+                  'detected_5_motif', 'detected_3_motif']
+    if options['interstitial']:
+        fieldnames += ['interstitial_arrays', 'interstitial_bp']
+
+    with open(out_csv, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"  [完成] 结果已保存至: {os.path.basename(out_csv)}")
+    return summarize_results(filename_only, results)
+
+
+SUMMARY_FIELDS = ['assembly', 'detected_5_motif', 'detected_3_motif', 'contigs', 'total_len',
+                  'left_telo_contigs', 'right_telo_contigs', 'telomere_ends', 'telomere_end_percent',
+                  't2t_contigs', 't2t_bp', 't2t_bp_percent', 'largest_t2t', 'interstitial_arrays']
+
+
+def summarize_results(assembly, results):
+    """把逐 contig 结果汇总为一行：端粒末端数、T2T contig 数及其占组装长度的比例"""
+    total_len = sum(row['contig_len'] for row in results)
+    t2t = [row['contig_len'] for row in results if row['has_both'] == "Yes"]
+    left = sum(row['has_left_telo'] == "Yes" for row in results)
+    right = sum(row['has_right_telo'] == "Yes" for row in results)
+    return {
+        'assembly': assembly,
+        'detected_5_motif': results[0]['detected_5_motif'],
+        'detected_3_motif': results[0]['detected_3_motif'],
+        'contigs': len(results),
+        'total_len': total_len,
+        'left_telo_contigs': left,
+        'right_telo_contigs': right,
+        'telomere_ends': left + right,
+        'telomere_end_percent': round(100 * (left + right) / (2 * len(results)), 2),
+        't2t_contigs': len(t2t),
+        't2t_bp': sum(t2t),
+        't2t_bp_percent': round(100 * sum(t2t) / total_len, 2) if total_len else 0,
+        'largest_t2t': max(t2t, default=0),
+        'interstitial_arrays': sum(row.get('interstitial_arrays', 0) for row in results),
+    }
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
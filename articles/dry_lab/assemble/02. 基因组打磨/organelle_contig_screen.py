@@ -1,27 +1,37 @@
 #!/usr/bin/env python3
 """批量评估组装 contig 与多个线粒体/叶绿体参考基因组的相似性。"""
 
-import csv
 import glob
 import gzip
-import math
+import hashlib
 import os
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
 
 FASTA_EXTENSIONS = (".fasta.gz", ".fa.gz", ".fna.gz", ".fas.gz", ".fasta", ".fa", ".fna", ".fas")
 DEFAULT_THREADS = min(os.cpu_count() or 8, 32)
+QUERY_CHUNK_BP = 50_000_000
+STREAM_BLOCK = 16 * 1024 * 1024
+DATABASE_CACHE = Path(os.environ.get("ORGANELLE_BLASTDB_CACHE", Path.home() / ".cache" / "organelle_blastdb"))
 OUTFMT_FIELDS = (
     "qseqid", "qlen", "sseqid", "slen", "pident", "length", "mismatch",
     "gapopen", "qstart", "qend", "sstart", "send", "evalue", "bitscore",
 )
+SUMMARY_METRICS = (
+    "aligned_bp", "query_coverage_pct", "identity_pct", "bitscore", "evalue", "hsp_count", "organelle_score",
+)
 
 
 def log(message):
@@ -121,135 +131,322 @@ def classify_reference(path):
         print("请输入 m、c 或 o。")
 
 
-def fasta_lengths(path):
-    opener = gzip.open if str(path).lower().endswith(".gz") else open
+def is_gzip(path):
+    return str(path).lower().endswith(".gz")
+
+
+def fasta_lengths(path, stage_to=None, stage_after=QUERY_CHUNK_BP):
+    """一次顺序读取得到每条 contig 的长度，以及它在（解压后）文件中的起始字节偏移。
+
+    偏移用于把大组装切成查询块时直接按字节区间送入 blastn。gzip 无法随机访问，
+    给出 stage_to 时，解压后超过 stage_after 字节（需要拆块）的组装会在同一遍读取中
+    写出一份未压缩副本，各查询块从副本按偏移读取，不必每个 查询块 × 参考 任务都从头解压。
+    返回 (长度, 偏移, 副本路径或 None)。
+    """
+    opener = gzip.open if is_gzip(path) else open
     lengths = {}
+    offsets = {}
     current = None
-    with opener(path, "rt", encoding="utf-8", errors="replace") as handle:
-        for line in handle:
-            if line.startswith(">"):
-                current = line[1:].strip().split()[0]
-                if not current:
-                    raise ValueError(f"空 FASTA 序列名：{path}")
-                if current in lengths:
-                    raise ValueError(f"FASTA 序列名重复：{current}（{path}）")
-                lengths[current] = 0
-            elif current is not None:
-                lengths[current] += len("".join(line.split()))
+    position = 0
+    head = bytearray() if stage_to is not None else None
+    partial = None if stage_to is None else Path(f"{stage_to}.part")
+    staged = None
+    try:
+        with opener(path, "rb") as handle:
+            for line in handle:
+                if line.startswith(b">"):
+                    fields = line[1:].split()
+                    current = fields[0].decode("utf-8", "replace") if fields else ""
+                    if not current:
+                        raise ValueError(f"空 FASTA 序列名：{path}")
+                    if current in lengths:
+                        raise ValueError(f"FASTA 序列名重复：{current}（{path}）")
+                    lengths[current] = 0
+                    offsets[current] = position
+                elif current is not None:
+                    lengths[current] += len(b"".join(line.split()))
+                position += len(line)
+                if staged is not None:
+                    staged.write(line)
+                elif head is not None:
+                    # 未超过阈值前先留在内存，小组装不写副本
+                    head += line
+                    if len(head) > stage_after:
+                        staged = open(partial, "wb", buffering=STREAM_BLOCK)
+                        staged.write(head)
+                        head = None
+    except BaseException:
+        if staged is not None:
+            staged.close()
+            partial.unlink(missing_ok=True)
+        raise
+    if staged is not None:
+        staged.close()
+        partial.replace(stage_to)
     if not lengths:
         raise ValueError(f"没有在文件中读到 FASTA 序列：{path}")
-    return lengths
-
-
-def prepare_fasta(path, staging_dir, label):
-    """BLAST+ 不直接依赖 gzip 支持；压缩输入统一解压到本次输出目录。"""
-    if not str(path).lower().endswith(".gz"):
-        return os.path.abspath(path)
-    staging_dir.mkdir(parents=True, exist_ok=True)
-    destination = staging_dir / f"{label}.fasta"
-    log(f"解压暂存：{path} -> {destination}")
-    with gzip.open(path, "rb") as source, open(destination, "wb") as target:
-        shutil.copyfileobj(source, target, length=16 * 1024 * 1024)
-    return str(destination)
-
-
-def merge_length(intervals):
-    if not intervals:
-        return 0
-    total = 0
-    start, end = sorted(intervals)[0]
-    for next_start, next_end in sorted(intervals)[1:]:
-        if next_start <= end + 1:
-            end = max(end, next_end)
-        else:
-            total += end - start + 1
-            start, end = next_start, next_end
-    return total + end - start + 1
+    return lengths, offsets, (stage_to if staged is not None else None)
+
+
+def feed_fasta(path, target, start=0, end=None):
+    """把 FASTA（可 gzip）解压后 [start, end) 的字节写入管道；end 为 None 表示到文件末尾。
+
+    普通文件直接 seek；gzip 无法随机访问，只能边解压边跳过前面的字节，
+    因此需要拆块的 gzip 组装改从 fasta_lengths 写出的未压缩副本读取。
+    """
+    opener = gzip.open if is_gzip(path) else open
+    remaining = None if end is None else end - start
+    try:
+        with opener(path, "rb") as source:
+            if is_gzip(path):
+                skip = start
+                while skip:
+                    skipped = len(source.read(min(skip, STREAM_BLOCK)))
+                    if not skipped:
+                        break
+                    skip -= skipped
+            else:
+                source.seek(start)
+            while remaining is None or remaining > 0:
+                block = source.read(STREAM_BLOCK if remaining is None else min(remaining, STREAM_BLOCK))
+                if not block:
+                    break
+                target.write(block)
+                if remaining is not None:
+                    remaining -= len(block)
+    except BrokenPipeError:
+        # 下游进程提前退出时由其退出码报告错误
+        pass
+    finally:
+        try:
+            target.close()
+        except BrokenPipeError:
+            pass
+
+
+def run_streamed(command, path, start=0, end=None):
+    """运行从标准输入读取 FASTA 的命令，输入由后台线程流式写入。"""
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    feeder = threading.Thread(target=feed_fasta, args=(path, process.stdin, start, end))
+    feeder.start()
+    feeder.join()
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def merged_coverage(codes, starts, ends, size):
+    """分组排序后一次扫描合并重叠/相邻区间，返回每个分组被覆盖的碱基数。
+
+    按 (分组, 起点) 排序，组内终点取累计最大值；起点超过此前最大终点 + 1 即开始新区间。
+    """
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    reach = pd.Series(ends).groupby(codes).cummax().to_numpy()
+    new_block = np.ones(len(codes), dtype=bool)
+    new_block[1:] = (codes[1:] != codes[:-1]) | (starts[1:] > reach[:-1] + 1)
+    block_starts = np.flatnonzero(new_block)
+    block_ends = np.maximum.reduceat(ends, block_starts) if len(block_starts) else ends[:0]
+    spans = block_ends - starts[block_starts] + 1
+    return np.bincount(codes[block_starts], weights=spans, minlength=size).astype(np.int64)
 
 
 def organelle_score(query_coverage_pct, identity_pct):
     """启发式证据分数，并非经过统计校准的概率。"""
     evidence = (query_coverage_pct / 100.0) * (identity_pct / 100.0) ** 2
-    return 1.0 - math.exp(-6.0 * evidence)
+    return 1.0 - np.exp(-6.0 * evidence)
+
+
+def blast_version():
+    result = subprocess.run(["makeblastdb", "-version"], capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines()[0]
+
+
+def reference_digest(path, version):
+    """按序列内容与 BLAST 版本计算缓存键；与是否压缩、换行宽度无关。"""
+    digest = hashlib.sha256(version.encode())
+    opener = gzip.open if is_gzip(path) else open
+    with opener(path, "rb") as handle:
+        for line in handle:
+            if line.startswith(b">"):
+                digest.update(b"\n" + line.strip() + b"\n")
+            else:
+                digest.update(b"".join(line.split()))
+    return digest.hexdigest()
+
 
+def make_database(path, label, prefix):
+    """普通 FASTA 直接建库；gzip 参考经管道送入 makeblastdb，不解压落盘。"""
+    command = ["makeblastdb", "-dbtype", "nucl", "-title", label, "-out", str(prefix)]
+    if is_gzip(path):
+        run_streamed(command + ["-in", "-"], path)
+    else:
+        subprocess.run(command + ["-in", os.path.abspath(path)], check=True)
 
-def build_databases(references, labels, database_dir, staging_dir):
+
+def build_databases(references, labels, database_dir, cache_dir=DATABASE_CACHE):
+    """从持久缓存中取库，未命中时才建库；本次输出目录中只放指向缓存的链接。
+
+    缓存目录以 sha256(序列内容 + BLAST 版本) 命名，先在临时目录建库再整体改名，
+    中途失败或多个任务同时建库都不会留下不完整的库。
+    """
+    version = blast_version()
     databases = []
     for path, label in zip(references, labels):
-        target_dir = database_dir / label
-        target_dir.mkdir(parents=True, exist_ok=True)
-        prefix = target_dir / "reference"
-        log(f"建库：{label}")
-        prepared_path = prepare_fasta(path, staging_dir, label)
-        subprocess.run(
-            ["makeblastdb", "-in", prepared_path, "-dbtype", "nucl", "-out", str(prefix)],
-            check=True,
-        )
-        databases.append(prefix)
+        key = reference_digest(path, version)
+        entry = cache_dir / key[:2] / key
+        if (entry / ".complete").exists():
+            log(f"复用缓存库：{label}（{key[:12]}）")
+        else:
+            log(f"建库：{label}（{key[:12]}）")
+            staging = entry.with_name(f"{key}.tmp{os.getpid()}")
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir(parents=True)
+            make_database(path, label, staging / "reference")
+            (staging / ".complete").write_text(f"{os.path.abspath(path)}\n{version}\n", encoding="utf-8")
+            try:
+                staging.rename(entry)
+            except OSError:
+                # 其它任务已先建好同一个库
+                shutil.rmtree(staging, ignore_errors=True)
+        link = database_dir / label
+        if link.is_symlink() or link.is_file():
+            link.unlink()
+        elif link.exists():
+            shutil.rmtree(link)
+        link.symlink_to(entry, target_is_directory=True)
+        databases.append(entry / "reference")
     return databases
 
 
-def run_blast(assembly, database, output_file, threads):
+def plan_chunks(contigs, chunk_bp=QUERY_CHUNK_BP):
+    """按 contig 顺序把组装分成总长约 chunk_bp 的查询块，单条 contig 不拆分。"""
+    chunks = []
+    current = []
+    size = 0
+    for contig, length in contigs.items():
+        if current and size + length > chunk_bp:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(contig)
+        size += length
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def query_ranges(contigs, offsets):
+    """把查询块换算成组装文件中的字节区间 [(start, end)]，最后一块的 end 为 None。"""
+    starts = [offsets[names[0]] for names in plan_chunks(contigs)]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def run_blast(assembly, database, output_file, threads, start=0, end=None):
+    """先写入 .part 临时文件，成功后再改名；最终文件存在即代表该比对已完成。
+
+    未压缩的完整组装直接作为 -query；gzip 或查询块经标准输入流式送入 blastn。
+    """
+    partial = Path(f"{output_file}.part")
     command = [
-        "blastn", "-query", os.path.abspath(assembly), "-db", str(database),
+        "blastn", "-db", str(database),
         "-task", "blastn", "-evalue", "1e-10", "-max_target_seqs", "1000",
         "-num_threads", str(threads), "-outfmt", "6 " + " ".join(OUTFMT_FIELDS),
-        "-out", str(output_file),
+        "-out", str(partial),
     ]
-    subprocess.run(command, check=True)
+    if is_gzip(assembly) or start or end is not None:
+        run_streamed(command + ["-query", "-"], assembly, start, end)
+    else:
+        subprocess.run(command + ["-query", os.path.abspath(assembly)], check=True)
+    partial.replace(output_file)
+
+
+def merge_outputs(parts, output_file):
+    """把各查询块的 BLAST 结果按块顺序合并为一个原始表。"""
+    partial = Path(f"{output_file}.part")
+    with open(partial, "wb") as target:
+        for part in parts:
+            with open(part, "rb") as source:
+                shutil.copyfileobj(source, target, length=16 * 1024 * 1024)
+    partial.replace(output_file)
+    for part in parts:
+        part.unlink()
 
 
 def summarize_blast(path, contig_lengths):
-    hits = defaultdict(list)
-    with open(path, encoding="utf-8") as handle:
-        reader = csv.DictReader(handle, fieldnames=OUTFMT_FIELDS, delimiter="\t")
-        for row in reader:
-            hits[row["qseqid"]].append(row)
-    summaries = {}
-    for contig, rows in hits.items():
-        intervals = [(min(int(r["qstart"]), int(r["qend"])), max(int(r["qstart"]), int(r["qend"]))) for r in rows]
-        aligned = merge_length(intervals)
-        hsp_bases = sum(int(r["length"]) for r in rows)
-        identity = sum(float(r["pident"]) * int(r["length"]) for r in rows) / hsp_bases
-        coverage = 100.0 * aligned / contig_lengths[contig]
-        summaries[contig] = {
-            "aligned_bp": aligned,
-            "query_coverage_pct": coverage,
-            "identity_pct": identity,
-            "bitscore": sum(float(r["bitscore"]) for r in rows),
-            "evalue": min(float(r["evalue"]) for r in rows),
-            "hsp_count": len(rows),
-            "organelle_score": organelle_score(coverage, identity),
-        }
-    return summaries
+    """按列载入 BLAST 表并分组汇总，返回以 contig 为索引的 DataFrame（无命中的 contig 不出现）。"""
+    columns = ["qseqid", "qstart", "qend", "pident", "length", "evalue", "bitscore"]
+    if os.path.getsize(path) == 0:
+        return pd.DataFrame(columns=SUMMARY_METRICS, index=pd.Index([], name="contig"))
+    hits = pd.read_csv(
+        path, sep="\t", header=None, names=OUTFMT_FIELDS, usecols=columns,
+        dtype={"qseqid": str, "qstart": np.int64, "qend": np.int64, "length": np.int64},
+        # 默认的快速浮点解析不能往返还原 e-value（如 1e-50 → 9.999999999999999e-51）
+        float_precision="round_trip",
+    )
+    codes, contigs = pd.factorize(hits["qseqid"])
+    qstart = hits["qstart"].to_numpy()
+    qend = hits["qend"].to_numpy()
+    aligned = merged_coverage(codes, np.minimum(qstart, qend), np.maximum(qstart, qend), len(contigs))
+    length = hits["length"].to_numpy()
+    grouped = hits.groupby(codes, sort=True)
+    summary = pd.DataFrame(index=pd.Index(contigs, name="contig"))
+    summary["aligned_bp"] = aligned
+    summary["query_coverage_pct"] = 100.0 * aligned / pd.Series(contig_lengths).reindex(contigs).to_numpy()
+    # bincount 按行顺序逐个累加，与逐行求和的舍入一致（groupby.sum 为补偿求和，末位可能不同）
+    weighted = np.bincount(codes, weights=hits["pident"].to_numpy() * length, minlength=len(contigs))
+    summary["identity_pct"] = weighted / np.bincount(codes, weights=length, minlength=len(contigs))
+    summary["bitscore"] = np.bincount(codes, weights=hits["bitscore"].to_numpy(), minlength=len(contigs))
+    summary["evalue"] = grouped["evalue"].min().to_numpy()
+    summary["hsp_count"] = grouped.size().to_numpy()
+    summary["organelle_score"] = organelle_score(summary["query_coverage_pct"], summary["identity_pct"])
+    return summary
 
 
 def write_matrix(path, assembly, contigs, labels, reference_types, results):
-    metrics = ("aligned_bp", "query_coverage_pct", "identity_pct", "bitscore", "evalue", "hsp_count", "organelle_score")
-    fields = ["assembly", "contig", "contig_length", "best_reference", "best_reference_type", "organelle_score"]
-    fields.extend(f"{label}__{metric}" for label in labels for metric in metrics)
-    with open(path, "w", newline="", encoding="utf-8-sig") as handle:
-        writer = csv.DictWriter(handle, fieldnames=fields, delimiter="\t")
-        writer.writeheader()
-        for contig, length in contigs.items():
-            candidates = [(results[label].get(contig, {}).get("organelle_score", 0.0), label) for label in labels]
-            best_score, best_label = max(candidates)
-            row = {
-                "assembly": os.path.abspath(assembly), "contig": contig, "contig_length": length,
-                "best_reference": best_label if best_score else "",
-                "best_reference_type": reference_types[best_label] if best_score else "",
-                "organelle_score": f"{best_score:.6f}",
-            }
-            for label in labels:
-                summary = results[label].get(contig, {})
-                for metric in metrics:
-                    value = summary.get(metric, 0)
-                    if metric in {"query_coverage_pct", "identity_pct", "bitscore"}:
-                        value = f"{value:.4f}"
-                    elif metric == "organelle_score":
-                        value = f"{value:.6f}"
-                    row[f"{label}__{metric}"] = value
-            writer.writerow(row)
+    """results 为 {参考名: summarize_blast 的 DataFrame}；整表按列拼接后一次写出。"""
+    index = pd.Index(list(contigs), name="contig")
+    matrix = pd.DataFrame({
+        "assembly": os.path.abspath(assembly),
+        "contig": index,
+        "contig_length": list(contigs.values()),
+    }, index=index)
+    scores = pd.DataFrame({
+        label: results[label]["organelle_score"].reindex(index, fill_value=0.0).astype(float)
+        for label in labels
+    })
+    # 与逐行取 max((score, label)) 一致：并列时取名称排序最大的参考
+    ranked = sorted(labels, reverse=True)
+    best_label = scores[ranked].idxmax(axis=1)
+    best_score = scores.max(axis=1)
+    has_hit = best_score > 0
+    matrix["best_reference"] = best_label.where(has_hit, "")
+    matrix["best_reference_type"] = best_label.map(reference_types).where(has_hit, "")
+    matrix["organelle_score"] = best_score.map("{:.6f}".format)
+    for label in labels:
+        summary = results[label].reindex(index)
+        hit = summary["hsp_count"].notna()
+        for metric in SUMMARY_METRICS:
+            values = summary[metric]
+            if metric in {"aligned_bp", "hsp_count"}:
+                column = values.fillna(0).astype(np.int64).astype(str)
+            elif metric == "evalue":
+                column = values.map(lambda value: str(float(value))).where(hit, "0")
+            elif metric == "organelle_score":
+                column = values.fillna(0.0).map("{:.6f}".format)
+            else:
+                column = values.fillna(0.0).map("{:.4f}".format)
+            matrix[f"{label}__{metric}"] = column
+    matrix.to_csv(path, sep="\t", index=False, encoding="utf-8-sig", lineterminator="\r\n")
+
+
+def finish_sample(sample, labels, reference_types):
+    """某份组装的全部比对完成后：合并查询块结果、汇总并写出矩阵。"""
+    for reference_label, parts in sample["parts"].items():
+        merge_outputs(parts, sample["raw_files"][reference_label])
+    results = {label: summarize_blast(sample["raw_files"][label], sample["contigs"]) for label in labels}
+    write_matrix(sample["matrix"], sample["assembly"], sample["contigs"], labels, reference_types, results)
+    if sample["query"] != sample["assembly"]:
+        Path(sample["query"]).unlink(missing_ok=True)
+    log(f"  矩阵完成：{sample['matrix']}")
 
 
 def main():
@@ -267,15 +464,19 @@ def main():
         assemblies = select_files(files, "请选择一个或多个组装结果：", excluded=references)
         reference_labels = unique_labels(references)
         reference_types = {label: classify_reference(path) for path, label in zip(references, reference_labels)}
-        threads = int(ask_text("BLAST 使用的线程数", DEFAULT_THREADS))
+        threads = int(ask_text("BLAST 使用的总线程数", DEFAULT_THREADS))
         if threads < 1:
             raise ValueError("线程数必须大于 0。")
+        workers = int(ask_text("同时运行的 blastn 任务数（总线程数在任务间平分）", threads))
+        if workers < 1:
+            raise ValueError("任务数必须大于 0。")
         default_output = f"organelle_screen_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         output_dir = Path(ask_text("输出文件夹", default_output)).resolve()
     except (ValueError, EOFError) as error:
         raise SystemExit(f"参数设置失败：{error}") from error
     if output_dir.exists() and any(output_dir.iterdir()):
-        raise SystemExit(f"输出文件夹已存在且非空：{output_dir}")
+        if not ask_yes_no(f"输出文件夹已存在且非空：{output_dir}，是否在其中续跑（跳过已完成的比对）", True):
+            return
     print("\n运行配置：")
     print(f"  参考基因组：{len(references)} 个")
     print(f"  组装结果：{len(assemblies)} 个")
@@ -284,26 +485,69 @@ def main():
         return
     database_dir = output_dir / "00_blast_databases"
     database_dir.mkdir(parents=True, exist_ok=True)
-    databases = build_databases(references, reference_labels, database_dir, output_dir / "00_staged_inputs" / "references")
+    databases = build_databases(references, reference_labels, database_dir)
     assembly_labels = unique_labels(assemblies)
-    for index, (assembly, assembly_label) in enumerate(zip(assemblies, assembly_labels), 1):
-        log(f"处理组装 [{index}/{len(assemblies)}]：{assembly_label}")
+
+    # 先为全部 组装 × 参考 × 查询块 生成任务，已有结果的比对直接跳过。
+    samples = []
+    jobs = []
+    for assembly, assembly_label in zip(assemblies, assembly_labels):
         sample_dir = output_dir / assembly_label
         raw_dir = sample_dir / "01_blast_raw"
         result_dir = sample_dir / "02_results"
         raw_dir.mkdir(parents=True, exist_ok=True)
         result_dir.mkdir(parents=True, exist_ok=True)
-        contigs = fasta_lengths(assembly)
-        prepared_assembly = prepare_fasta(assembly, sample_dir / "00_staged_input", assembly_label)
-        results = {}
+        raw_files = {label: raw_dir / f"{label}.blast.tsv" for label in reference_labels}
+        pending = [label for label in reference_labels if not raw_files[label].exists()]
+        stage_to = raw_dir / "query.fasta" if pending and is_gzip(assembly) else None
+        contigs, offsets, staged = fasta_lengths(assembly, stage_to)
+        sample = {
+            "assembly": assembly, "query": staged or assembly, "label": assembly_label, "contigs": contigs,
+            "raw_files": raw_files, "parts": {}, "remaining": 0,
+            "matrix": result_dir / f"{assembly_label}.organelle_matrix.tsv",
+        }
+        samples.append(sample)
+        if not pending:
+            continue
+        queries = query_ranges(contigs, offsets)
+        if len(queries) > 1:
+            log(f"{assembly_label}：拆分为 {len(queries)} 个查询块")
         for reference_label, database in zip(reference_labels, databases):
-            raw_file = raw_dir / f"{reference_label}.blast.tsv"
-            log(f"  比对到：{reference_label}")
-            run_blast(prepared_assembly, database, raw_file, threads)
-            results[reference_label] = summarize_blast(raw_file, contigs)
-        matrix = result_dir / f"{assembly_label}.organelle_matrix.tsv"
-        write_matrix(matrix, assembly, contigs, reference_labels, reference_types, results)
-        log(f"  矩阵完成：{matrix}")
+            if reference_label not in pending:
+                continue
+            if len(queries) == 1:
+                outputs = [raw_files[reference_label]]
+            else:
+                outputs = [raw_dir / f"{reference_label}.chunk{index:03d}.blast.tsv" for index in range(len(queries))]
+                sample["parts"][reference_label] = outputs
+            for query, output in zip(queries, outputs):
+                if not output.exists():
+                    jobs.append((sample, database, output, query))
+                    sample["remaining"] += 1
+
+    for sample in samples:
+        if sample["remaining"] == 0:
+            finish_sample(sample, reference_labels, reference_types)
+
+    if jobs:
+        workers = min(workers, len(jobs))
+        job_threads = max(1, threads // workers)
+        log(f"待运行 blastn 任务 {len(jobs)} 个：同时运行 {workers} 个，每个 {job_threads} 线程")
+        pool = ThreadPoolExecutor(max_workers=workers)
+        futures = {
+            pool.submit(run_blast, sample["query"], database, output, job_threads, *query): (sample, output)
+            for sample, database, output, query in jobs
+        }
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                sample, output = futures[future]
+                log(f"  [{done}/{len(jobs)}] 完成：{sample['label']} / {output.name}")
+                sample["remaining"] -= 1
+                if sample["remaining"] == 0:
+                    finish_sample(sample, reference_labels, reference_types)
+        finally:
+            pool.shutdown(cancel_futures=True)
     log(f"全部任务完成：{output_dir}")
     print("提示：organelle_score 是覆盖度和一致性的启发式评分，不是统计学概率；请结合 contig 长度、重复序列和生物学背景人工判断。")
 
@@ -4,23 +4,35 @@
 Designed for paired-end Hi-C lanes named like *_R1/*_R2 or *_1/*_2.
 The script never modifies input FASTQ files. It creates a reference link/copy,
 logs every command, and supports resuming completed steps.
+
+With ``--stream`` each lane is aligned concurrently and streamed through
+samblaster straight into a read-name grouped BAM shard, skipping the
+coordinate sort, merge and Picard passes. Shards remember the MD5 of every
+contig they were aligned against, so after small assembly edits only the
+pairs touching changed contigs (or unmapped pairs) are realigned.
 """
 
 from __future__ import annotations
 
 import argparse
+import hashlib
 import os
 import re
 import shlex
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 
 
 FASTQ_SUFFIXES = (".fastq.gz", ".fq.gz", ".fastq", ".fq")
+INDEX_SUFFIXES = (".fai", ".amb", ".ann", ".bwt", ".pac", ".sa")
+# Above this many changed contigs a full realignment is simpler than filtering.
+MAX_CHANGED_CONTIGS = 500
+HASH_BLOCK = 16 * 1024 * 1024
 PAIR_PATTERNS = (
     re.compile(r"^(.*?)([_\.-])R([12])([_\.-].*)?$", re.I),
     re.compile(r"^(.*?)([_\.-])READ([12])([_\.-].*)?$", re.I),
@@ -220,6 +232,170 @@ def prepare_reference(source: Path, destination: Path) -> None:
         shutil.copy2(source, destination)
 
 
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def refresh_reference(source: Path, destination: Path) -> bool:
+    """Point the reference at ``source``; return True when it changed.
+
+    The source size, mtime_ns and SHA-256 are stored next to the indexes, so
+    an assembly edited in place at the same path is also detected. The hash
+    is only recomputed when size or mtime differ from the stored stamp.
+    """
+    stamp_path = Path(str(destination) + ".source")
+    stat = source.stat()
+    stored = stamp_path.read_text(encoding="utf-8").split("\t") if stamp_path.is_file() else []
+    if destination.is_symlink() and destination.resolve() != source:
+        digest, changed = file_digest(source), True
+    elif len(stored) == 3 and stored[:2] == [str(stat.st_size), str(stat.st_mtime_ns)]:
+        digest, changed = stored[2], False
+    else:
+        digest = file_digest(source)
+        changed = destination.exists() and (len(stored) != 3 or stored[2] != digest)
+    if changed:
+        print(f"参考序列已更换或被修改，重建索引: {source}")
+        destination.unlink(missing_ok=True)
+        for suffix in INDEX_SUFFIXES:
+            Path(str(destination) + suffix).unlink(missing_ok=True)
+        destination.with_suffix(".dict").unlink(missing_ok=True)
+    prepare_reference(source, destination)
+    stamp_path.write_text(f"{stat.st_size}\t{stat.st_mtime_ns}\t{digest}", encoding="utf-8")
+    return changed
+
+
+def read_contig_md5(path: Path) -> dict[str, str]:
+    """Parse SN/M5 pairs from a ``samtools dict`` file or a shard manifest."""
+    contigs: dict[str, str] = {}
+    if not path.is_file():
+        return contigs
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if line.startswith("@SQ"):
+            fields = dict(
+                field.split(":", 1) for field in line.split("\t")[1:] if ":" in field
+            )
+            if "SN" in fields and "M5" in fields:
+                contigs[fields["SN"]] = fields["M5"]
+        elif "\t" in line and not line.startswith("@"):
+            name, digest = line.split("\t", 1)
+            contigs[name] = digest
+    return contigs
+
+
+def write_contig_md5(path: Path, contigs: dict[str, str]) -> None:
+    path.write_text(
+        "".join(f"{name}\t{digest}\n" for name, digest in contigs.items()),
+        encoding="utf-8",
+    )
+
+
+def ere_escape(text: str) -> str:
+    """Escape a contig name for a POSIX extended regex in samtools -e."""
+    return "".join(f"[{char}]" if char in ".[]()*+?{}|$" else char for char in text)
+
+
+def stream_lane(
+    runner: Runner,
+    pair: ReadPair,
+    label: str,
+    reference: Path,
+    contigs: dict[str, str],
+    shard_dir: Path,
+    threads: int,
+) -> bool:
+    """Align one lane into a name-grouped shard; return True if it was rebuilt.
+
+    A shard whose contigs all still match is reused as is. When only a few
+    contigs changed, pairs that touch them (or have an unmapped end) are
+    converted back to FASTQ and realigned; every other record is kept and
+    re-encoded against the new header.
+    """
+    bam = shard_dir / f"{label}.bam"
+    manifest = shard_dir / f"{label}.contigs.tsv"
+    lane_done = shard_dir / f".{label}.complete"
+    read_group = f"@RG\\tID:{label}\\tSM:HIC\\tLB:HIC\\tPL:ILLUMINA\\tPU:{label}"
+    align_tail = [
+        ["samblaster", "--addMateTags"],
+        ["samtools", "view", "-@", str(threads), "-b", "-F", "0x900", "-o"],
+    ]
+
+    if ready(lane_done) and ready(bam):
+        previous = read_contig_md5(manifest)
+        changed = {name for name, digest in previous.items() if contigs.get(name) != digest}
+        if not changed:
+            print(f"跳过未变化的比对分片: {bam}")
+            return False
+        if len(changed) <= MAX_CHANGED_CONTIGS and len(changed) * 2 < len(previous):
+            print(f"{label}: {len(changed)} 条 contig 有变化，仅重新比对相关 read pairs")
+            pattern = "^(" + "|".join(ere_escape(name) for name in sorted(changed)) + ")$"
+            touched = (
+                f'flag.unmap || flag.munmap || rname =~ "{pattern}" '
+                f'|| mrname =~ "{pattern}"'
+            )
+            header = shard_dir / f"{label}.header.sam"
+            keep = shard_dir / f"{label}.keep.bam"
+            realigned = shard_dir / f"{label}.realigned.bam"
+            updated = shard_dir / f"{label}.updated.bam"
+            if not runner.dry_run:
+                dict_lines = reference.with_suffix(".dict").read_text(encoding="utf-8")
+                header.write_text(
+                    dict_lines + read_group.replace("\\t", "\t") + "\n", encoding="utf-8"
+                )
+            runner.pipe(
+                [
+                    [
+                        "sh", "-c",
+                        f"cat {shlex.quote(str(header))} && samtools view "
+                        f"-e {shlex.quote(f'!({touched})')} {shlex.quote(str(bam))}",
+                    ],
+                    ["samtools", "view", "-@", str(threads), "-b", "-o", str(keep), "-"],
+                ],
+                keep,
+            )
+            runner.pipe(
+                [
+                    ["samtools", "view", "-u", "-e", touched, str(bam)],
+                    ["samtools", "fastq", "-n", "-"],
+                    [
+                        "bwa", "mem", "-5SP", "-p", "-t", str(threads),
+                        "-R", read_group, str(reference), "-",
+                    ],
+                    align_tail[0],
+                    [*align_tail[1], str(realigned), "-"],
+                ],
+                realigned,
+            )
+            runner.run(["samtools", "cat", "-o", str(updated), str(keep), str(realigned)])
+            if not runner.dry_run:
+                updated.replace(bam)
+                write_contig_md5(manifest, contigs)
+                for path in (header, keep, realigned):
+                    path.unlink(missing_ok=True)
+            return True
+
+    lane_done.unlink(missing_ok=True)
+    bam.unlink(missing_ok=True)
+    runner.pipe(
+        [
+            [
+                "bwa", "mem", "-5SP", "-t", str(threads), "-R", read_group,
+                str(reference), str(pair.r1), str(pair.r2),
+            ],
+            align_tail[0],
+            [*align_tail[1], str(bam), "-"],
+        ],
+        bam,
+    )
+    if not runner.dry_run:
+        write_contig_md5(manifest, contigs)
+        lane_done.write_text("complete\n", encoding="utf-8")
+    return True
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="交互式 Hi-C + YaHS 挂载流程")
     parser.add_argument("--search-dir", type=Path, default=Path.cwd(), help="FASTQ 搜索目录")
@@ -232,6 +408,14 @@ def main() -> None:
     )
     parser.add_argument("--motif", help="限制酶基序，如 GATC；未知或 Omni-C 时不填")
     parser.add_argument("--skip-fastqc", action="store_true")
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="lane 并行比对并经 samblaster 流式生成分片，跳过排序/合并/Picard，并在组装小改后复用分片",
+    )
+    parser.add_argument(
+        "--lane-jobs", type=int,
+        help="--stream 模式下同时比对的 lane 数（默认按线程数自动设置）",
+    )
     parser.add_argument("--dry-run", action="store_true", help="只显示命令，不运行")
     args = parser.parse_args()
 
@@ -256,6 +440,8 @@ def main() -> None:
     outdir = outdir.expanduser().resolve()
     if args.threads < 1:
         raise SystemExit("线程数必须大于 0")
+    if args.lane_jobs is not None and args.lane_jobs < 1:
+        raise SystemExit("--lane-jobs 必须大于 0")
     if sys.stdin.isatty() and "--threads" not in sys.argv:
         value = input(f"线程数 [默认 {args.threads}]: ").strip()
         if value:
@@ -276,7 +462,11 @@ def main() -> None:
     if motif is None and sys.stdin.isatty():
         motif = input("限制酶基序 [如 GATC；未知/Omni-C 留空]: ").strip() or None
 
-    require_tools(["bwa", "samtools", "yahs", "picard"] + ([] if args.skip_fastqc else ["fastqc", "multiqc"]))
+    require_tools(
+        ["bwa", "samtools", "yahs"]
+        + (["samblaster"] if args.stream else ["picard"])
+        + ([] if args.skip_fastqc else ["fastqc", "multiqc"])
+    )
     for directory in (
         outdir, outdir / "reference", outdir / "qc", outdir / "bam",
         outdir / "yahs", outdir / "tmp",
@@ -286,7 +476,10 @@ def main() -> None:
     runner = Runner(log_path, args.dry_run)
 
     reference = outdir / "reference" / "assembly.fa"
-    prepare_reference(fasta, reference)
+    if args.stream:
+        refresh_reference(fasta, reference)
+    else:
+        prepare_reference(fasta, reference)
     print("\n分析配置：")
     print(f"  FASTQ 配对数: {len(selected)}")
     print(f"  FASTA:        {fasta}")
@@ -294,6 +487,7 @@ def main() -> None:
     print(f"  线程数:       {args.threads}")
     print(f"  Picard 堆内存:{args.java_memory}")
     print(f"  酶切基序:     {motif or '未指定'}")
+    print(f"  比对模式:     {'流式分片（samblaster）' if args.stream else '排序 BAM + Picard'}")
     if sys.stdin.isatty() and input("开始运行？[Y/n]: ").strip().lower() in {"n", "no"}:
         raise SystemExit("已取消。")
 
@@ -310,6 +504,62 @@ def main() -> None:
             if not args.dry_run:
                 qc_flag.write_text("complete\n", encoding="utf-8")
 
+    if args.stream:
+        dict_path = reference.with_suffix(".dict")
+        if not ready(dict_path):
+            runner.run(["samtools", "dict", str(reference)], dict_path)
+        contigs = read_contig_md5(dict_path)
+        shard_dir = outdir / "shards"
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        lane_jobs = args.lane_jobs or max(1, min(len(selected), args.threads // 8))
+        lane_threads = max(1, args.threads // lane_jobs)
+        labels = [f"{i:02d}_{safe_label(pair.label, i)}" for i, pair in enumerate(selected, 1)]
+        with ThreadPoolExecutor(max_workers=lane_jobs) as pool:
+            rebuilt = list(pool.map(
+                lambda item: stream_lane(
+                    runner, item[0], item[1], reference, contigs, shard_dir, lane_threads
+                ),
+                zip(selected, labels),
+            ))
+        alignments = outdir / "bam" / "hic.stream.bam"
+        prefix = outdir / "yahs" / "hic"
+        if any(rebuilt) or not ready(alignments):
+            alignments.unlink(missing_ok=True)
+            shards = [shard_dir / f"{label}.bam" for label in labels]
+            if len(shards) == 1:
+                if not args.dry_run:
+                    shutil.copy2(shards[0], alignments)
+            else:
+                runner.run(["samtools", "cat", "-o", str(alignments)] + [str(p) for p in shards])
+            for stale in prefix.parent.glob(f"{prefix.name}_scaffolds_final.*"):
+                stale.unlink()
+        runner.run(["samtools", "flagstat", "-@", str(args.threads), str(alignments)], outdir / "bam" / "hic.stream.flagstat.txt")
+    else:
+        alignments = align_sorted(runner, args, selected, reference, outdir)
+
+    prefix = outdir / "yahs" / "hic"
+    final_fasta = Path(str(prefix) + "_scaffolds_final.fa")
+    if not ready(final_fasta):
+        command = ["yahs", str(reference), str(alignments), "-o", str(prefix)]
+        if motif:
+            command.extend(["-e", motif])
+        runner.run(command)
+
+    print("\n流程完成。")
+    print(f"最终 FASTA: {final_fasta}")
+    print(f"最终 AGP:   {prefix}_scaffolds_final.agp")
+    print(f"运行日志:   {log_path}")
+    print(f"质控报告:   {outdir / 'qc' / 'multiqc_report.html'}")
+
+
+def align_sorted(
+    runner: Runner,
+    args: argparse.Namespace,
+    selected: list[ReadPair],
+    reference: Path,
+    outdir: Path,
+) -> Path:
+    """Classic path: sorted lane BAMs -> samtools merge -> Picard MarkDuplicates."""
     lane_bams: list[Path] = []
     for i, pair in enumerate(selected, 1):
         label = f"{i:02d}_{safe_label(pair.label, i)}"
@@ -358,20 +608,7 @@ def main() -> None:
     if not ready(Path(str(dedup) + ".bai")) and not ready(dedup.with_suffix(".bai")):
         runner.run(["samtools", "index", "-@", str(args.threads), str(dedup)])
     runner.run(["samtools", "flagstat", "-@", str(args.threads), str(dedup)], outdir / "bam" / "hic.dedup.flagstat.txt")
-
-    prefix = outdir / "yahs" / "hic"
-    final_fasta = Path(str(prefix) + "_scaffolds_final.fa")
-    if not ready(final_fasta):
-        command = ["yahs", str(reference), str(dedup), "-o", str(prefix)]
-        if motif:
-            command.extend(["-e", motif])
-        runner.run(command)
-
-    print("\n流程完成。")
-    print(f"最终 FASTA: {final_fasta}")
-    print(f"最终 AGP:   {prefix}_scaffolds_final.agp")
-    print(f"运行日志:   {log_path}")
-    print(f"质控报告:   {outdir / 'qc' / 'multiqc_report.html'}")
+    return dedup
 
 
 if __name__ == "__main__":
@@ -3,8 +3,14 @@
 
 import os
 import sys
+import csv
+import json
 import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # 只保存文件，不弹窗口；多进程绘图也不依赖图形界面
 import matplotlib.pyplot as plt
 
 # ============= 图表字体设置 (支持中文) =============
@@ -81,67 +87,339 @@ def make_sure(selected_paths):
     return response in ['y', 'yes']
 
 # ============= 解析与绘图核心 =============
-def plot_kraken_report(report_path):
-    data = []
-    unclassified_pct = 0
-    with open(report_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            parts = line.strip('\n').split('\t')
-            if len(parts) < 6:
-                continue
-            
-            # 关键修复：加入 .strip() 清除 Kraken2 排版用的空格
-            pct = float(parts[0].strip())
-            rank = parts[3].strip() 
-            name = parts[5].strip() 
-            
-            if rank == 'U':
-                unclassified_pct = pct
-            elif rank.startswith('S'): 
-                data.append((name, pct))
-    
-    if not data:
-        print(f"⚠️ {os.path.basename(report_path)} 中未找到物种级别(S)的数据，跳过绘制。")
-        return
+OUTPUT_FORMATS = {'png': '位图 PNG (300 dpi)', 'svg': '矢量 SVG', 'pdf': '矢量 PDF'}
+_FIGURE = None
 
-    # 转换为 DataFrame 并提取 Top 10
-    df = pd.DataFrame(data, columns=['Species', 'Percentage'])
+
+def parse_species(report_path):
+    """按列读取报告，返回 (Top 10 物种 DataFrame, 未分类比例)；没有种级别数据时 DataFrame 为空。"""
+    table = pd.read_csv(report_path, sep='\t', header=None, quoting=csv.QUOTE_NONE,
+                        keep_default_na=False, dtype=str)
+    if table.shape[1] < 6:
+        return pd.DataFrame(columns=['Species', 'Percentage']), 0
+    # 关键修复：加入 .strip() 清除 Kraken2 排版用的空格
+    pct = table.iloc[:, 0].str.strip().astype(float)
+    rank = table.iloc[:, -3].str.strip()
+    name = table.iloc[:, -1].str.strip()
+    unclassified = pct[rank == 'U']
+    unclassified_pct = float(unclassified.iloc[-1]) if len(unclassified) else 0
     # 由于存在同种下的亚种 (比如 S 和 S1)，可能出现重复名字或父子包含，这里直接按丰度排
-    df = df.sort_values(by='Percentage', ascending=False).head(10)
-    df = df.sort_values(by='Percentage', ascending=True) 
+    species = rank.str.startswith('S')
+    df = pd.DataFrame({'Species': name[species], 'Percentage': pct[species]})
+    df = df.sort_values(by='Percentage', ascending=False, kind='stable').head(10)
+    return df.sort_values(by='Percentage', ascending=True, kind='stable'), unclassified_pct
+
+
+def figure_template():
+    """每个进程只创建一次 Figure，之后每个样本清空坐标轴重画，省去反复创建窗口和字体布局的开销。"""
+    global _FIGURE
+    if _FIGURE is None:
+        _FIGURE = plt.figure(figsize=(10, 6))
+        _FIGURE.add_subplot(1, 1, 1)
+    return _FIGURE
+
+
+def plot_kraken_report(report_path, fmt='png'):
+    df, unclassified_pct = parse_species(report_path)
+    if df.empty:
+        return f"⚠️ {os.path.basename(report_path)} 中未找到物种级别(S)的数据，跳过绘制。"
+
+    fig = figure_template()
+    ax = fig.axes[0]
+    ax.clear()
 
     # 绘制条形图
-    plt.figure(figsize=(10, 6))
-    bars = plt.barh(df['Species'], df['Percentage'], color='#4C72B0', edgecolor='black')
+    bars = ax.barh(df['Species'], df['Percentage'], color='#4C72B0', edgecolor='black')
     
     # 添加数据标签
     for bar in bars:
         width = bar.get_width()
-        plt.text(width + 0.3, bar.get_y() + bar.get_height()/2, 
-                 f'{width:.2f}%', va='center', fontsize=10)
+        ax.text(width + 0.3, bar.get_y() + bar.get_height()/2, 
+                f'{width:.2f}%', va='center', fontsize=10)
 
     # 图表美化
-    sample_name = os.path.basename(report_path).replace('_report.txt', '').replace('.txt', '')
-    plt.title(f'物种丰度分析 - 样本: {sample_name}', fontsize=14, pad=20)
-    plt.xlabel('相对丰度 (%)', fontsize=12)
-    plt.ylabel('物种名称', fontsize=12)
+    sample_name = sample_name_of(report_path)
+    ax.set_title(f'物种丰度分析 - 样本: {sample_name}', fontsize=14, pad=20)
+    ax.set_xlabel('相对丰度 (%)', fontsize=12)
+    ax.set_ylabel('物种名称', fontsize=12)
     
     # 动态调整 X 轴，防止标签超出边界
     max_pct = max(df['Percentage']) if not df.empty else 0
-    plt.xlim(0, max_pct * 1.25) 
+    ax.set_xlim(0, max_pct * 1.25) 
     
     # 在右上角标注未分类比例
-    plt.text(0.95, 0.05, f'Unclassified: {unclassified_pct:.2f}%', 
-             transform=plt.gca().transAxes, ha='right', va='bottom',
-             bbox=dict(boxstyle='round,pad=0.5', facecolor='lightyellow', alpha=0.8))
+    ax.text(0.95, 0.05, f'Unclassified: {unclassified_pct:.2f}%', 
+            transform=ax.transAxes, ha='right', va='bottom',
+            bbox=dict(boxstyle='round,pad=0.5', facecolor='lightyellow', alpha=0.8))
     
-    plt.tight_layout()
+    fig.tight_layout()
     
-    # 保存图片
-    out_name = os.path.join(os.path.dirname(report_path), f"{sample_name}_abundance_barplot.png")
-    plt.savefig(out_name, dpi=300)
-    plt.close()
-    print(f"✅ 生成可视化结果: {os.path.basename(out_name)}")
+    # 保存图片（矢量格式忽略 dpi）
+    out_name = os.path.join(os.path.dirname(report_path), f"{sample_name}_abundance_barplot.{fmt}")
+    fig.savefig(out_name, dpi=300, format=fmt)
+    return f"✅ 生成可视化结果: {os.path.basename(out_name)}"
+
+
+def plot_reports(reports, fmt='png', jobs=None):
+    """多进程批量绘图；每个进程复用自己的 Figure 模板，完成一个打印一个。"""
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(reports)))
+    if jobs == 1:
+        for report in reports:
+            print(plot_kraken_report(report, fmt))
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for message in pool.map(plot_kraken_report, reports, [fmt] * len(reports), chunksize=4):
+            print(message)
+
+
+def choose_format():
+    print("\n输出格式：")
+    for i, (fmt, label) in enumerate(OUTPUT_FORMATS.items(), start=1):
+        print(f"  [{i}] {label}")
+    formats = list(OUTPUT_FORMATS)
+    while True:
+        choice = input("👉 请选择 (默认 1): ").strip() or '1'
+        if choice.isdigit() and 1 <= int(choice) <= len(formats):
+            return formats[int(choice) - 1]
+        print("输入错误：请输入列表中的编号。")
+
+# ============= 多样本丰度矩阵 =============
+RANK_LABELS = {
+    'S': '种 (species)',
+    'G': '属 (genus)',
+    'F': '科 (family)',
+    'O': '目 (order)',
+    'C': '纲 (class)',
+    'P': '门 (phylum)',
+    'D': '域 (domain)',
+}
+LINEAGE_RANKS = [('superkingdom', 'domain'), ('phylum',), ('class',), ('order',), ('family',), ('genus',)]
+TAXONOMY_MAGIC = b"KRAKEN2-TAXONOMY-INDEX 1\n"
+
+
+def sample_name_of(report_path):
+    return os.path.basename(report_path).replace('_report.txt', '').replace('.txt', '')
+
+
+def parse_report_at_rank(report_path, rank):
+    """
+    按列读取一个 Kraken2 报告，返回 (taxid, 名称, clade reads) 三列数组与样本总 reads 数。
+    只保留等级代码恰好为 rank 的行（S 不含 S1 等亚等级）；clade reads 已包含其下所有分类单元。
+    兼容 --report-minimizer-data 多出的两列：等级、TaxID、名称总是最后三列。
+    """
+    table = pd.read_csv(report_path, sep='\t', header=None, quoting=csv.QUOTE_NONE,
+                        keep_default_na=False, dtype=str)
+    reads = table.iloc[:, 1].astype(np.int64).to_numpy()
+    ranks = table.iloc[:, -3].str.strip().to_numpy()
+    total = int(reads[(ranks == 'U') | (ranks == 'R')].sum()) or int(reads.max(initial=0))
+    keep = ranks == rank
+    taxids = table.iloc[:, -2].astype(np.int64).to_numpy()[keep]
+    names = table.iloc[:, -1].str.strip().to_numpy()[keep]
+    return taxids, names, reads[keep], total
+
+
+def build_abundance_matrix(reports, rank, jobs):
+    """
+    多进程并行解析全部报告，拼成稀疏的 taxon × sample 矩阵（COO 三列：行、列、reads）。
+    返回 dict：taxids、names、samples、rows、cols、reads、totals。
+    """
+    with ProcessPoolExecutor(max_workers=max(1, min(jobs, len(reports)))) as pool:
+        parsed = list(pool.map(parse_report_at_rank, reports, [rank] * len(reports), chunksize=4))
+
+    samples = [sample_name_of(path) for path in reports]
+    if len(set(samples)) < len(samples):
+        # 不同结果目录中的同名样本用上级目录名区分
+        samples = [f"{os.path.basename(os.path.dirname(path))}/{name}" for path, name in zip(reports, samples)]
+
+    all_taxids = np.concatenate([item[0] for item in parsed])
+    all_names = np.concatenate([item[1] for item in parsed])
+    taxids, first, rows = np.unique(all_taxids, return_index=True, return_inverse=True)
+    cols = np.repeat(np.arange(len(reports)), [len(item[0]) for item in parsed])
+    return {
+        'taxids': taxids,
+        'names': all_names[first].astype(str),
+        'samples': np.array(samples),
+        'rows': rows.astype(np.int64),
+        'cols': cols,
+        'reads': np.concatenate([item[2] for item in parsed]),
+        'totals': np.array([item[3] for item in parsed], dtype=np.int64),
+    }
+
+
+def load_taxonomy_index(index_path):
+    """
+    用 NumPy 直接映射 Kraken_2.py 生成的 taxonomy_index.bin，不把整个文件读入内存。
+    布局：魔数行、JSON 头、int32 父节点、uint8 等级、uint32 学名偏移、学名区（见 Kraken_2.py 中 TaxonomyIndex）。
+    """
+    raw = np.memmap(index_path, dtype=np.uint8, mode='r')
+    if bytes(raw[:len(TAXONOMY_MAGIC)]) != TAXONOMY_MAGIC:
+        raise ValueError(f"不是 taxonomy 索引文件：{index_path}")
+    start = len(TAXONOMY_MAGIC)
+    header_end = start + int(np.flatnonzero(raw[start:start + (1 << 20)] == ord('\n'))[0]) + 1
+    header = json.loads(bytes(raw[start:header_end]))
+    size = header['size']
+    position = header_end
+    parents = raw[position:position + 4 * size].view('<i4')
+    position += 4 * size
+    ranks = raw[position:position + size]
+    position += size + (-(position + size) % 8)
+    offsets = raw[position:position + 4 * (size + 1)].view('<u4')
+    position += 4 * (size + 1)
+    return {'size': size, 'rank_names': header['ranks'], 'parents': parents, 'ranks': ranks,
+            'offsets': offsets, 'names': raw[position:]}
+
+
+def find_taxonomy_index(db_dir):
+    """数据库目录中没有索引时，借用同目录下的 Kraken_2.py 现场生成。"""
+    taxonomy_dir = os.path.join(db_dir, 'taxonomy')
+    index_path = os.path.join(taxonomy_dir, 'taxonomy_index.bin')
+    if os.path.exists(index_path):
+        return index_path
+    if not os.path.exists(os.path.join(taxonomy_dir, 'nodes.dmp')):
+        print(f"⚠️ {taxonomy_dir} 中没有 nodes.dmp，跳过谱系注释。")
+        return None
+    try:
+        sys.path.insert(0, get_base_dir())
+        from Kraken_2 import TaxonomyIndex
+    except ImportError:
+        print("⚠️ 未找到 taxonomy 索引，且同目录下没有 Kraken_2.py 可用来生成，跳过谱系注释。")
+        return None
+    from pathlib import Path
+    TaxonomyIndex.load(Path(taxonomy_dir))
+    return index_path
+
+
+def lineage_table(index, taxids):
+    """沿父节点数组向上逐层查找，一次得到所有 taxid 在各主要等级上的学名。"""
+    codes = {}
+    for aliases in LINEAGE_RANKS:
+        for rank in aliases:
+            if rank in index['rank_names']:
+                codes[aliases[0]] = index['rank_names'].index(rank)
+                break
+    found = {rank: np.full(len(taxids), -1, dtype=np.int64) for rank in codes}
+    current = np.where((taxids > 0) & (taxids < index['size']), taxids, 1).astype(np.int64)
+    for _ in range(128):
+        current_ranks = index['ranks'][current]
+        for rank, code in codes.items():
+            hit = (current_ranks == code) & (found[rank] < 0)
+            found[rank][hit] = current[hit]
+        parents = index['parents'][current].astype(np.int64)
+        parents[parents < 0] = current[parents < 0]
+        if np.array_equal(parents, current):
+            break
+        current = parents
+
+    def name_of(taxid):
+        if taxid < 0:
+            return ''
+        return bytes(index['names'][index['offsets'][taxid]:index['offsets'][taxid + 1]]).decode('utf-8', 'replace')
+
+    return pd.DataFrame({rank: [name_of(t) for t in found[rank]] for rank in codes})
+
+
+def save_abundance_matrix(matrix, rank, out_prefix, index=None):
+    """
+    稀疏矩阵按列存为 .npz（COO 三列 + 行列标签），便于后续用 NumPy/SciPy 直接载入；
+    同时写出一份相对丰度 (%) 的宽表 .tsv 方便用 Excel 查看。
+    """
+    np.savez_compressed(f"{out_prefix}.npz", rank=rank, **matrix)
+
+    percent = 100.0 * matrix['reads'] / matrix['totals'][matrix['cols']]
+    dense = np.zeros((len(matrix['taxids']), len(matrix['samples'])))
+    dense[matrix['rows'], matrix['cols']] = percent
+    table = pd.DataFrame(dense, columns=matrix['samples'])
+    table.insert(0, 'taxid', matrix['taxids'])
+    table.insert(1, 'name', matrix['names'])
+    if index is not None:
+        lineage = lineage_table(index, matrix['taxids'])
+        for position, column in enumerate(lineage.columns, start=2):
+            table.insert(position, column, lineage[column])
+    order = np.argsort(-dense.sum(axis=1), kind='stable')
+    table.iloc[order].to_csv(f"{out_prefix}.tsv", sep='\t', index=False, float_format='%.6g', encoding='utf-8-sig')
+
+
+def plot_abundance_matrix(matrix, rank, out_path, top_n=20, fmt='png'):
+    """一张图上下两部分：Top N 分类单元的堆叠柱状图 + 同一批分类单元的 log10 丰度热图。"""
+    n_samples = len(matrix['samples'])
+    percent = 100.0 * matrix['reads'] / matrix['totals'][matrix['cols']]
+    overall = np.bincount(matrix['rows'], weights=percent, minlength=len(matrix['taxids']))
+    top = np.argsort(-overall, kind='stable')[:top_n]
+    position = np.full(len(matrix['taxids']), -1)
+    position[top] = np.arange(len(top))
+    in_top = position[matrix['rows']] >= 0
+    dense = np.zeros((len(top), n_samples))
+    dense[position[matrix['rows'][in_top]], matrix['cols'][in_top]] = percent[in_top]
+    other = np.bincount(matrix['cols'][~in_top], weights=percent[~in_top], minlength=n_samples)
+    labels = list(matrix['names'][top])
+
+    width = min(max(10, 0.25 * n_samples + 4), 60)
+    fig, (ax_bar, ax_heat) = plt.subplots(
+        2, 1, figsize=(width, 6 + 0.3 * len(top)),
+        gridspec_kw={'height_ratios': [1, max(1, len(top) / 12)]}, constrained_layout=True)
+
+    x = np.arange(n_samples)
+    colors = plt.get_cmap('tab20')(np.linspace(0, 1, 20))
+    bottom = np.zeros(n_samples)
+    for row, label in enumerate(labels):
+        ax_bar.bar(x, dense[row], bottom=bottom, width=0.85, color=colors[row % 20], label=label)
+        bottom += dense[row]
+    ax_bar.bar(x, other, bottom=bottom, width=0.85, color='lightgrey', label='Other')
+    ax_bar.set_xlim(-0.5, n_samples - 0.5)
+    ax_bar.set_ylabel('相对丰度 (%)', fontsize=12)
+    ax_bar.set_title(f'多样本物种组成 - {RANK_LABELS[rank]}（Top {len(top)}）', fontsize=14)
+    ax_bar.set_xticks([])
+    ax_bar.legend(loc='upper left', bbox_to_anchor=(1.01, 1), fontsize=8, frameon=False)
+
+    image = ax_heat.imshow(np.log10(dense + 1e-3), aspect='auto', cmap='viridis', interpolation='nearest')
+    ax_heat.set_yticks(np.arange(len(top)))
+    ax_heat.set_yticklabels(labels, fontsize=8)
+    if n_samples <= 150:
+        ax_heat.set_xticks(x)
+        ax_heat.set_xticklabels(matrix['samples'], rotation=90, fontsize=7)
+    else:
+        ax_heat.set_xticks([])
+        ax_heat.set_xlabel(f'{n_samples} 个样本', fontsize=12)
+    fig.colorbar(image, ax=ax_heat, label='log10(相对丰度 %)', shrink=0.8)
+
+    fig.savefig(out_path, dpi=300, format=fmt)
+    plt.close(fig)
+
+
+def choose_rank():
+    print("\n可选分类等级：")
+    for code, label in RANK_LABELS.items():
+        print(f"  [{code}] {label}")
+    while True:
+        rank = input("👉 请选择汇总的分类等级 (默认 S): ").strip().upper() or 'S'
+        if rank in RANK_LABELS:
+            return rank
+        print("输入错误：请输入上面列出的等级代码。")
+
+
+def run_abundance_matrix(selected_files, fmt='png'):
+    rank = choose_rank()
+    top_n = input("👉 图中展示的分类单元数 (默认 20): ").strip()
+    top_n = int(top_n) if top_n.isdigit() and int(top_n) > 0 else 20
+    db_dir = input("👉 如需在矩阵中附上完整谱系，请输入 Kraken2 数据库目录 (直接回车跳过): ").strip().strip('"')
+    index = None
+    if db_dir:
+        index_path = find_taxonomy_index(os.path.expanduser(db_dir))
+        index = load_taxonomy_index(index_path) if index_path else None
+
+    print(f"\n🚀 正在并行解析 {len(selected_files)} 个报告...")
+    matrix = build_abundance_matrix(selected_files, rank, os.cpu_count() or 1)
+    if not len(matrix['taxids']):
+        print(f"⚠️ 所选报告中没有 {RANK_LABELS[rank]} 级别的数据。")
+        return
+
+    out_dir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in selected_files])
+    out_prefix = os.path.join(out_dir, f"kraken2_abundance_{rank}")
+    save_abundance_matrix(matrix, rank, out_prefix, index)
+    plot_abundance_matrix(matrix, rank, f"{out_prefix}.{fmt}", top_n, fmt)
+    print(f"✅ 丰度矩阵：{len(matrix['taxids'])} 个分类单元 × {len(matrix['samples'])} 个样本")
+    print(f"   {out_prefix}.npz / .tsv / .{fmt}")
+
 
 # ============= 主函数 =============
 def main():
@@ -154,9 +432,17 @@ def main():
     selected_files = choose_file(all_txt, "Kraken2 报告 (.txt)")
     
     if selected_files and make_sure(selected_files):
-        print("\n🚀 开始生成图表...")
-        for report in selected_files:
-            plot_kraken_report(report)
+        print("\n可视化方式：")
+        print("  [1] 每个样本单独绘制 Top 10 物种条形图")
+        print("  [2] 多样本合并为丰度矩阵，绘制堆叠柱状图 + 热图")
+        mode = input("👉 请选择 (默认 1): ").strip() or '1'
+        fmt = choose_format()
+        if mode == '2':
+            run_abundance_matrix(selected_files, fmt)
+            print("\n🎉 多样本丰度矩阵已完成！")
+            return
+        print(f"\n🚀 开始生成图表（{min(len(selected_files), os.cpu_count() or 1)} 个进程并行）...")
+        plot_reports(selected_files, fmt)
         print("\n🎉 所有选中样本的可视化已完成！")
 
 if __name__ == "__main__":
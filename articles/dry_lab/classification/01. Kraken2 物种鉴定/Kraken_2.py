@@ -31,6 +31,9 @@ Kraken2 交互式自建库 + 物种鉴定流水线
 from __future__ import annotations
 
 import gzip
+import hashlib
+import json
+import mmap
 import os
 import re
 import shutil
@@ -38,6 +41,8 @@ import subprocess
 import sys
 import tarfile
 import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 
@@ -59,6 +64,10 @@ QUERY_SUFFIXES = FASTA_SUFFIXES | {
     ".fastq.gz",
 }
 DB_REQUIRED_FILES = ("hash.k2d", "opts.k2d", "taxo.k2d")
+TAXONOMY_INDEX = "taxonomy_index.bin"
+STAGE_BLOCK = 64 * 1024 * 1024
+REWRITE_BLOCK = 16 * 1024 * 1024
+KRAKEN_TAXID = re.compile(rb"kraken:taxid\|\d+")
 
 
 def base_dir() -> Path:
@@ -197,18 +206,149 @@ def ensure_taxdump(taxdump_path: Path, db_dir: Path) -> None:
         raise RuntimeError(f"taxdump 解压后缺少必要文件：{', '.join(missing)}")
 
 
+def file_stamp(path: Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TaxonomyIndex:
+    """
+    由 nodes.dmp / names.dmp 生成的紧凑二进制索引，以 TaxID 为下标直接访问。
+
+    文件布局（小端序）：
+        KRAKEN2-TAXONOMY-INDEX 1\n
+        JSON 头一行（size、ranks、来源文件大小与修改时间），以空格补齐到 8 字节边界
+        parent       int32[size]     父节点 TaxID，不存在的 TaxID 为 -1，根节点指向自身
+        rank         uint8[size]     ranks 表中的下标，0 表示不存在
+        name_offset  uint32[size+1]  学名在 names 区中的起止偏移（先补齐到 8 字节）
+        names        UTF-8 学名依次拼接
+
+    索引以 mmap 打开，查询不需要把整个文件读进内存；nodes.dmp 或 names.dmp
+    变化后会自动重建。下游脚本（如 Kraken 可视化.py）可以直接用 NumPy 读取同一文件。
+    """
+
+    MAGIC = b"KRAKEN2-TAXONOMY-INDEX 1\n"
+
+    def __init__(self, index_path: Path) -> None:
+        with index_path.open("rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[: len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"不是 taxonomy 索引文件：{index_path}")
+        header_end = self._map.find(b"\n", len(self.MAGIC)) + 1
+        self.header = json.loads(self._map[len(self.MAGIC) : header_end])
+        self.size = size = self.header["size"]
+        self.rank_names: list[str] = self.header["ranks"]
+        self.rank_codes = {rank: code for code, rank in enumerate(self.rank_names) if code}
+
+        view = memoryview(self._map)
+        position = header_end
+        self.parents = view[position : position + 4 * size].cast("i")
+        position += 4 * size
+        self.ranks = view[position : position + size]
+        position += size + (-(position + size) % 8)
+        self.name_offsets = view[position : position + 4 * (size + 1)].cast("I")
+        position += 4 * (size + 1)
+        self.names = view[position:]
+
+    @classmethod
+    def load(cls, taxonomy_dir: Path) -> "TaxonomyIndex":
+        """读取数据库 taxonomy 目录旁缓存的索引；不存在或 taxdump 已更新时先重建。"""
+        index_path = taxonomy_dir / TAXONOMY_INDEX
+        sources = {name: file_stamp(taxonomy_dir / name) for name in ("nodes.dmp", "names.dmp")}
+        if index_path.exists():
+            index = cls(index_path)
+            if index.header.get("sources") == sources:
+                return index
+        print(f"正在建立 taxonomy 索引：{index_path}")
+        cls.build(taxonomy_dir, index_path, sources)
+        return cls(index_path)
+
+    @staticmethod
+    def build(taxonomy_dir: Path, index_path: Path, sources: dict[str, list[int]]) -> None:
+        parent_of: dict[int, int] = {}
+        rank_of: dict[int, int] = {}
+        rank_names = [""]
+        rank_codes: dict[bytes, int] = {}
+        with (taxonomy_dir / "nodes.dmp").open("rb") as handle:
+            for line in handle:
+                fields = line.split(b"\t|\t", 3)
+                taxid = int(fields[0])
+                parent_of[taxid] = int(fields[1])
+                code = rank_codes.get(fields[2])
+                if code is None:
+                    code = rank_codes[fields[2]] = len(rank_names)
+                    rank_names.append(fields[2].decode("utf-8", "replace"))
+                rank_of[taxid] = code
+
+        names: dict[int, bytes] = {}
+        with (taxonomy_dir / "names.dmp").open("rb") as handle:
+            for line in handle:
+                fields = line.split(b"\t|\t", 3)
+                if len(fields) == 4 and fields[3].startswith(b"scientific name"):
+                    names[int(fields[0])] = fields[1]
+
+        size = max(parent_of) + 1
+        parents = array("i", [-1]) * size
+        ranks = bytearray(size)
+        for taxid, parent in parent_of.items():
+            parents[taxid] = parent
+            ranks[taxid] = rank_of[taxid]
+        offsets = array("I", [0]) * (size + 1)
+        pieces = []
+        position = 0
+        for taxid in range(size):
+            name = names.get(taxid, b"")
+            pieces.append(name)
+            position += len(name)
+            offsets[taxid + 1] = position
+
+        header = json.dumps({"size": size, "ranks": rank_names, "sources": sources}, ensure_ascii=False).encode()
+        header += b" " * (-(len(TaxonomyIndex.MAGIC) + len(header) + 1) % 8) + b"\n"
+        partial = index_path.with_name(index_path.name + ".part")
+        with partial.open("wb") as out:
+            out.write(TaxonomyIndex.MAGIC + header)
+            out.write(parents.tobytes())
+            out.write(ranks)
+            out.write(b"\0" * (-5 * size % 8))
+            out.write(offsets.tobytes())
+            for name in pieces:
+                out.write(name)
+        partial.replace(index_path)
+
+    def __contains__(self, taxid: int) -> bool:
+        return 0 <= taxid < self.size and self.parents[taxid] >= 0
+
+    def rank(self, taxid: int) -> str:
+        return self.rank_names[self.ranks[taxid]] if taxid in self else ""
+
+    def name(self, taxid: int) -> str:
+        if taxid not in self:
+            return ""
+        return bytes(self.names[self.name_offsets[taxid] : self.name_offsets[taxid + 1]]).decode("utf-8", "replace")
+
+    def lineage(self, taxid: int) -> list[int]:
+        """从 taxid 一直到根节点的 TaxID 列表；TaxID 不存在时返回空列表。"""
+        path: list[int] = []
+        while taxid in self:
+            path.append(taxid)
+            parent = self.parents[taxid]
+            if parent == taxid:
+                break
+            taxid = parent
+        return path
+
+    def ancestor_at(self, taxid: int, rank: str) -> int | None:
+        """把 taxid 归并到指定分类等级（如 genus、family），没有该等级的祖先时返回 None。"""
+        code = self.rank_codes.get(rank)
+        for node in self.lineage(taxid):
+            if self.ranks[node] == code:
+                return node
+        return None
+
+
 def validate_taxids_exist(taxids: set[str], db_dir: Path) -> None:
-    nodes_file = db_dir / "taxonomy" / "nodes.dmp"
-    found: set[str] = set()
-    with nodes_file.open("r", encoding="utf-8", errors="ignore") as handle:
-        for line in handle:
-            taxid = line.split("|", 1)[0].strip()
-            if taxid in taxids:
-                found.add(taxid)
-                if found == taxids:
-                    break
-
-    missing = sorted(taxids - found, key=int)
+    taxonomy = TaxonomyIndex.load(db_dir / "taxonomy")
+    missing = sorted((taxid for taxid in taxids if int(taxid) not in taxonomy), key=int)
     if missing:
         raise ValueError(
             "以下 TaxID 不存在于 taxdump 的 nodes.dmp 中："
@@ -234,28 +374,61 @@ def sanitize_filename(name: str) -> str:
     return name.strip("._-") or "reference"
 
 
-def rewrite_fasta_with_taxid(source: Path, target: Path, taxid: str) -> None:
+def tag_fasta_headers(data: bytes, taxid: bytes) -> bytes:
+    """给一段以整行结尾的 FASTA 字节中的每个 header 写入 kraken:taxid|TaxID，序列行原样保留。"""
+    pieces: list[bytes] = []
+    position = 0
+    header = 0 if data.startswith(b">") else data.find(b"\n>")
+    while header >= 0:
+        if data[header] != ord(">"):
+            header += 1
+        end = data.find(b"\n", header)
+        if end < 0:
+            end = len(data)
+        text = data[header:end]
+        if b"kraken:taxid|" in text:
+            text = KRAKEN_TAXID.sub(b"kraken:taxid|" + taxid, text)
+        else:
+            text += b" kraken:taxid|" + taxid
+        pieces.append(data[position:header])
+        pieces.append(text)
+        position = end
+        header = data.find(b"\n>", end)
+    pieces.append(data[position:])
+    return b"".join(pieces)
+
+
+def rewrite_fasta_with_taxid(source: Path, target: Path, taxid: str) -> Path:
+    """按大块读写改写 header；块在最后一个换行处切开，保证每块都从行首开始。"""
     target.parent.mkdir(parents=True, exist_ok=True)
-    with open_text(source) as inp, target.open("w", encoding="utf-8", newline="\n") as out:
-        for line in inp:
-            if line.startswith(">"):
-                header = line.rstrip("\r\n")
-                if "kraken:taxid|" in header:
-                    header = re.sub(r"kraken:taxid\|\d+", f"kraken:taxid|{taxid}", header)
-                else:
-                    header = f"{header} kraken:taxid|{taxid}"
-                out.write(header + "\n")
-            else:
-                out.write(line)
+    tag = taxid.encode()
+    opener = gzip.open if source.name.lower().endswith(".gz") else open
+    with opener(source, "rb") as inp, target.open("wb") as out:
+        carry = b""
+        while True:
+            block = inp.read(REWRITE_BLOCK)
+            if not block:
+                break
+            data = carry + block
+            cut = data.rfind(b"\n") + 1
+            data, carry = data[:cut], data[cut:]
+            if b"\r" in data:
+                data = data.replace(b"\r\n", b"\n")
+            out.write(tag_fasta_headers(data, tag))
+        if carry.startswith(b">"):
+            out.write(tag_fasta_headers(carry.rstrip(b"\r"), tag) + b"\n")
+        else:
+            out.write(carry)
+    return target
 
 
-def prepare_taxid_fastas(fasta_taxids: dict[Path, str], db_dir: Path) -> list[Path]:
+def prepare_taxid_fastas(fasta_taxids: dict[Path, str], db_dir: Path, jobs: int = 1) -> list[Path]:
     prepared_dir = db_dir / "library_with_taxid"
-    prepared_files: list[Path] = []
+    targets: dict[Path, tuple[Path, str]] = {}
     used_names: set[str] = set()
 
     print_header("生成带 kraken:taxid 的参考 FASTA")
-    for index, (source, taxid) in enumerate(fasta_taxids.items(), start=1):
+    for source, taxid in fasta_taxids.items():
         stem = sanitize_filename(source.name)
         target_name = f"{stem}.taxid_{taxid}.fasta"
         counter = 2
@@ -263,13 +436,18 @@ def prepare_taxid_fastas(fasta_taxids: dict[Path, str], db_dir: Path) -> list[Pa
             target_name = f"{stem}.{counter}.taxid_{taxid}.fasta"
             counter += 1
         used_names.add(target_name)
+        targets[prepared_dir / target_name] = (source, taxid)
 
-        target = prepared_dir / target_name
-        print(f"[{index}/{len(fasta_taxids)}] {source.name} -> {target.name}")
-        rewrite_fasta_with_taxid(source, target, taxid)
-        prepared_files.append(target)
+    with ProcessPoolExecutor(max_workers=max(1, min(jobs, len(targets)))) as pool:
+        futures = {
+            pool.submit(rewrite_fasta_with_taxid, source, target, taxid): source
+            for target, (source, taxid) in targets.items()
+        }
+        for index, future in enumerate(as_completed(futures), start=1):
+            target = future.result()
+            print(f"[{index}/{len(targets)}] {futures[future].name} -> {target.name}")
 
-    return prepared_files
+    return list(targets)
 
 
 def looks_like_accession_map(path: Path) -> bool:
@@ -277,24 +455,77 @@ def looks_like_accession_map(path: Path) -> bool:
     return "accession2taxid" in name
 
 
-def copy_accession_maps(map_paths: list[Path], db_dir: Path) -> None:
+def gunzip_file(source: Path, target: Path) -> None:
+    """有 pigz 时用 pigz -dc 解压（读、解压、写分别在独立线程），否则退回 Python gzip。"""
+    partial = target.with_name(target.name + ".part")
+    with partial.open("wb") as out:
+        if shutil.which("pigz"):
+            subprocess.run(["pigz", "-dc", str(source)], check=True, stdout=out)
+        else:
+            with gzip.open(source, "rb") as inp:
+                shutil.copyfileobj(inp, out, STAGE_BLOCK)
+    partial.replace(target)
+
+
+def copy_accession_maps(map_paths: list[Path], db_dir: Path, jobs: int = 1) -> None:
     taxonomy_dir = db_dir / "taxonomy"
     taxonomy_dir.mkdir(parents=True, exist_ok=True)
 
     print_header("准备 accession2taxid 映射文件")
+    tasks = []
     for source in map_paths:
         if source.name.lower().endswith(".gz"):
             target = taxonomy_dir / source.name[:-3]
             print(f"解压：{source.name} -> {target.name}")
-            with gzip.open(source, "rb") as inp, target.open("wb") as out:
-                shutil.copyfileobj(inp, out)
+            tasks.append((gunzip_file, source, target))
         else:
             target = taxonomy_dir / source.name
             if source.resolve() == target.resolve():
                 print(f"已在 taxonomy 目录中：{source.name}")
                 continue
             print(f"复制：{source.name}")
-            shutil.copy2(source, target)
+            tasks.append((shutil.copy2, source, target))
+
+    if not tasks:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(tasks)))) as pool:
+        for future in [pool.submit(*task) for task in tasks]:
+            future.result()
+
+
+def add_to_library(fasta: Path, db_dir: Path) -> str:
+    """
+    运行一次 kraken2-build --add-to-library，返回其全部输出。
+
+    kraken2-build 每次都把序列和 prelim_map 写到 library/added 下独立的临时文件名，
+    多个进程可以同时向同一数据库添加参考。
+    """
+    cmd = ["kraken2-build", "--add-to-library", str(fasta), "--db", str(db_dir)]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    output = "\n$ " + " ".join(cmd) + "\n" + result.stdout
+    if result.returncode:
+        raise subprocess.CalledProcessError(result.returncode, cmd, output=output)
+    return output
+
+
+def add_fastas_to_library(fastas: list[Path], db_dir: Path, log_file: Path, jobs: int = 1) -> None:
+    print_header("添加参考 FASTA 到 Kraken2 library")
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(fastas)))) as pool, log_file.open(
+        "a", encoding="utf-8"
+    ) as log:
+        futures = {pool.submit(add_to_library, fasta, db_dir): fasta for fasta in fastas}
+        try:
+            for index, future in enumerate(as_completed(futures), start=1):
+                try:
+                    log.write(future.result())
+                except subprocess.CalledProcessError as error:
+                    log.write(error.output)
+                    print(f"错误：添加 {futures[future].name} 失败，详见 {log_file}")
+                    raise
+                print(f"[{index}/{len(fastas)}] {futures[future].name}")
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
 
 
 def run_command(cmd: list[str], log_file: Path | None = None) -> None:
@@ -330,11 +561,11 @@ def build_database(
         if not fasta_taxids:
             raise ValueError("手动 TaxID 模式需要 FASTA 与 TaxID 对应关系。")
         validate_taxids_exist(set(fasta_taxids.values()), db_dir)
-        prepared_fastas = prepare_taxid_fastas(fasta_taxids, db_dir)
+        prepared_fastas = prepare_taxid_fastas(fasta_taxids, db_dir, threads)
     elif build_mode == "accession2taxid":
         if not accession_maps:
             raise ValueError("accession2taxid 模式需要至少一个 accession2taxid 映射文件。")
-        copy_accession_maps(accession_maps, db_dir)
+        copy_accession_maps(accession_maps, db_dir, threads)
         prepared_fastas = fasta_files
     elif build_mode == "header_taxid":
         missing_taxid = [path for path in fasta_files if not fasta_has_kraken_taxid(path)]
@@ -345,13 +576,7 @@ def build_database(
     else:
         raise ValueError(f"未知建库模式：{build_mode}")
 
-    print_header("添加参考 FASTA 到 Kraken2 library")
-    for index, fasta in enumerate(prepared_fastas, start=1):
-        print(f"[{index}/{len(prepared_fastas)}] {fasta.name}")
-        run_command(
-            ["kraken2-build", "--add-to-library", str(fasta), "--db", str(db_dir)],
-            log_file=log_file,
-        )
+    add_fastas_to_library(prepared_fastas, db_dir, log_file, threads)
 
     print_header("构建 Kraken2 数据库")
     run_command(
@@ -506,43 +731,325 @@ def collect_query_samples() -> dict[str, dict[str, Path | None]]:
         print("没有找到完整样本。双端数据需要同时有 R1/R2；单端 fasta/fastq 可直接分析。")
 
 
-def run_kraken2(db_dir: Path, samples: dict[str, dict[str, Path | None]], threads: int) -> Path:
-    timestamp = time.strftime("%Y%m%d_%H%M%S")
-    out_dir = base_dir() / f"03_Kraken2_鉴定结果_{timestamp}"
+def available_memory() -> int | None:
+    """读取 /proc/meminfo 中的 MemAvailable（字节）；非 Linux 返回 None。"""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as handle:
+            for line in handle:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def database_size(db_dir: Path) -> int:
+    return sum((db_dir / name).stat().st_size for name in DB_REQUIRED_FILES)
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 ** 3:.1f} GB"
+
+
+def warm_page_cache(files: list[Path]) -> None:
+    """顺序读一遍文件，让数据库进入系统页缓存，后续 --memory-mapping 直接命中内存。"""
+    for path in files:
+        with path.open("rb", buffering=0) as handle:
+            while handle.read(STAGE_BLOCK):
+                pass
+
+
+def stage_database(db_dir: Path) -> tuple[Path, str, float]:
+    """
+    把数据库只加载一次到共享内存，所有样本都用 --memory-mapping 共享同一份。
+
+    - 上次保留在 /dev/shm 的副本仍是最新的：不做容量检查，直接复用；
+    - 内存与 /dev/shm 都足够：复制 *.k2d 到 /dev/shm（tmpfs）；用不上的过期副本会被删除；
+    - 只有内存足够：预读到系统页缓存，从原目录映射；
+    - 内存不足：不预读，直接从磁盘映射（不会因内存不足失败，但分类会变慢）。
+
+    返回 (实际使用的数据库目录, 模式, 加载耗时秒数)。
+    """
+    size = database_size(db_dir)
+    start = time.perf_counter()
+    files = [db_dir / name for name in DB_REQUIRED_FILES]
+
+    # 先找上次保留的副本：tmpfs 页面不计入 MemAvailable，也占用 /dev/shm 空间，
+    # 若先做容量检查，已加载好的副本反而会被判为“内存不足”而永远无法复用。
+    shm = Path("/dev/shm")
+    digest = hashlib.sha1(str(db_dir).encode()).hexdigest()[:12]
+    staged = shm / f"kraken2_{digest}"
+    fresh = staged.is_dir() and all(
+        (staged / path.name).exists()
+        and (staged / path.name).stat().st_size == path.stat().st_size
+        and (staged / path.name).stat().st_mtime >= path.stat().st_mtime
+        for path in files
+    )
+    if fresh:
+        print(f"复用 /dev/shm 中已加载的数据库：{staged}")
+        return staged, "tmpfs", time.perf_counter() - start
+
+    # 过期的旧副本会被覆盖，其占用的内存和 /dev/shm 空间计入可用额度
+    stale = sum(
+        (staged / name).stat().st_size for name in DB_REQUIRED_FILES if (staged / name).is_file()
+    ) if staged.is_dir() else 0
+    memory = available_memory()
+    if memory is not None:
+        memory += stale
+
+    use_shm = shm.is_dir() and shutil.disk_usage(shm).free + stale >= size * 1.05
+    if staged.is_dir() and (memory is None or memory < size * 1.2 or not use_shm):
+        # 用不上的过期副本不再留在内存里
+        shutil.rmtree(staged, ignore_errors=True)
+        print(f"已删除 /dev/shm 中过期的数据库副本：{staged}")
+
+    if memory is None or memory < size * 1.2:
+        memory_text = format_size(memory) if memory is not None else "未知"
+        print(f"可用内存 {memory_text} 不足以容纳数据库 {format_size(size)} 的 1.2 倍，改为直接从磁盘映射。")
+        return db_dir, "disk", 0.0
+
+    if use_shm:
+        print(f"正在把数据库（{format_size(size)}）加载到共享内存：{staged}")
+        staged.mkdir(exist_ok=True)
+        for path in files:
+            shutil.copyfile(path, staged / path.name)
+        return staged, "tmpfs", time.perf_counter() - start
+
+    print(f"/dev/shm 空间不足，正在把数据库（{format_size(size)}）预读到系统页缓存……")
+    warm_page_cache(files)
+    return db_dir, "page-cache", time.perf_counter() - start
+
+
+def release_database(db_dir: Path, mode: str) -> None:
+    if mode != "tmpfs":
+        return
+    if ask_yes_no(f"是否保留共享内存中的数据库副本 {db_dir} 供下次运行复用", False):
+        print(f"已保留；不再需要时可手动删除：rm -r {db_dir}")
+        return
+    shutil.rmtree(db_dir, ignore_errors=True)
+    print(f"已释放共享内存中的数据库副本：{db_dir}")
+
+
+def compressor_command(threads: int) -> list[str]:
+    """优先使用多线程 pigz，未安装时退回单线程 gzip。"""
+    if shutil.which("pigz"):
+        return ["pigz", "-p", str(threads), "-c"]
+    return ["gzip", "-c"]
+
+
+def filter_classified(source, target, taxids: set[bytes], taxonomy: TaxonomyIndex | None = None) -> int:
+    """
+    只保留 TaxID 在 taxids 中的已分类 reads，返回保留条数。
+    给出 taxonomy 时，TaxID 的下级分类单元也会保留（每个 TaxID 只查一次谱系）。
+
+    逐条结果第 3 列在 --use-names 下形如 "Escherichia coli (taxid 562)"，否则就是 TaxID。
+    """
+    wanted = {int(taxid) for taxid in taxids}
+    decided: dict[bytes, bool] = {}
+    kept = 0
+    for line in source:
+        if not line.startswith(b"C\t"):
+            continue
+        field = line.split(b"\t", 3)[2]
+        if field.endswith(b")"):
+            field = field[field.rfind(b" ") + 1 : -1]
+        keep = decided.get(field)
+        if keep is None:
+            if taxonomy is None:
+                keep = field in taxids
+            else:
+                keep = not wanted.isdisjoint(taxonomy.lineage(int(field)))
+            decided[field] = keep
+        if keep:
+            target.write(line)
+            kept += 1
+    return kept
+
+
+def per_read_file(out_dir: Path, sample_name: str, per_read: str) -> Path | None:
+    if per_read == "gzip":
+        return out_dir / f"{sample_name}_kraken.out.gz"
+    if per_read == "filter":
+        return out_dir / f"{sample_name}_kraken.filtered.out"
+    if per_read == "none":
+        return None
+    return out_dir / f"{sample_name}_kraken.out"
+
+
+def classify_sample(
+    db_dir: Path,
+    sample_name: str,
+    paths: dict[str, Path | None],
+    out_dir: Path,
+    threads: int,
+    memory_mapping: bool,
+    per_read: str = "full",
+    taxon_filter: set[str] | None = None,
+    taxonomy: TaxonomyIndex | None = None,
+) -> float:
+    """
+    运行单个样本；报告与逐条结果先写 .part，成功后再改名，返回分类耗时（秒）。
+
+    per_read 决定逐条结果的去向：full 原样写出，gzip 经 pigz 压缩，
+    filter 只保留 taxon_filter 中 TaxID（给出 taxonomy 时包括其下级）的已分类 reads，none 不输出。
+    """
+    report_file = out_dir / f"{sample_name}_report.txt"
+    output_file = per_read_file(out_dir, sample_name, per_read)
+    log_file = out_dir / f"{sample_name}.log"
+    report_part = report_file.with_name(report_file.name + ".part")
+
+    cmd = [
+        "kraken2",
+        "--db",
+        str(db_dir),
+        "--threads",
+        str(threads),
+        "--use-names",
+        "--report",
+        str(report_part),
+    ]
+    if memory_mapping:
+        cmd.append("--memory-mapping")
+    if output_file is None:
+        # Kraken2 约定 --output - 表示不输出逐条结果
+        cmd.extend(["--output", "-"])
+    if paths["r1"] and paths["r2"]:
+        cmd.extend(["--paired", str(paths["r1"]), str(paths["r2"])])
+    else:
+        cmd.append(str(paths["single"]))
+
+    command_text = "$ " + " ".join(quote_arg(part) for part in cmd)
+    if per_read == "gzip":
+        command_text += " | " + " ".join(compressor_command(threads))
+    if output_file is not None:
+        command_text += f" > {quote_arg(str(output_file))}"
+    print(command_text)
+
+    start = time.perf_counter()
+    with log_file.open("w", encoding="utf-8") as log:
+        if output_file is None:
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=log)
+        else:
+            output_part = output_file.with_name(output_file.name + ".part")
+            with output_part.open("wb") as out:
+                if per_read == "full":
+                    subprocess.run(cmd, check=True, stdout=out, stderr=log)
+                else:
+                    kraken = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log)
+                    if per_read == "gzip":
+                        compressor = subprocess.Popen(compressor_command(threads), stdin=kraken.stdout, stdout=out)
+                        kraken.stdout.close()
+                        if compressor.wait():
+                            kraken.kill()
+                            kraken.wait()
+                            raise subprocess.CalledProcessError(compressor.returncode, compressor.args)
+                    else:
+                        wanted = {taxid.encode() for taxid in taxon_filter or ()}
+                        with kraken.stdout:
+                            kept = filter_classified(kraken.stdout, out, wanted, taxonomy)
+                        log.write(f"\n保留指定 TaxID 的已分类 reads：{kept}\n")
+                    if kraken.wait():
+                        raise subprocess.CalledProcessError(kraken.returncode, cmd)
+            output_part.replace(output_file)
+    report_part.replace(report_file)
+    return time.perf_counter() - start
+
+
+def run_kraken2(
+    db_dir: Path,
+    samples: dict[str, dict[str, Path | None]],
+    threads: int,
+    memory_mapping: bool = False,
+    out_dir: Path | None = None,
+    jobs: int = 1,
+    per_read: str = "full",
+    taxon_filter: set[str] | None = None,
+    taxonomy: TaxonomyIndex | None = None,
+) -> Path:
+    """
+    多个样本同时运行，线程数在同时运行的样本间平分；共享内存模式下各进程映射同一份数据库。
+    结果目录中已有完整 _report.txt 的样本会被跳过，便于中断后续跑。
+    """
+    if out_dir is None:
+        out_dir = base_dir() / f"03_Kraken2_鉴定结果_{time.strftime('%Y%m%d_%H%M%S')}"
     out_dir.mkdir(parents=True, exist_ok=True)
 
     print_header("运行 Kraken2 鉴定")
     print(f"结果目录：{out_dir}")
 
-    for index, (sample_name, paths) in enumerate(samples.items(), start=1):
-        print(f"\n[{index}/{len(samples)}] {sample_name}")
-        report_file = out_dir / f"{sample_name}_report.txt"
-        output_file = out_dir / f"{sample_name}_kraken.out"
-        log_file = out_dir / f"{sample_name}.log"
-
-        cmd = [
-            "kraken2",
-            "--db",
-            str(db_dir),
-            "--threads",
-            str(threads),
-            "--use-names",
-            "--report",
-            str(report_file),
-        ]
-        if paths["r1"] and paths["r2"]:
-            cmd.extend(["--paired", str(paths["r1"]), str(paths["r2"])])
-        else:
-            cmd.append(str(paths["single"]))
-
-        print("$ " + " ".join(quote_arg(part) for part in cmd) + f" > {quote_arg(str(output_file))}")
-        with output_file.open("w", encoding="utf-8") as out, log_file.open("w", encoding="utf-8") as log:
-            subprocess.run(cmd, check=True, stdout=out, stderr=log)
-        print(f"完成：{report_file.name}")
+    pending = {
+        name: paths
+        for name, paths in samples.items()
+        if not (out_dir / f"{name}_report.txt").exists()
+    }
+    skipped = len(samples) - len(pending)
+    if skipped:
+        print(f"跳过已有完整报告的样本：{skipped} 个")
+    if not pending:
+        return out_dir
+
+    jobs = max(1, min(jobs, len(pending)))
+    job_threads = max(1, threads // jobs)
+    print(f"待运行样本 {len(pending)} 个：同时运行 {jobs} 个，每个 {job_threads} 线程")
+
+    timing_file = out_dir / "timing.tsv"
+    if not timing_file.exists():
+        timing_file.write_text("sample\tclassify_seconds\n", encoding="utf-8")
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                classify_sample,
+                db_dir,
+                name,
+                paths,
+                out_dir,
+                job_threads,
+                memory_mapping,
+                per_read,
+                taxon_filter,
+                taxonomy,
+            ): name
+            for name, paths in pending.items()
+        }
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                name = futures[future]
+                elapsed = future.result()
+                with timing_file.open("a", encoding="utf-8") as handle:
+                    handle.write(f"{name}\t{elapsed:.1f}\n")
+                print(f"[{done}/{len(pending)}] 完成：{name}_report.txt（分类耗时 {elapsed:.1f} 秒）")
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
 
     return out_dir
 
 
+def collect_per_read_mode() -> tuple[str, set[str] | None]:
+    print_header("选择逐条 read 分类结果的输出方式")
+    print("[1] 完整输出 样本名_kraken.out（未压缩文本，体积常常比输入 FASTQ 还大）")
+    print("[2] 压缩输出 样本名_kraken.out.gz（优先使用多线程 pigz）")
+    print("[3] 只保留指定 TaxID 的已分类 reads，写入 样本名_kraken.filtered.out")
+    print("[4] 不输出逐条结果，只保留 样本名_report.txt")
+
+    choices = {"1": "full", "2": "gzip", "3": "filter", "4": "none"}
+    while True:
+        value = ask("请选择输出方式", "2")
+        if value in choices:
+            break
+        print("请输入 1、2、3 或 4。")
+
+    per_read = choices[value]
+    if per_read != "filter":
+        return per_read, None
+    while True:
+        taxids = set(re.findall(r"\d+", ask("请输入要保留的 TaxID，多个用逗号或空格分隔")))
+        if taxids:
+            return per_read, taxids
+        print("至少需要一个 TaxID，例如 562。")
+
+
 def main() -> None:
     print_header("Kraken2 交互式自建库 + 物种鉴定流水线")
     require_tools()
@@ -575,7 +1082,22 @@ def main() -> None:
         )
 
     samples = collect_query_samples()
-    threads = ask_int("\n请输入鉴定线程数", max(1, os.cpu_count() or 1))
+    threads = ask_int("\n请输入鉴定总线程数", max(1, os.cpu_count() or 1))
+    memory_mapping = ask_yes_no("是否将数据库一次加载到共享内存，供所有样本以 --memory-mapping 复用", True)
+    if memory_mapping:
+        # Kraken2 超过十几个线程后提速有限，默认每个样本约 8 线程
+        default_jobs = max(1, min(len(samples), threads // 8))
+    else:
+        print("提示：未使用共享内存时，每个同时运行的样本都会各自载入一份完整数据库。")
+        default_jobs = 1
+    jobs = ask_int("同时运行的样本数（总线程数在样本间平分）", default_jobs)
+    default_out = str(base_dir() / f"03_Kraken2_鉴定结果_{time.strftime('%Y%m%d_%H%M%S')}")
+    out_dir = Path(os.path.expanduser(ask("请输入结果目录（填写已有目录可跳过已完成样本）", default_out))).resolve()
+    per_read, taxon_filter = collect_per_read_mode()
+    taxonomy = None
+    if taxon_filter and (db_dir / "taxonomy" / "nodes.dmp").exists():
+        if ask_yes_no("是否同时保留这些 TaxID 的下级分类单元（如属下的所有种）", True):
+            taxonomy = TaxonomyIndex.load(db_dir / "taxonomy")
 
     print_header("最终确认")
     print(f"Kraken2 数据库：{db_dir}")
@@ -586,8 +1108,24 @@ def main() -> None:
         print("已取消。")
         return
 
-    out_dir = run_kraken2(db_dir, samples, threads)
+    run_db_dir, stage_mode, load_seconds = db_dir, "", 0.0
+    if memory_mapping:
+        run_db_dir, stage_mode, load_seconds = stage_database(db_dir)
+        print(f"数据库加载方式：{stage_mode}，加载耗时 {load_seconds:.1f} 秒")
+
+    classify_start = time.perf_counter()
+    try:
+        out_dir = run_kraken2(
+            run_db_dir, samples, threads, memory_mapping, out_dir, jobs, per_read, taxon_filter, taxonomy
+        )
+    finally:
+        if memory_mapping:
+            release_database(run_db_dir, stage_mode)
+    classify_seconds = time.perf_counter() - classify_start
     print_header("全部完成")
+    if memory_mapping:
+        print(f"数据库加载耗时：{load_seconds:.1f} 秒（{stage_mode}）")
+    print(f"样本分类总耗时：{classify_seconds:.1f} 秒，逐样本耗时见 timing.tsv")
     print(f"Kraken2 结果目录：{out_dir}")
     print("主要输出：*_report.txt 为分类报告，*_kraken.out 为每条序列的分类结果。")
 
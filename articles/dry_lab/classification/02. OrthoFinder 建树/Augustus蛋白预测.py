@@ -6,7 +6,9 @@ import glob
 import subprocess
 import time
 import re
-from concurrent.futures import ProcessPoolExecutor
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # ============= 基础路径与文件查找 =============
 def get_base_dir():
@@ -52,53 +54,170 @@ def choose_files(files):
         except Exception as e:
             print(f"输入错误: {e}")
 
-# ============= 蛋白提取函数 (独立出来供并行调用) =============
-def extract_proteins(gff_file, faa_file):
-    try:
-        with open(gff_file, 'r') as f, open(faa_file, 'w') as out:
-            current_id = ""
-            is_protein = False
-            for line in f:
-                if line.startswith("# start gene"):
-                    current_id = line.strip().split()[-1]
-                if line.startswith("# protein sequence = ["):
-                    is_protein = True
-                    out.write(f">{current_id}\n")
-                    seq = re.search(r'\[(.*)\]', line)
-                    if seq:
-                        out.write(seq.group(1).replace("\n", "").replace("# ", "") + "\n")
-                    continue
-                if is_protein and line.startswith("# "):
-                    seq_part = line.replace("# ", "").strip()
-                    if "]" in seq_part:
-                        out.write(seq_part.split("]")[0] + "\n")
-                        is_protein = False
-                    else:
-                        out.write(seq_part + "\n")
-    except Exception as e:
-        print(f"提取蛋白序列出错: {e}")
+# ============= 基因组切块 =============
+CHUNK_BP = 5_000_000      # 默认每块约 5 Mb
+OVERLAP_BP = 50_000       # 相邻块重叠，需大于最长基因，保证跨块边界的基因在某一块中完整出现
+LINE_WIDTH = 60
+
+def read_fasta(file_path):
+    """逐条产出 (名称, 序列)；名称取 header 第一个空格前的部分，与 augustus 输出的 seqid 一致。"""
+    name, parts = None, []
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(parts)
+                fields = line[1:].split()
+                name = fields[0] if fields else ''
+                parts = []
+            else:
+                parts.append(line.strip())
+    if name is not None:
+        yield name, ''.join(parts)
+
+def write_chunk(path, pieces):
+    with open(path, 'w') as out:
+        for name, seq in pieces:
+            out.write(f">{name}\n")
+            for i in range(0, len(seq), LINE_WIDTH):
+                out.write(seq[i:i + LINE_WIDTH] + "\n")
+
+def plan_chunks(file_path, chunk_dir, chunk_bp, overlap_bp):
+    """
+    把一个基因组切成若干块 FASTA 写入 chunk_dir，返回 (块列表, contig 顺序)。
+    每块为 (块文件, {contig: (窗口起点偏移, 核心区起点, 核心区终点)})，坐标均为 0-based 半开区间。
+    长 contig 按 chunk_bp 切成核心区，两侧各向外延伸 overlap_bp；短 contig 合并到同一块，整条都是核心区。
+    基因只归属于起点落在核心区内的那一块，重叠区中重复预测的基因因此只保留一次。
+    """
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunks, order = [], {}
+    pending, pending_bp, pending_map = [], 0, {}
+
+    def flush():
+        nonlocal pending, pending_bp, pending_map
+        if pending:
+            path = os.path.join(chunk_dir, f"chunk_{len(chunks) + 1:05d}.fa")
+            write_chunk(path, pending)
+            chunks.append((path, pending_map))
+        pending, pending_bp, pending_map = [], 0, {}
+
+    for name, seq in read_fasta(file_path):
+        order[name] = len(order)
+        length = len(seq)
+        if length <= chunk_bp:
+            if pending_bp + length > chunk_bp:
+                flush()
+            pending.append((name, seq))
+            pending_bp += length
+            pending_map[name] = (0, 0, length)
+            continue
+        flush()
+        for core_start in range(0, length, chunk_bp):
+            core_end = min(core_start + chunk_bp, length)
+            win_start = max(0, core_start - overlap_bp)
+            win_end = min(length, core_end + overlap_bp)
+            pending = [(name, seq[win_start:win_end])]
+            pending_map = {name: (win_start, core_start, core_end)}
+            flush()
+    flush()
+    return chunks, order
+
+# ============= 蛋白流式提取 =============
+def stream_genes(lines):
+    """
+    逐行解析 augustus --gff3=on --protein=on 的输出流，每读完一个基因（# end gene）就产出一次：
+    (contig, 起点, 终点, 链, 蛋白序列, 该基因的全部输出行)。不需要等 augustus 写完整个 GFF。
+    """
+    block, gene, protein, collecting = None, None, [], False
+    for line in lines:
+        if line.startswith("# start gene"):
+            block, gene, protein, collecting = [line], None, [], False
+            continue
+        if block is None:
+            continue
+        block.append(line)
+        if line.startswith("# end gene"):
+            if gene is not None:
+                yield gene + (''.join(protein), block)
+            block = None
+            continue
+        if line.startswith("# protein sequence = ["):
+            collecting = True
+            line = "# " + line[len("# protein sequence = ["):]
+        if collecting and line.startswith("# "):
+            part = line[2:].strip()
+            if "]" in part:
+                protein.append(part.split("]")[0])
+                collecting = False
+            else:
+                protein.append(part)
+        elif not line.startswith("#"):
+            fields = line.split("\t")
+            if len(fields) >= 9 and fields[2] == "gene":
+                gene = (fields[0], int(fields[3]), int(fields[4]), fields[6])
+
+def predict_chunk(task_info):
+    """运行一个块的 augustus，边读输出边提取基因；只返回起点落在核心区内的基因，坐标换算回整条 contig。"""
+    chunk_file, pieces, species = task_info
+    cmd = ["augustus", f"--species={species}", "--gff3=on", "--protein=on", chunk_file]
+    genes = []
+    with tempfile.TemporaryFile('w+') as err:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err, text=True, bufsize=1 << 20)
+        for contig, start, end, strand, protein, block in stream_genes(process.stdout):
+            offset, core_start, core_end = pieces.get(contig, (0, 0, float('inf')))
+            if core_start <= start + offset - 1 < core_end:
+                genes.append((contig, start + offset, end + offset, strand, protein, offset, block))
+        if process.wait() != 0:
+            err.seek(0)
+            raise RuntimeError(err.read()[:100])
+    return genes
 
-# ============= 单个任务的封装 =============
-def worker(task_info):
-    file_path, species, out_dir = task_info
+def shift_block(block, offset, old_id, new_id):
+    """把一个基因的 GFF 行平移到整条 contig 坐标，并把 augustus 块内编号改成全基因组编号。"""
+    rename = re.compile(rf"\b{re.escape(old_id)}\b")
+    lines = []
+    for line in block:
+        if line.startswith("#"):
+            lines.append(rename.sub(new_id, line))
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) >= 9:
+            fields[3] = str(int(fields[3]) + offset)
+            fields[4] = str(int(fields[4]) + offset)
+            fields[8] = rename.sub(new_id, fields[8])
+            line = "\t".join(fields) + "\n"
+        lines.append(line)
+    return lines
+
+def merge_genome(genes, order, gff_out, faa_out):
+    """按 contig 顺序和坐标排序、去掉重复预测，重新编号为 g1..gN，写出合并后的 GFF 与蛋白 FASTA。"""
+    genes = sorted(genes, key=lambda g: (order.get(g[0], len(order)), g[1], g[2], g[3]))
+    seen = set()
+    with open(gff_out, 'w') as gff, open(faa_out, 'w') as faa:
+        gff.write("##gff-version 3\n")
+        number = 0
+        for contig, start, end, strand, protein, offset, block in genes:
+            if (contig, start, end, strand) in seen:
+                continue
+            seen.add((contig, start, end, strand))
+            number += 1
+            old_id = block[0].split()[-1]
+            new_id = f"g{number}"
+            gff.writelines(shift_block(block, offset, old_id, new_id))
+            if protein:
+                faa.write(f">{new_id}\n{protein}\n")
+    return number
+
+# ============= 单个基因组的封装 =============
+def prepare_genome(file_path, out_dir, chunk_bp, overlap_bp):
+    """chunk_bp 为 0 时整个基因组作为一块直接交给 augustus（不写临时文件）。"""
     base_name = os.path.splitext(os.path.basename(file_path))[0]
-    gff_out = os.path.join(out_dir, f"{base_name}.gff")
-    faa_out = os.path.join(out_dir, f"{base_name}.faa")
-    
-    cmd = ["augustus", f"--species={species}", "--gff3=on", "--protein=on", file_path]
-    
-    print(f"开始预测: {base_name} ...")
-    try:
-        with open(gff_out, 'w') as out_f:
-            process = subprocess.run(cmd, stdout=out_f, stderr=subprocess.PIPE, text=True)
-        
-        if process.returncode == 0:
-            extract_proteins(gff_out, faa_out)
-            return f"√ {base_name} 完成"
-        else:
-            return f"× {base_name} 失败: {process.stderr[:100]}"
-    except Exception as e:
-        return f"× {base_name} 崩溃: {str(e)}"
+    if chunk_bp <= 0:
+        order = {name: i for i, (name, _) in enumerate(read_fasta(file_path))}
+        return base_name, [(file_path, {})], order
+    chunk_dir = os.path.join(out_dir, "_chunks", base_name)
+    chunks, order = plan_chunks(file_path, chunk_dir, chunk_bp, overlap_bp)
+    return base_name, chunks, order
 
 # ============= 主程序 =============
 def main():
@@ -114,28 +233,61 @@ def main():
     # 【新增核心数选择】
     max_workers = input("请输入并行任务数: ").strip()
     max_workers = int(max_workers) if max_workers else 4
+
+    # 【切块】大基因组切成带重叠的块并行预测，总耗时取决于最大的块而不是最大的基因组
+    chunk_mb = input(f"请输入切块大小 Mb (0 表示不切块，默认: {CHUNK_BP // 1_000_000}): ").strip()
+    chunk_bp = int(float(chunk_mb) * 1_000_000) if chunk_mb else CHUNK_BP
+    overlap_bp = OVERLAP_BP
+    if chunk_bp > 0:
+        overlap_kb = input(f"请输入相邻块重叠 kb (需大于最长基因，默认: {OVERLAP_BP // 1000}): ").strip()
+        overlap_bp = int(float(overlap_kb) * 1000) if overlap_kb else OVERLAP_BP
     
     out_dir = "_Augustus_Out"
     if not os.path.exists(out_dir): os.makedirs(out_dir)
     
-    # 准备任务列表
-    tasks = [(f, species, out_dir) for f in selected_files]
-    
-    print(f"\n[即将开始] 并行核心数: {max_workers} | 任务总数: {len(tasks)}")
+    print(f"\n[即将开始] 并行核心数: {max_workers} | 基因组数: {len(selected_files)}"
+          + (f" | 切块: {chunk_bp / 1e6:g} Mb，重叠 {overlap_bp / 1000:g} kb" if chunk_bp > 0 else " | 不切块"))
     confirm = input("确认执行? (y/n): ").strip().lower()
     
     if confirm in ['y', 'yes']:
         start_time = time.time()
-        
-        # 使用进程池执行
+
+        genomes = [prepare_genome(f, out_dir, chunk_bp, overlap_bp) for f in selected_files]
+        tasks, owners = [], []
+        for index, (base_name, chunks, _) in enumerate(genomes):
+            print(f"开始预测: {base_name} ({len(chunks)} 块) ...")
+            for chunk_file, pieces in chunks:
+                tasks.append((chunk_file, pieces, species))
+                owners.append(index)
+
+        # 所有基因组的所有块一起进入进程池，大块优先提交以免最后只剩一个大块在跑
+        sizes = [os.path.getsize(task[0]) for task in tasks]
+        genes = [[] for _ in genomes]
+        failed = {}
         with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(worker, tasks))
-        
-        for res in results:
-            print(res)
+            futures = {}
+            for i in sorted(range(len(tasks)), key=lambda i: -sizes[i]):
+                futures[executor.submit(predict_chunk, tasks[i])] = owners[i]
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    genes[index].extend(future.result())
+                except Exception as e:
+                    failed.setdefault(index, str(e))
+
+        for index, (base_name, chunks, order) in enumerate(genomes):
+            if index in failed:
+                print(f"× {base_name} 失败: {failed[index]}")
+                continue
+            gff_out = os.path.join(out_dir, f"{base_name}.gff")
+            faa_out = os.path.join(out_dir, f"{base_name}.faa")
+            number = merge_genome(genes[index], order, gff_out, faa_out)
+            print(f"√ {base_name} 完成 ({number} 个基因)")
+            if chunk_bp > 0:
+                shutil.rmtree(os.path.join(out_dir, "_chunks", base_name), ignore_errors=True)
             
         end_time = time.time()
         print(f"\n全部任务完成！总耗时: {(end_time - start_time)/60:.2f} 分钟。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,18 +2,73 @@
 # -*- coding: utf-8 -*-
 import os
 import glob
-import re
+import string
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+# 纯字母校验用的字节表：删掉所有英文字母后还剩字符，说明这一行含数字、标点等非法字符
+LETTERS = string.ascii_letters.encode()
+# ID 简化用的字节表：字母、数字、点、下划线、短横线以外的字符一律换成下划线
+ID_SAFE = (string.ascii_letters + string.digits + "._-").encode()
+ID_TABLE = bytes(c if c in ID_SAFE else ord("_") for c in range(256))
+
+
+def clean_one(path, out_dir, simplify):
+    """
+    一次读入整个文件（二进制），按 \n、\r\n、\r 分行校验后一次写出。
+    序列行只保留纯字母行；simplify 为 True 时 header 只保留第一个空格前的部分，非法字符替换为下划线，
+    重名自动加后缀，并把新旧 ID 的对应关系写入 <文件名>.id_map.tsv。
+    """
+    file_name = os.path.basename(path)
+    with open(path, 'rb') as fin:
+        lines = fin.read().splitlines()
+
+    out = []
+    id_map = []
+    seen = {}
+    valid_lines_count = 0
+    deleted_lines_count = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue  # 跳过空行
+        if line.startswith(b">"):
+            if simplify:
+                fields = line[1:].split()
+                new_id = fields[0].translate(ID_TABLE) if fields else b"seq"
+                base_id = new_id
+                while new_id in seen:
+                    seen[base_id] += 1
+                    new_id = b"%s_%d" % (base_id, seen[base_id])
+                seen[new_id] = 1
+                id_map.append(new_id + b"\t" + line[1:])
+                line = b">" + new_id
+            out.append(line)
+            valid_lines_count += 1
+        elif not line.translate(None, LETTERS):
+            # 【核心过滤】：纯字母校验。只要这一行包含数字、标点符号就整行删除
+            out.append(line)
+            valid_lines_count += 1
+        else:
+            deleted_lines_count += 1
+
+    with open(os.path.join(out_dir, file_name), 'wb') as fout:
+        fout.write(b"\n".join(out) + b"\n" if out else b"")
+    if simplify:
+        with open(os.path.join(out_dir, f"{file_name}.id_map.tsv"), 'wb') as fmap:
+            fmap.write(b"new_id\toriginal_header\n" + b"".join(entry + b"\n" for entry in id_map))
+    return file_name, valid_lines_count, deleted_lines_count
+
 
 def clean_fasta_strictly():
     print("=== FASTA 序列终极洁癖清洗工具 ===")
-    
+
     # 获取当前目录下所有的 .faa, .pep, .fasta 文件
     extensions = ['*.faa', '*.pep', '*.fasta']
     files = []
     for ext in extensions:
         files.extend(glob.glob(ext))
-        
+
     if not files:
         print("未找到序列文件，请确保脚本放在包含序列的文件夹中。")
         return
@@ -21,40 +76,25 @@ def clean_fasta_strictly():
     out_dir = "Cleaned_faa"
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-        
-    print(f"找到 {len(files)} 个文件，开始执行严格清洗（过滤所有含非法字符的日志行）...\n")
-    
+
+    simplify = input("是否同时简化序列 ID（只保留第一个空格前的部分，并生成新旧 ID 对照表）? (y/n，默认 y): ").strip().lower()
+    simplify = simplify in ['', 'y', 'yes']
+    workers = min(len(files), os.cpu_count() or 1)
+
+    print(f"找到 {len(files)} 个文件，{workers} 个进程并行执行严格清洗（过滤所有含非法字符的日志行）...\n")
+
     start = time.time()
-    
-    for f in files:
-        file_name = os.path.basename(f)
-        out_path = os.path.join(out_dir, file_name)
-        
-        valid_lines_count = 0
-        deleted_lines_count = 0
-        
-        with open(f, 'r', encoding='utf-8') as fin, open(out_path, 'w', encoding='utf-8') as fout:
-            for line in fin:
-                line = line.strip()
-                if not line:
-                    continue  # 跳过空行
-                    
-                if line.startswith(">"):
-                    fout.write(line + "\n")
-                    valid_lines_count += 1
-                else:
-                    # 【核心过滤】：纯字母校验。只要这一行包含数字、标点符号，re.match 就会返回 None
-                    if re.match(r'^[A-Za-z]+$', line):
-                        fout.write(line + "\n")
-                        valid_lines_count += 1
-                    else:
-                        deleted_lines_count += 1
-                        
-        print(f"  √ {file_name} -> 保留了 {valid_lines_count} 行，删除了 {deleted_lines_count} 行垃圾日志")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(clean_one, files, [out_dir] * len(files), [simplify] * len(files))
+        for file_name, valid_lines_count, deleted_lines_count in results:
+            print(f"  √ {file_name} -> 保留了 {valid_lines_count} 行，删除了 {deleted_lines_count} 行垃圾日志")
 
     print("\n" + "="*40)
     print(f"🎉 全部清洗完毕！耗时: {time.time()-start:.2f} 秒。")
     print(f"干净的序列已保存在 '{out_dir}' 文件夹中。")
+    if simplify:
+        print("每个文件的新旧 ID 对照表为同名的 .id_map.tsv。")
 
 if __name__ == "__main__":
-    clean_fasta_strictly()
\ No newline at end of file
+    clean_fasta_strictly()
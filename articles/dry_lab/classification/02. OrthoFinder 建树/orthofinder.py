@@ -46,8 +46,42 @@ def choose_files(files):
             return [files[i] for i in sorted(list(selected_indices))]
         except: print("输入错误。")
 
+def find_working_dirs(path=None):
+    """找出之前运行留下的 WorkingDirectory（其中有物种编号、DIAMOND 库和两两比对结果），新的在前"""
+    if path is None: path = get_base_dir()
+    dirs = glob.glob(os.path.join(path, '**', 'WorkingDirectory'), recursive=True)
+    dirs = [d for d in dirs if os.path.isfile(os.path.join(d, 'SpeciesIDs.txt'))]
+    return sorted(dirs, key=os.path.getmtime, reverse=True)
+
+def choose_working_dir(dirs):
+    if not dirs:
+        print("提示：未找到之前运行留下的 WorkingDirectory。")
+        return None
+    print(f"\n找到 {len(dirs)} 个之前的运行结果:")
+    for i, d in enumerate(dirs, 1):
+        print(f"  [{i}] {os.path.relpath(d, get_base_dir())}  ({len(read_species(d))} 个物种)")
+    while True:
+        user_input = input("请选择要在其基础上添加物种的运行 (默认 1): ").strip() or "1"
+        if user_input.isdigit() and 1 <= int(user_input) <= len(dirs):
+            return dirs[int(user_input) - 1]
+        print("输入错误。")
+
+def read_species(working_dir):
+    """SpeciesIDs.txt 每行形如 '0: Species.faa'，返回已有物种的文件名"""
+    species = set()
+    with open(os.path.join(working_dir, 'SpeciesIDs.txt')) as f:
+        for line in f:
+            if ':' in line:
+                species.add(line.split(':', 1)[1].strip())
+    return species
+
 def prepare_input_dir(selected_files, project_name):
     input_dir = os.path.join(get_base_dir(), f"{project_name}_Input")
+    if os.path.exists(os.path.join(input_dir, 'OrthoFinder')):
+        # 目录里有之前的比对结果，以后增量添加物种还要用，不默认删除
+        choice = input(f"'{os.path.basename(input_dir)}' 中已有 OrthoFinder 结果，是否删除后重跑? (y/n，默认 n): ").strip().lower()
+        if choice not in ['y', 'yes']:
+            input_dir = os.path.join(get_base_dir(), f"{project_name}_Input_{time.strftime('%Y%m%d_%H%M%S')}")
     if os.path.exists(input_dir): shutil.rmtree(input_dir)
     os.makedirs(input_dir)
     
@@ -64,8 +98,12 @@ def prepare_input_dir(selected_files, project_name):
         print(f"  - 已导入: {os.path.basename(f)}")
     return input_dir
 
-def run_orthofinder(input_dir, cpu, use_msa):
-    cmd = ["orthofinder", "-f", input_dir, "-t", str(cpu), "-a", str(cpu)]
+def run_orthofinder(input_dir, cpu, use_msa, previous_dir=None):
+    """previous_dir 为之前运行的 WorkingDirectory 时走增量模式：复用已有比对，只计算新物种相关的比对"""
+    if previous_dir:
+        cmd = ["orthofinder", "-b", previous_dir, "-f", input_dir, "-t", str(cpu), "-a", str(cpu)]
+    else:
+        cmd = ["orthofinder", "-f", input_dir, "-t", str(cpu), "-a", str(cpu)]
     if use_msa: cmd.extend(["-M", "msa"])
     
     print("\n🚀 正在启动 OrthoFinder ...\n" + "="*40)
@@ -83,15 +121,38 @@ def run_orthofinder(input_dir, cpu, use_msa):
 
 def main():
     print("=== OrthoFinder 自动化建树脚本 (修复版) ===")
+    print("  [1] 新建分析")
+    print("  [2] 在之前的结果上增量添加物种 (只计算新物种相关的比对)")
+    mode = input("请选择模式 (默认 1): ").strip() or "1"
+
+    previous_dir = None
+    if mode == "2":
+        previous_dir = choose_working_dir(find_working_dirs())
+        if not previous_dir: return
+        existing = read_species(previous_dir)
+
     all_files = find_protein_files()
     selected_files = choose_files(all_files)
     if not selected_files: return
+
+    if previous_dir:
+        selected_files = [f for f in selected_files if os.path.basename(f) not in existing]
+        if not selected_files:
+            print("所选物种都已在之前的运行中，无需添加。")
+            return
+        print(f"\n已有 {len(existing)} 个物种，本次新增 {len(selected_files)} 个。")
     
     project_name = input("项目名称: ").strip() or "Ortho_Project"
     cpu = input("CPU核心数 (默认 4): ").strip() or "4"
     
+    if previous_dir:
+        project_name = f"{project_name}_Add_{time.strftime('%Y%m%d_%H%M%S')}"
     input_dir = prepare_input_dir(selected_files, project_name)
-    run_orthofinder(input_dir, cpu, True)
+    known_dirs = set(find_working_dirs())
+    run_orthofinder(input_dir, cpu, True, previous_dir)
+    for d in find_working_dirs():
+        if d not in known_dirs:
+            print(f"结果目录: {os.path.relpath(os.path.dirname(d), get_base_dir())}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -15,12 +15,10 @@ def simplify_fasta():
         print("错误：找不到输入文件！")
         return
 
-    # 2. 提取所有原始 ID
-    original_ids = []
+    # 2. 只读一遍文件：整份读入内存，顺带提取所有原始 ID
     with open(input_file, 'r') as f:
-        for line in f:
-            if line.startswith(">"):
-                original_ids.append(line.strip()[1:])
+        lines = f.readlines()
+    original_ids = [line.strip()[1:] for line in lines if line.startswith(">")]
     
     print(f"\n找到 {len(original_ids)} 个物种。现在开始设置简短名：")
     print("提示：输入为空则保留原名，输入 's' 则仅保留 GCA 编号。")
@@ -42,15 +40,13 @@ def simplify_fasta():
         else:
             name_map[old_id] = new_name
             
-    # 4. 执行替换并写出新文件
+    # 4. 在内存中替换并一次写出新文件
     output_file = "Cleaned_Alignment.fa"
-    with open(input_file, 'r') as fin, open(output_file, 'w') as fout:
-        for line in fin:
-            if line.startswith(">"):
-                old_id = line.strip()[1:]
-                fout.write(f">{name_map.get(old_id, old_id)}\n")
-            else:
-                fout.write(line)
+    with open(output_file, 'w') as fout:
+        fout.writelines(
+            f">{name_map.get(line.strip()[1:], line.strip()[1:])}\n" if line.startswith(">") else line
+            for line in lines
+        )
                 
     print(f"\n" + "="*40)
     print(f"🎉 转换完成！新文件已生成: {output_file}")
@@ -6,6 +6,10 @@ Workflow
 paired FASTQ -> BWA-MEM -> pairtools parse/sort -> merge -> dedup/select
              -> cooler (.cool) -> balanced multi-resolution cooler (.mcool)
 
+With ``--dedup-shards N`` the merged pairs are indexed with pairix, split into
+N groups of chromosome pairs, and each group is deduplicated and selected in
+parallel before the shards are streamed into ``cooler cload pairs``.
+
 The script is standalone, does not modify input files, and resumes completed
 steps when the same output directory is reused.
 """
@@ -19,6 +23,7 @@ import shlex
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
@@ -224,6 +229,129 @@ class Runner:
                 raise
 
 
+def read_chromsizes(path: Path) -> dict[str, int]:
+    sizes: dict[str, int] = {}
+    with path.open(encoding="utf-8") as handle:
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2 and fields[1].isdigit():
+                sizes[fields[0]] = int(fields[1])
+    return sizes
+
+
+def plan_shards(
+    chrom_pairs: list[str], sizes: dict[str, int], count: int
+) -> list[list[str]]:
+    """Group pairix chromosome pairs into ``count`` shards of similar weight.
+
+    Cis blocks are weighted by chromosome length and trans blocks by the
+    length product scaled to genome size, which approximates contact counts
+    well enough to keep the slowest shard close to the average.  Each shard
+    keeps the file order so its stream stays sorted for pairtools dedup.
+    """
+    genome = sum(sizes.values()) or 1
+    weighted: list[tuple[float, int, str]] = []
+    for order, chrom_pair in enumerate(chrom_pairs):
+        chrom1, _, chrom2 = chrom_pair.partition("|")
+        size1, size2 = sizes.get(chrom1, 1), sizes.get(chrom2, 1)
+        weight = size1 if chrom1 == chrom2 else size1 * size2 / genome
+        weighted.append((weight, order, chrom_pair))
+    loads = [0.0] * count
+    members: list[list[tuple[int, str]]] = [[] for _ in range(count)]
+    for weight, order, chrom_pair in sorted(weighted, reverse=True):
+        target = loads.index(min(loads))
+        loads[target] += weight
+        members[target].append((order, chrom_pair))
+    return [[pair for _, pair in sorted(group)] for group in members if group]
+
+
+def dedup_shards(
+    runner: Runner,
+    merged: Path,
+    chromsizes: Path,
+    shard_dir: Path,
+    count: int,
+    threads: int,
+    dry_run: bool,
+) -> tuple[list[Path], list[Path], list[Path]]:
+    """Deduplicate and select UU pairs per chromosome-pair shard in parallel.
+
+    Returns the per-shard valid pairs, dedup stats and valid-pair stats.
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    index = Path(str(merged) + ".px2")
+    if not ready(index):
+        runner.run(["pairix", "-f", "-p", "pairs", str(merged)])
+    listing = shard_dir / "chrom_pairs.txt"
+    if not ready(listing):
+        runner.run(["pairix", "-l", str(merged)], stdout_path=listing)
+
+    query_files = [shard_dir / f"shard{number:03d}.queries.txt" for number in range(count)]
+    if not dry_run:
+        chrom_pairs = [
+            line.strip()
+            for line in listing.read_text(encoding="utf-8").splitlines()
+            if line.strip()
+        ]
+        groups = plan_shards(chrom_pairs, read_chromsizes(chromsizes), count)
+        query_files = query_files[: len(groups)]
+        for path, group in zip(query_files, groups):
+            text = "\n".join(group) + "\n"
+            if not path.is_file() or path.read_text(encoding="utf-8") != text:
+                path.write_text(text, encoding="utf-8")
+                stem = path.name.replace(".queries.txt", "")
+                (shard_dir / f".{stem}.complete").unlink(missing_ok=True)
+
+    workers = max(1, min(len(query_files), threads))
+
+    def process(query_file: Path) -> tuple[Path, Path, Path]:
+        stem = query_file.name.replace(".queries.txt", "")
+        valid = shard_dir / f"{stem}.valid.UU.pairs.gz"
+        dedup_stats = shard_dir / f"{stem}.dedup.stats.txt"
+        valid_stats = shard_dir / f"{stem}.valid.stats.txt"
+        shard_done = shard_dir / f".{stem}.complete"
+        if done(shard_done) and ready(valid):
+            return valid, dedup_stats, valid_stats
+        outputs = (
+            valid, dedup_stats, valid_stats,
+            shard_dir / f"{stem}.dups.pairs.gz",
+            shard_dir / f"{stem}.unmapped.pairs.gz",
+        )
+        for path in outputs:
+            path.unlink(missing_ok=True)
+        # pairix -H prints the shared header; xargs keeps the query order of
+        # the listing so the concatenated blocks remain sorted.
+        extract = (
+            f"pairix -H {shlex.quote(str(merged))} && "
+            f"xargs -d '\\n' -a {shlex.quote(str(query_file))} "
+            f"pairix {shlex.quote(str(merged))}"
+        )
+        runner.pipe(
+            [
+                ["sh", "-c", extract],
+                [
+                    "pairtools", "dedup", "--max-mismatch", "3",
+                    "--output-dups", str(outputs[3]),
+                    "--output-unmapped", str(outputs[4]),
+                    "--output-stats", str(dedup_stats),
+                ],
+                [
+                    "pairtools", "select", '(pair_type == "UU")',
+                    "--output", str(valid),
+                ],
+            ],
+            valid,
+        )
+        runner.run(["pairtools", "stats", "--output", str(valid_stats), str(valid)])
+        write_done(shard_done, dry_run)
+        return valid, dedup_stats, valid_stats
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(process, query_files))
+    valids, dedup_stats, valid_stats = (list(column) for column in zip(*results))
+    return valids, dedup_stats, valid_stats
+
+
 def prepare_reference(source: Path, destination: Path) -> None:
     if destination.exists():
         return
@@ -251,6 +379,12 @@ def main() -> None:
         default="10000N",
         help="cooler zoomify 分辨率（默认 10000N）",
     )
+    parser.add_argument(
+        "--dedup-shards",
+        type=int,
+        default=1,
+        help="合并后按染色体对分片并行 dedup/select 的分片数（默认 1，不分片）",
+    )
     parser.add_argument("--assembly-name", default="hic_scaffold")
     parser.add_argument("--skip-fastqc", action="store_true")
     parser.add_argument("--no-balance", action="store_true")
@@ -300,11 +434,12 @@ def main() -> None:
         if value:
             args.bin_size = int(value)
 
-    if args.threads < 1 or args.bin_size < 1 or args.mapq < 0:
-        raise SystemExit("线程数和 bin size 必须大于 0，MAPQ 不能小于 0。")
+    if args.threads < 1 or args.bin_size < 1 or args.mapq < 0 or args.dedup_shards < 1:
+        raise SystemExit("线程数、分片数和 bin size 必须大于 0，MAPQ 不能小于 0。")
     require_tools(
         ["bwa", "samtools", "pairtools", "cooler"]
         + ([] if args.skip_fastqc else ["fastqc", "multiqc"])
+        + (["pairix"] if args.dedup_shards > 1 else [])
     )
 
     directories = {
@@ -330,6 +465,7 @@ def main() -> None:
     print(f"  线程数:         {args.threads}")
     print(f"  最低 MAPQ:      {args.mapq}")
     print(f"  基础分辨率:     {args.bin_size:,} bp")
+    print(f"  dedup 分片数:   {args.dedup_shards}")
     print(f"  多分辨率规则:   {args.zoom_resolutions}")
     if sys.stdin.isatty() and input("开始运行？[Y/n]: ").strip().lower() in {"n", "no"}:
         raise SystemExit("已取消。")
@@ -417,53 +553,83 @@ def main() -> None:
             )
         write_done(merge_done, args.dry_run)
 
-    dedup = directories["pairs"] / "all.dedup.pairs.gz"
-    dups = directories["pairs"] / "all.dups.pairs.gz"
-    unmapped = directories["pairs"] / "all.unmapped.pairs.gz"
-    dedup_stats = directories["pairs"] / "dedup.stats.txt"
-    dedup_done = directories["pairs"] / ".dedup_complete"
-    if not (done(dedup_done) and ready(dedup)):
-        for path in (dedup, dups, unmapped, dedup_stats):
-            path.unlink(missing_ok=True)
-        runner.run(
-            [
-                "pairtools", "dedup", "--max-mismatch", "3",
-                "--output", str(dedup),
-                "--output-dups", str(dups),
-                "--output-unmapped", str(unmapped),
-                "--output-stats", str(dedup_stats),
-                str(merged),
-            ]
-        )
-        write_done(dedup_done, args.dry_run)
-
     valid = directories["pairs"] / "all.valid.UU.pairs.gz"
     valid_stats = directories["pairs"] / "valid.stats.txt"
-    select_done = directories["pairs"] / ".select_complete"
-    if not (done(select_done) and ready(valid)):
-        valid.unlink(missing_ok=True)
-        valid_stats.unlink(missing_ok=True)
-        runner.run(
-            [
-                "pairtools", "select", '(pair_type == "UU")',
-                "--output", str(valid), str(dedup),
-            ]
+    dedup_stats = directories["pairs"] / "dedup.stats.txt"
+    shard_valids: list[Path] = []
+    if args.dedup_shards > 1:
+        shard_dir = directories["pairs"] / f"shards_{args.dedup_shards}"
+        shard_valids, shard_dedup_stats, shard_valid_stats = dedup_shards(
+            runner, merged, chromsizes, shard_dir,
+            args.dedup_shards, args.threads, args.dry_run,
         )
-        runner.run(["pairtools", "stats", "--output", str(valid_stats), str(valid)])
-        write_done(select_done, args.dry_run)
+        stats_done = shard_dir / ".stats_complete"
+        if not (done(stats_done) and ready(valid_stats)):
+            runner.run(
+                ["pairtools", "stats", "--merge", "--output", str(dedup_stats),
+                 *[str(path) for path in shard_dedup_stats]]
+            )
+            runner.run(
+                ["pairtools", "stats", "--merge", "--output", str(valid_stats),
+                 *[str(path) for path in shard_valid_stats]]
+            )
+            write_done(stats_done, args.dry_run)
+    else:
+        dedup = directories["pairs"] / "all.dedup.pairs.gz"
+        dups = directories["pairs"] / "all.dups.pairs.gz"
+        unmapped = directories["pairs"] / "all.unmapped.pairs.gz"
+        dedup_done = directories["pairs"] / ".dedup_complete"
+        if not (done(dedup_done) and ready(dedup)):
+            for path in (dedup, dups, unmapped, dedup_stats):
+                path.unlink(missing_ok=True)
+            runner.run(
+                [
+                    "pairtools", "dedup", "--max-mismatch", "3",
+                    "--output", str(dedup),
+                    "--output-dups", str(dups),
+                    "--output-unmapped", str(unmapped),
+                    "--output-stats", str(dedup_stats),
+                    str(merged),
+                ]
+            )
+            write_done(dedup_done, args.dry_run)
+
+        select_done = directories["pairs"] / ".select_complete"
+        if not (done(select_done) and ready(valid)):
+            valid.unlink(missing_ok=True)
+            valid_stats.unlink(missing_ok=True)
+            runner.run(
+                [
+                    "pairtools", "select", '(pair_type == "UU")',
+                    "--output", str(valid), str(dedup),
+                ]
+            )
+            runner.run(["pairtools", "stats", "--output", str(valid_stats), str(valid)])
+            write_done(select_done, args.dry_run)
 
     base_cool = directories["cool"] / f"contacts.{args.bin_size}.cool"
     cool_done = directories["cool"] / ".cload_complete"
     if not (done(cool_done) and ready(base_cool)):
         base_cool.unlink(missing_ok=True)
-        runner.run(
-            [
-                "cooler", "cload", "pairs",
-                "--assembly", args.assembly_name,
-                "-c1", "2", "-p1", "3", "-c2", "4", "-p2", "5",
-                f"{chromsizes}:{args.bin_size}", str(valid), str(base_cool),
-            ]
-        )
+        cload = [
+            "cooler", "cload", "pairs",
+            "--assembly", args.assembly_name,
+            "-c1", "2", "-p1", "3", "-c2", "4", "-p2", "5",
+            f"{chromsizes}:{args.bin_size}",
+        ]
+        if shard_valids:
+            runner.pipe(
+                [
+                    [
+                        "pairtools", "merge", "--nproc", str(args.threads),
+                        *[str(path) for path in shard_valids],
+                    ],
+                    [*cload, "-", str(base_cool)],
+                ],
+                base_cool,
+            )
+        else:
+            runner.run([*cload, str(valid), str(base_cool)])
         write_done(cool_done, args.dry_run)
 
     if not args.no_balance:
@@ -493,7 +659,10 @@ def main() -> None:
     runner.run(["cooler", "ls", str(mcool)], stdout_path=directories["cool"] / "contacts.resolutions.txt")
 
     print("\n流程完成。")
-    print(f"有效互作 pairs: {valid}")
+    if shard_valids:
+        print(f"有效互作分片:   {shard_dir}（{len(shard_valids)} 个 *.valid.UU.pairs.gz）")
+    else:
+        print(f"有效互作 pairs: {valid}")
     print(f"基础矩阵:       {base_cool}")
     print(f"多分辨率矩阵:   {mcool}")
     print(f"互作统计:       {valid_stats}")
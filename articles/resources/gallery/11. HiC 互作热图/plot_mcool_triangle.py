@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
-"""交互式绘制底边朝下的三角形全基因组 Hi-C 热图。"""
+"""交互式绘制底边朝下的三角形全基因组 Hi-C 热图。
 
+设置 BATCH_BED 后进入批量模式：并行绘制 BED 中的全部区域，并生成索引图。
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -67,9 +74,50 @@ LABEL_MIN_LENGTH = 1_000_000
 #   PNG 等栅格输出的分辨率。SVG/PDF 主体仍为矢量容器。
 DPI = 220
 
-# MAX_BINS
-#   稠密矩阵的安全上限。提高该值前请确认有足够内存。
-MAX_BINS = 15_000
+# OUTPUT_PIXELS
+#   输出热图每条边的最大像素格数。bins 多于该值时，相邻 bins 会被合并
+#   为一个像素格（取平均），因此 10–50 kb 的全基因组图也不会生成
+#   完整稠密矩阵。内存约为 OUTPUT_PIXELS² × 24 字节。
+#   像素格在每条染色体起点对齐，短 scaffold 至少占一格，
+#   因此 scaffold 很多时实际格数可能略高于该值。
+OUTPUT_PIXELS = 3_000
+
+# TILE_PIXELS
+#   每次从 .mcool 读取的稀疏像素记录数上限。调小可进一步降低内存峰值。
+TILE_PIXELS = 5_000_000
+
+# CACHE_DIR
+#   已合并瓦片的缓存目录名，建在 .mcool 所在目录下。瓦片按文件身份
+#   （路径、大小、修改时间）、分辨率、BALANCED 和合并倍数区分；只修改
+#   配色、CLIP_QUANTILE 或换用相邻染色体重绘时无需再读取 .mcool。
+#   设为 None 可关闭缓存；.mcool 更新后旧缓存自动失效，可直接删除。
+CACHE_DIR = ".hic_tile_cache"
+
+# BATCH_BED
+#   None：按上面的设置交互式绘制整条染色体。
+#   设为 BED 文件路径（相对路径以脚本目录为起点，如 "tad_candidates.bed"）
+#   时进入批量模式：每行一个区域（chrom、start、end，可选第 4 列名称），
+#   由进程池并行绘制，每个区域单独保存一张图，并另存一张索引图（contact sheet）。
+#   批量模式忽略 CHROMS；与整图共用稀疏瓦片读取和缓存，区域 bins 超过
+#   OUTPUT_PIXELS 时按 2 的幂合并相邻 bins（取平均）。
+BATCH_BED = None
+
+# BATCH_FLANK
+#   每个区域向两侧额外扩展的长度，单位为 bp，便于观察断点或 TAD 边界附近。
+BATCH_FLANK = 0
+
+# BATCH_WORKERS
+#   批量模式的进程数；None 表示使用全部 CPU 核心。
+BATCH_WORKERS = None
+
+# SHEET_COLUMNS
+#   索引图每行放置的区域数。
+SHEET_COLUMNS = 4
+
+# SHEET_PIXELS
+#   索引图中每个缩略图矩阵的最大边长。工作进程保存单区域图后只把按块平均
+#   缩小到这一尺寸的矩阵交回主进程，区域再多主进程内存也只随缩略图增长。
+SHEET_PIXELS = 256
 
 # 三角热图自身的画布尺寸，单位为英寸。三角形高度约为底边的一半，
 # 因而使用比正方形热图更扁的画布。
@@ -162,6 +210,409 @@ def choose_output(script_dir: Path) -> Path:
         output = script_dir / output
     return output.resolve()
 
+def choose_factor(chrom_bins: np.ndarray) -> int:
+    """选择每个像素格合并的 bins 数（2 的幂），使网格不超过 OUTPUT_PIXELS。
+
+    取 2 的幂便于相邻区域、相近规模的选择复用同一套缓存瓦片。
+    """
+    factor = 1
+    while (
+        factor < chrom_bins.max()
+        and int(np.sum(-(-chrom_bins // factor))) > OUTPUT_PIXELS
+    ):
+        factor *= 2
+    return factor
+
+
+def cache_directory(mcool_path: Path, factor: int) -> Path | None:
+    """以 mcool 的路径、大小、修改时间以及分辨率、归一化和合并倍数定位缓存。"""
+    if CACHE_DIR is None:
+        return None
+    stat = mcool_path.stat()
+    normalization = "balanced" if BALANCED else "raw"
+    identity = (
+        f"{mcool_path}|{stat.st_size}|{stat.st_mtime_ns}|"
+        f"{RESOLUTION}|{normalization}|{factor}"
+    )
+    digest = hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]
+    return (
+        mcool_path.parent / CACHE_DIR
+        / f"{mcool_path.stem}.{RESOLUTION}.{normalization}.x{factor}.{digest}"
+    )
+
+
+def reduce_cells(keys: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    return unique_keys, np.bincount(inverse, weights=values)
+
+
+def symmetric_grid(
+    cell1: np.ndarray, cell2: np.ndarray, values: np.ndarray, grid_size: int
+) -> np.ndarray:
+    """把上三角像素格累加为 grid_size × grid_size 的对称矩阵。"""
+    upper = np.bincount(
+        cell1 * grid_size + cell2, weights=values, minlength=grid_size * grid_size
+    ).reshape(grid_size, grid_size)
+    grid = upper + upper.T
+    diagonal = np.diag_indices(grid_size)
+    grid[diagonal] = upper[diagonal]
+    return grid
+
+
+class TileStore:
+    """按染色体行条带读取并缓存已合并的稀疏互作瓦片。
+
+    每条瓦片记录某条染色体的 bins 与其后（按文件顺序）所有 bins
+    的上三角互作，已经乘上 balance 权重并合并到像素格；像素格在
+    每条染色体起点对齐，因此任意染色体组合都可以直接拼接。
+    """
+
+    def __init__(self, contact: cooler.Cooler, mcool_path: Path, factor: int):
+        self.contact = contact
+        self.factor = factor
+        with contact.open("r") as handle:
+            self.chrom_offsets = handle["indexes/chrom_offset"][:].astype(np.int64)
+            self.bin1_offsets = handle["indexes/bin1_offset"][:]
+        chrom_bins = np.diff(self.chrom_offsets)
+        self.chrom_cells = -(-chrom_bins // factor)
+        self.cell_offsets = np.r_[0, np.cumsum(self.chrom_cells)].astype(np.int64)
+        self.n_cells = int(self.cell_offsets[-1])
+        chrom_of_bin = np.repeat(np.arange(len(chrom_bins)), chrom_bins)
+        self.cell_of_bin = (
+            self.cell_offsets[chrom_of_bin]
+            + (np.arange(len(chrom_of_bin)) - self.chrom_offsets[chrom_of_bin]) // factor
+        )
+        self.directory = cache_directory(mcool_path, factor)
+        self.weights: np.ndarray | None = None
+
+    def balance_weights(self) -> np.ndarray | None:
+        if not BALANCED:
+            return None
+        if self.weights is None:
+            bin_table = self.contact.bins()
+            if "weight" not in bin_table.columns:
+                fail(
+                    "mcool 中没有 weight 列，无法读取 balanced 矩阵。\n"
+                    "可将 BALANCED 改为 False。"
+                )
+            weights = np.array(bin_table["weight"][:], dtype=np.float64)
+            weights[~np.isfinite(weights)] = 0
+            self.weights = weights
+        return self.weights
+
+    def read_cells(
+        self, row: int, row_end: int, bin_end: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """按 bin1_offset 分块读取 [row, row_end) 行的像素，返回 (像素格键, 互作和)。
+
+        给出 bin_end 时只保留 bin2 < bin_end 的像素。
+        """
+        weights = self.balance_weights()
+        pixel_table = self.contact.pixels()
+        key_parts: list[np.ndarray] = []
+        value_parts: list[np.ndarray] = []
+        while row < row_end:
+            lo = int(self.bin1_offsets[row])
+            next_row = int(
+                np.searchsorted(self.bin1_offsets, lo + TILE_PIXELS, side="right")
+            ) - 1
+            next_row = min(max(next_row, row + 1), row_end)
+            hi = int(self.bin1_offsets[next_row])
+            row = next_row
+            if hi <= lo:
+                continue
+            tile = pixel_table[lo:hi]
+            bin1 = tile["bin1_id"].to_numpy()
+            bin2 = tile["bin2_id"].to_numpy()
+            values = tile["count"].to_numpy(dtype=np.float64)
+            if weights is not None:
+                values = values * weights[bin1] * weights[bin2]
+            cell1 = self.cell_of_bin[bin1]
+            cell2 = self.cell_of_bin[bin2]
+            # 同一像素格内的非对角 bins 在完整对称矩阵中出现两次。
+            values = np.where((cell1 == cell2) & (bin1 != bin2), 2 * values, values)
+            keep = values > 0
+            if bin_end is not None:
+                keep &= bin2 < bin_end
+            keys, sums = reduce_cells(
+                cell1[keep] * self.n_cells + cell2[keep], values[keep]
+            )
+            key_parts.append(keys)
+            value_parts.append(sums)
+        if not key_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return reduce_cells(np.concatenate(key_parts), np.concatenate(value_parts))
+
+    def compute_strip(self, chrom_index: int) -> tuple[np.ndarray, np.ndarray]:
+        return self.read_cells(
+            int(self.chrom_offsets[chrom_index]), int(self.chrom_offsets[chrom_index + 1])
+        )
+
+    def strip_path(self, chrom_index: int) -> Path | None:
+        if self.directory is None:
+            return None
+        return self.directory / f"chrom{chrom_index:05d}.npz"
+
+    def strip(self, chrom_index: int) -> tuple[np.ndarray, np.ndarray]:
+        path = self.strip_path(chrom_index)
+        if path is None:
+            return self.compute_strip(chrom_index)
+        if path.is_file():
+            with np.load(path) as cached:
+                return cached["keys"], cached["values"]
+        keys, values = self.compute_strip(chrom_index)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + ".part.npz")
+        np.savez(partial, keys=keys, values=values)
+        partial.replace(path)
+        return keys, values
+
+    def matrix(self, chrom_indices: list[int]) -> np.ndarray:
+        """拼接所选染色体的瓦片，返回每个像素格的平均互作强度。"""
+        compact = np.full(self.n_cells, -1, dtype=np.int64)
+        selected_cells = np.concatenate(
+            [
+                np.arange(self.cell_offsets[index], self.cell_offsets[index + 1])
+                for index in chrom_indices
+            ]
+        )
+        grid_size = len(selected_cells)
+        compact[selected_cells] = np.arange(grid_size)
+        key_parts: list[np.ndarray] = []
+        cell2_parts: list[np.ndarray] = []
+        value_parts: list[np.ndarray] = []
+        for index in chrom_indices:
+            keys, values = self.strip(index)
+            cell1 = compact[keys // self.n_cells]
+            cell2 = compact[keys % self.n_cells]
+            keep = cell2 >= 0
+            key_parts.append(cell1[keep])
+            cell2_parts.append(cell2[keep])
+            value_parts.append(values[keep])
+        grid = symmetric_grid(
+            np.concatenate(key_parts),
+            np.concatenate(cell2_parts),
+            np.concatenate(value_parts),
+            grid_size,
+        )
+
+        bins_per_cell = np.concatenate(
+            [
+                np.minimum(
+                    self.factor,
+                    self.chrom_offsets[index + 1] - self.chrom_offsets[index]
+                    - self.factor * np.arange(self.chrom_cells[index]),
+                )
+                for index in chrom_indices
+            ]
+        ).astype(np.float64)
+        return grid / np.outer(bins_per_cell, bins_per_cell)
+
+    def region(self, chrom_index: int, start: int, end: int) -> tuple[np.ndarray, int, int]:
+        """返回单条染色体上一个区域每个像素格的平均互作强度及对齐后的起止 bin。
+
+        区域两端扩展到像素格边界；该染色体已有缓存瓦片时直接截取，
+        否则只读取区域内的行，并丢弃区域以外的列。
+        """
+        chrom_lo = int(self.chrom_offsets[chrom_index])
+        chrom_hi = int(self.chrom_offsets[chrom_index + 1])
+        first = start // RESOLUTION // self.factor * self.factor
+        last = -(-(-(-end // RESOLUTION)) // self.factor) * self.factor
+        lo = chrom_lo + first
+        hi = max(lo + 1, min(chrom_hi, chrom_lo + last))
+        cell_lo = int(self.cell_of_bin[lo])
+        grid_size = int(self.cell_of_bin[hi - 1]) + 1 - cell_lo
+
+        path = self.strip_path(chrom_index)
+        if path is not None and path.is_file():
+            keys, values = self.strip(chrom_index)
+        else:
+            keys, values = self.read_cells(lo, hi, bin_end=hi)
+        cell1 = keys // self.n_cells - cell_lo
+        cell2 = keys % self.n_cells - cell_lo
+        keep = (cell1 >= 0) & (cell1 < grid_size) & (cell2 >= 0) & (cell2 < grid_size)
+        grid = symmetric_grid(cell1[keep], cell2[keep], values[keep], grid_size)
+
+        bins_per_cell = np.minimum(
+            self.factor, hi - lo - self.factor * np.arange(grid_size)
+        ).astype(np.float64)
+        return grid / np.outer(bins_per_cell, bins_per_cell), lo - chrom_lo, hi - chrom_lo
+
+
+def build_color_map():
+    if CUSTOM_COLORS is None:
+        return COLORMAP
+    if len(CUSTOM_COLORS) < 2:
+        fail("CUSTOM_COLORS 至少需要两种颜色")
+    return LinearSegmentedColormap.from_list("hic_custom", CUSTOM_COLORS, N=256)
+
+
+def read_regions(bed_path: Path, chromsizes) -> list[tuple[str, str, int, int]]:
+    """读取 BED 前三列（可选第 4 列为名称），并按 BATCH_FLANK 向两侧扩展。"""
+    regions: list[tuple[str, str, int, int]] = []
+    with bed_path.open(encoding="utf-8") as handle:
+        for line_number, line in enumerate(handle, 1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3 or not fields[1].isdigit() or not fields[2].isdigit():
+                fail(f"{bed_path} 第 {line_number} 行不是有效的 BED 记录")
+            chrom = fields[0]
+            if chrom not in chromsizes.index:
+                print(f"警告：跳过不在 mcool 中的区域 {chrom}:{fields[1]}-{fields[2]}")
+                continue
+            start = max(0, int(fields[1]) - BATCH_FLANK)
+            end = min(int(chromsizes[chrom]), int(fields[2]) + BATCH_FLANK)
+            if end <= start:
+                continue
+            name = fields[3] if len(fields) > 3 and fields[3] else f"{chrom}_{start}_{end}"
+            regions.append((name, chrom, start, end))
+    return regions
+
+
+_WORKER_CONTACT = None
+_WORKER_MCOOL: Path | None = None
+_WORKER_STORES: dict[int, TileStore] = {}
+
+
+def init_worker(uri: str, mcool_path: Path) -> None:
+    """每个工作进程只打开一次 cooler 句柄，供该进程内的所有区域复用。"""
+    global _WORKER_CONTACT, _WORKER_MCOOL
+    _WORKER_CONTACT = cooler.Cooler(uri)
+    _WORKER_MCOOL = mcool_path
+
+
+def region_matrix(chrom: str, start: int, end: int) -> tuple[np.ndarray, int, int]:
+    """从稀疏瓦片读取单个区域的 log1p 矩阵；bins 超过 OUTPUT_PIXELS 时按 2 的幂合并。"""
+    contact = _WORKER_CONTACT
+    bins = -(-end // RESOLUTION) - start // RESOLUTION
+    factor = choose_factor(np.array([bins]))
+    store = _WORKER_STORES.get(factor)
+    if store is None:
+        store = _WORKER_STORES[factor] = TileStore(contact, _WORKER_MCOOL, factor)
+    chrom_index = contact.chromnames.index(chrom)
+    matrix, lo, hi = store.region(chrom_index, start, end)
+    matrix[~np.isfinite(matrix)] = 0
+    matrix[matrix < 0] = 0
+    bin_start = lo * RESOLUTION
+    bin_end = min(hi * RESOLUTION, int(contact.chromsizes[chrom]))
+    return np.log1p(matrix), bin_start, bin_end
+
+
+def draw_region(axis, matrix: np.ndarray, start: int, end: int, color_map):
+    """在 axis 上以 Mb 为横坐标绘制单个区域的三角热图，返回图像和颜色上限。"""
+    positive = matrix[matrix > 0]
+    color_max = float(np.quantile(positive, CLIP_QUANTILE)) if positive.size else 1.0
+    if not np.isfinite(color_max) or color_max <= 0:
+        color_max = float(positive.max()) if positive.size else 1.0
+    size = len(matrix)
+    triangle_matrix = np.ma.masked_where(
+        np.arange(size)[:, None] > np.arange(size)[None, :], matrix
+    )
+    x0, x1 = start / 1e6, end / 1e6
+    triangle_transform = (
+        Affine2D.from_values(0.5, 0.5, 0.5, -0.5, 0, 0) + axis.transData
+    )
+    image = axis.imshow(
+        triangle_matrix,
+        cmap=color_map,
+        vmin=0,
+        vmax=color_max,
+        origin="lower",
+        extent=(x0, x1, x0, x1),
+        interpolation="none",
+        rasterized=True,
+        transform=triangle_transform,
+    )
+    axis.set_xlim(x0, x1)
+    axis.set_ylim(0, (x1 - x0) / 2)
+    axis.set_aspect("equal")
+    axis.set_yticks([])
+    for side in ("left", "right", "top"):
+        axis.spines[side].set_visible(False)
+    return image
+
+
+def thumbnail(matrix: np.ndarray) -> np.ndarray:
+    """按块平均把矩阵缩小到边长不超过 SHEET_PIXELS，供索引图使用。"""
+    size = len(matrix)
+    step = -(-size // SHEET_PIXELS)
+    if step <= 1:
+        return matrix.astype(np.float32)
+    cells = -(-size // step)
+    padded = np.zeros((cells * step, cells * step))
+    padded[:size, :size] = matrix
+    counts = np.minimum(step, size - step * np.arange(cells)).astype(np.float64)
+    sums = padded.reshape(cells, step, cells, step).sum(axis=(1, 3))
+    return (sums / np.outer(counts, counts)).astype(np.float32)
+
+
+def render_region(task: tuple[str, str, int, int, str]):
+    """工作进程入口：读取区域矩阵并单独保存一张三角热图，返回缩略图矩阵。"""
+    name, chrom, start, end, output = task
+    matrix, bin_start, bin_end = region_matrix(chrom, start, end)
+    figure, axis = plt.subplots(figsize=(8, 4.6))
+    image = draw_region(axis, matrix, bin_start, bin_end, build_color_map())
+    axis.set_xlabel(f"{chrom} (Mb)")
+    axis.set_title(f"{name}  {chrom}:{bin_start:,}-{bin_end:,} ({RESOLUTION:,} bp)", pad=10)
+    figure.colorbar(image, ax=axis, fraction=0.035, pad=0.025, shrink=0.82)
+    figure.tight_layout()
+    figure.savefig(output, dpi=DPI, bbox_inches="tight", facecolor="white")
+    plt.close(figure)
+    return name, chrom, bin_start, bin_end, thumbnail(matrix)
+
+
+def run_batch(script_dir: Path, mcool_path: Path, uri: str, chromsizes) -> None:
+    """批量模式：进程池并行绘制 BED 中的每个区域，并汇总为一张索引图。"""
+    bed_path = Path(BATCH_BED).expanduser()
+    if not bed_path.is_absolute():
+        bed_path = script_dir / bed_path
+    if not bed_path.is_file():
+        fail(f"BATCH_BED 文件不存在：{bed_path}")
+    regions = read_regions(bed_path, chromsizes)
+    if not regions:
+        fail(f"{bed_path} 中没有可绘制的区域")
+    sheet = choose_output(script_dir)
+    region_dir = sheet.with_name(f"{sheet.stem}_regions")
+    region_dir.mkdir(parents=True, exist_ok=True)
+    workers = min(len(regions), BATCH_WORKERS or os.cpu_count() or 1)
+    print(f"\n批量绘制 {len(regions):,} 个区域，进程数 {workers}")
+    print(f"单区域图目录：{region_dir}")
+
+    tasks = []
+    for number, (name, chrom, start, end) in enumerate(regions, 1):
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_.") or "region"
+        output = region_dir / f"{number:04d}_{safe_name}{sheet.suffix}"
+        tasks.append((name, chrom, start, end, str(output)))
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(uri, mcool_path)
+    ) as pool:
+        results = []
+        for done_count, result in enumerate(pool.map(render_region, tasks), 1):
+            results.append(result)
+            if done_count % 20 == 0 or done_count == len(tasks):
+                print(f"  已完成 {done_count:,}/{len(tasks):,}")
+
+    columns = max(1, min(SHEET_COLUMNS, len(results)))
+    rows = -(-len(results) // columns)
+    figure, axes = plt.subplots(
+        rows, columns, figsize=(columns * 4, rows * 2.4), squeeze=False
+    )
+    color_map = build_color_map()
+    for axis, (name, chrom, start, end, matrix) in zip(axes.flat, results):
+        draw_region(axis, matrix, start, end, color_map)
+        axis.set_title(f"{name}\n{chrom}:{start:,}-{end:,}", fontsize=7)
+        axis.tick_params(axis="x", labelsize=6, length=2)
+    for axis in axes.flat[len(results):]:
+        axis.set_visible(False)
+    figure.suptitle(
+        f"Hi-C triangle contact sheet ({RESOLUTION:,} bp, {len(results):,} regions)"
+    )
+    figure.tight_layout()
+    figure.savefig(sheet, dpi=DPI, bbox_inches="tight", facecolor="white")
+    plt.close(figure)
+    print(f"完成：{sheet}")
+
 
 def main() -> None:
     script_dir = Path(__file__).resolve().parent
@@ -181,7 +632,14 @@ def main() -> None:
             f"请运行 `cooler ls {mcool_path}` 检查可用分辨率。"
         )
 
+    if OUTPUT_PIXELS <= 0 or TILE_PIXELS <= 0:
+        fail("OUTPUT_PIXELS 和 TILE_PIXELS 必须大于 0")
+
     chromsizes = contact.chromsizes
+    if BATCH_BED is not None:
+        run_batch(script_dir, mcool_path, uri, chromsizes)
+        return
+
     available_chroms = list(chromsizes.index)
     if CHROMS is None:
         selected_chroms = choose_chroms(available_chroms)
@@ -200,44 +658,34 @@ def main() -> None:
             fail("以下染色体不在 mcool 中：" + ", ".join(missing))
         selected_chroms = list(CHROMS)
 
-    bins = contact.bins()[:]
-    selected_mask = bins["chrom"].isin(selected_chroms).to_numpy()
-    selected_indices = np.flatnonzero(selected_mask)
-    n_bins = len(selected_indices)
+    selected_set = set(selected_chroms)
+    chrom_indices = [
+        index for index, chrom in enumerate(available_chroms)
+        if chrom in selected_set
+    ]
+    with contact.open("r") as handle:
+        chrom_offsets = handle["indexes/chrom_offset"][:].astype(np.int64)
+    chrom_bins = np.diff(chrom_offsets)[chrom_indices]
+    n_bins = int(chrom_bins.sum())
     if n_bins == 0:
         fail("选择结果中没有任何 bins")
-    if n_bins > MAX_BINS:
-        estimated_gib = n_bins * n_bins * 8 / 1024**3
-        suggested = int(
-            np.ceil(
-                RESOLUTION * n_bins / MAX_BINS / 10_000
-            ) * 10_000
-        )
-        fail(
-            f"矩阵包含 {n_bins:,} 个 bins，单个矩阵约需 "
-            f"{estimated_gib:.1f} GiB。\n"
-            f"请改用约 {suggested:,} bp 或更粗的已有分辨率，"
-            "或确认内存充足后提高 MAX_BINS。"
-        )
+    factor = choose_factor(chrom_bins)
+    store = TileStore(contact, mcool_path, factor)
+    cells = store.chrom_cells[chrom_indices]
+    grid_size = int(cells.sum())
 
     output = choose_output(script_dir)
     print(f"\n读取矩阵：{uri}")
     print(f"染色体 / scaffold 数：{len(selected_chroms):,}")
     print(f"矩阵 bins：{n_bins:,} × {n_bins:,}")
+    print(
+        f"输出像素格：{grid_size:,} × {grid_size:,}"
+        f"（每格最多合并 {factor} × {factor} bins）"
+    )
+    if store.directory is not None:
+        print(f"瓦片缓存：{store.directory}")
 
-    try:
-        full_matrix = contact.matrix(balance=BALANCED)[:]
-    except Exception as error:
-        if BALANCED:
-            fail(
-                f"读取 balanced 矩阵失败：{error}\n"
-                "可将 BALANCED 改为 False。"
-            )
-        raise
-
-    matrix = full_matrix[np.ix_(selected_indices, selected_indices)]
-    del full_matrix
-    matrix = np.asarray(matrix, dtype=np.float64)
+    matrix = store.matrix(chrom_indices)
     matrix[~np.isfinite(matrix)] = 0
     matrix[matrix < 0] = 0
     matrix = np.log1p(matrix)
@@ -250,30 +698,18 @@ def main() -> None:
         color_max = float(positive.max())
 
     # 只保留主对角线以上的一半；坐标变换后主对角线成为水平底边。
-    row_numbers = np.arange(n_bins)[:, None]
-    column_numbers = np.arange(n_bins)[None, :]
+    row_numbers = np.arange(grid_size)[:, None]
+    column_numbers = np.arange(grid_size)[None, :]
     triangle_matrix = np.ma.masked_where(row_numbers > column_numbers, matrix)
 
-    selected_bins = bins.iloc[selected_indices].reset_index(drop=True)
-    chrom_array = selected_bins["chrom"].astype(str).to_numpy()
-    change_points = np.flatnonzero(
-        chrom_array[1:] != chrom_array[:-1]
-    ) + 1
-    starts = np.r_[0, change_points]
-    ends = np.r_[change_points, n_bins]
-    names = chrom_array[starts]
+    ends = np.cumsum(cells)
+    starts = ends - cells
+    names = np.array([available_chroms[index] for index in chrom_indices])
     midpoints = (starts + ends) / 2
     lengths = chromsizes.loc[names].to_numpy()
     label_mask = lengths >= LABEL_MIN_LENGTH
 
-    if CUSTOM_COLORS is None:
-        color_map = COLORMAP
-    else:
-        if len(CUSTOM_COLORS) < 2:
-            fail("CUSTOM_COLORS 至少需要两种颜色")
-        color_map = LinearSegmentedColormap.from_list(
-            "hic_custom", CUSTOM_COLORS, N=256
-        )
+    color_map = build_color_map()
 
     figure, axis = plt.subplots(figsize=FIGURE_SIZE)
 
@@ -289,7 +725,7 @@ def main() -> None:
         vmin=0,
         vmax=color_max,
         origin="lower",
-        extent=(0, n_bins, 0, n_bins),
+        extent=(0, grid_size, 0, grid_size),
         interpolation="none",
         rasterized=True,
         transform=triangle_transform,
@@ -304,10 +740,10 @@ def main() -> None:
             "transform": triangle_transform,
         }
         axis.plot([boundary, boundary], [0, boundary], **line_style)
-        axis.plot([boundary, n_bins], [boundary, boundary], **line_style)
+        axis.plot([boundary, grid_size], [boundary, boundary], **line_style)
 
-    axis.set_xlim(0, n_bins)
-    axis.set_ylim(0, n_bins / 2)
+    axis.set_xlim(0, grid_size)
+    axis.set_ylim(0, grid_size / 2)
     axis.set_aspect("equal")
     axis.set_xticks(midpoints[label_mask])
     axis.set_xticklabels(names[label_mask], rotation=90, fontsize=7)
@@ -3,6 +3,7 @@
 
 # 此文件与文章目录中的脚本保持一致。
 
+import hashlib
 from datetime import datetime
 from pathlib import Path
 
@@ -68,9 +69,24 @@ LABEL_MIN_LENGTH = 1_000_000
 #   PNG 等栅格输出的分辨率。SVG/PDF 主体仍为矢量容器。
 DPI = 220
 
-# MAX_BINS
-#   稠密矩阵的安全上限。提高该值前请确认有足够内存。
-MAX_BINS = 15_000
+# OUTPUT_PIXELS
+#   输出热图每条边的最大像素格数。bins 多于该值时，相邻 bins 会被合并
+#   为一个像素格（取平均），因此 10–50 kb 的全基因组图也不会生成
+#   完整稠密矩阵。内存约为 OUTPUT_PIXELS² × 24 字节。
+#   像素格在每条染色体起点对齐，短 scaffold 至少占一格，
+#   因此 scaffold 很多时实际格数可能略高于该值。
+OUTPUT_PIXELS = 3_000
+
+# TILE_PIXELS
+#   每次从 .mcool 读取的稀疏像素记录数上限。调小可进一步降低内存峰值。
+TILE_PIXELS = 5_000_000
+
+# CACHE_DIR
+#   已合并瓦片的缓存目录名，建在 .mcool 所在目录下。瓦片按文件身份
+#   （路径、大小、修改时间）、分辨率、BALANCED 和合并倍数区分；只修改
+#   配色、CLIP_QUANTILE 或换用相邻染色体重绘时无需再读取 .mcool。
+#   设为 None 可关闭缓存；.mcool 更新后旧缓存自动失效，可直接删除。
+CACHE_DIR = ".hic_tile_cache"
 
 # 三角热图自身的画布尺寸，单位为英寸。三角形高度约为底边的一半，
 # 因而使用比正方形热图更扁的画布。
@@ -157,6 +173,176 @@ def choose_output(script_dir: Path) -> Path:
         output = script_dir / output
     return output.resolve()
 
+def choose_factor(chrom_bins: np.ndarray) -> int:
+    """选择每个像素格合并的 bins 数（2 的幂），使网格不超过 OUTPUT_PIXELS。
+
+    取 2 的幂便于相邻区域、相近规模的选择复用同一套缓存瓦片。
+    """
+    factor = 1
+    while (
+        factor < chrom_bins.max()
+        and int(np.sum(-(-chrom_bins // factor))) > OUTPUT_PIXELS
+    ):
+        factor *= 2
+    return factor
+
+
+def cache_directory(mcool_path: Path, factor: int) -> Path | None:
+    """以 mcool 的路径、大小、修改时间以及分辨率、归一化和合并倍数定位缓存。"""
+    if CACHE_DIR is None:
+        return None
+    stat = mcool_path.stat()
+    normalization = "balanced" if BALANCED else "raw"
+    identity = (
+        f"{mcool_path}|{stat.st_size}|{stat.st_mtime_ns}|"
+        f"{RESOLUTION}|{normalization}|{factor}"
+    )
+    digest = hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]
+    return (
+        mcool_path.parent / CACHE_DIR
+        / f"{mcool_path.stem}.{RESOLUTION}.{normalization}.x{factor}.{digest}"
+    )
+
+
+def reduce_cells(keys: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    return unique_keys, np.bincount(inverse, weights=values)
+
+
+class TileStore:
+    """按染色体行条带读取并缓存已合并的稀疏互作瓦片。
+
+    每条瓦片记录某条染色体的 bins 与其后（按文件顺序）所有 bins
+    的上三角互作，已经乘上 balance 权重并合并到像素格；像素格在
+    每条染色体起点对齐，因此任意染色体组合都可以直接拼接。
+    """
+
+    def __init__(self, contact: cooler.Cooler, mcool_path: Path, factor: int):
+        self.contact = contact
+        self.factor = factor
+        with contact.open("r") as handle:
+            self.chrom_offsets = handle["indexes/chrom_offset"][:].astype(np.int64)
+            self.bin1_offsets = handle["indexes/bin1_offset"][:]
+        chrom_bins = np.diff(self.chrom_offsets)
+        self.chrom_cells = -(-chrom_bins // factor)
+        self.cell_offsets = np.r_[0, np.cumsum(self.chrom_cells)].astype(np.int64)
+        self.n_cells = int(self.cell_offsets[-1])
+        chrom_of_bin = np.repeat(np.arange(len(chrom_bins)), chrom_bins)
+        self.cell_of_bin = (
+            self.cell_offsets[chrom_of_bin]
+            + (np.arange(len(chrom_of_bin)) - self.chrom_offsets[chrom_of_bin]) // factor
+        )
+        self.directory = cache_directory(mcool_path, factor)
+        self.weights: np.ndarray | None = None
+
+    def balance_weights(self) -> np.ndarray | None:
+        if not BALANCED:
+            return None
+        if self.weights is None:
+            bin_table = self.contact.bins()
+            if "weight" not in bin_table.columns:
+                fail(
+                    "mcool 中没有 weight 列，无法读取 balanced 矩阵。\n"
+                    "可将 BALANCED 改为 False。"
+                )
+            weights = np.array(bin_table["weight"][:], dtype=np.float64)
+            weights[~np.isfinite(weights)] = 0
+            self.weights = weights
+        return self.weights
+
+    def compute_strip(self, chrom_index: int) -> tuple[np.ndarray, np.ndarray]:
+        """按 bin1_offset 分块读取一条染色体的像素，返回 (像素格键, 互作和)。"""
+        weights = self.balance_weights()
+        pixel_table = self.contact.pixels()
+        row = int(self.chrom_offsets[chrom_index])
+        row_end = int(self.chrom_offsets[chrom_index + 1])
+        key_parts: list[np.ndarray] = []
+        value_parts: list[np.ndarray] = []
+        while row < row_end:
+            lo = int(self.bin1_offsets[row])
+            next_row = int(
+                np.searchsorted(self.bin1_offsets, lo + TILE_PIXELS, side="right")
+            ) - 1
+            next_row = min(max(next_row, row + 1), row_end)
+            hi = int(self.bin1_offsets[next_row])
+            row = next_row
+            if hi <= lo:
+                continue
+            tile = pixel_table[lo:hi]
+            bin1 = tile["bin1_id"].to_numpy()
+            bin2 = tile["bin2_id"].to_numpy()
+            values = tile["count"].to_numpy(dtype=np.float64)
+            if weights is not None:
+                values = values * weights[bin1] * weights[bin2]
+            cell1 = self.cell_of_bin[bin1]
+            cell2 = self.cell_of_bin[bin2]
+            # 同一像素格内的非对角 bins 在完整对称矩阵中出现两次。
+            values = np.where((cell1 == cell2) & (bin1 != bin2), 2 * values, values)
+            keep = values > 0
+            keys, sums = reduce_cells(
+                cell1[keep] * self.n_cells + cell2[keep], values[keep]
+            )
+            key_parts.append(keys)
+            value_parts.append(sums)
+        if not key_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return reduce_cells(np.concatenate(key_parts), np.concatenate(value_parts))
+
+    def strip(self, chrom_index: int) -> tuple[np.ndarray, np.ndarray]:
+        if self.directory is None:
+            return self.compute_strip(chrom_index)
+        path = self.directory / f"chrom{chrom_index:05d}.npz"
+        if path.is_file():
+            with np.load(path) as cached:
+                return cached["keys"], cached["values"]
+        keys, values = self.compute_strip(chrom_index)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + ".part.npz")
+        np.savez(partial, keys=keys, values=values)
+        partial.replace(path)
+        return keys, values
+
+    def matrix(self, chrom_indices: list[int]) -> np.ndarray:
+        """拼接所选染色体的瓦片，返回每个像素格的平均互作强度。"""
+        compact = np.full(self.n_cells, -1, dtype=np.int64)
+        selected_cells = np.concatenate(
+            [
+                np.arange(self.cell_offsets[index], self.cell_offsets[index + 1])
+                for index in chrom_indices
+            ]
+        )
+        grid_size = len(selected_cells)
+        compact[selected_cells] = np.arange(grid_size)
+        key_parts: list[np.ndarray] = []
+        value_parts: list[np.ndarray] = []
+        for index in chrom_indices:
+            keys, values = self.strip(index)
+            cell1 = compact[keys // self.n_cells]
+            cell2 = compact[keys % self.n_cells]
+            keep = cell2 >= 0
+            key_parts.append(cell1[keep] * grid_size + cell2[keep])
+            value_parts.append(values[keep])
+        upper = np.bincount(
+            np.concatenate(key_parts),
+            weights=np.concatenate(value_parts),
+            minlength=grid_size * grid_size,
+        ).reshape(grid_size, grid_size)
+        grid = upper + upper.T
+        diagonal = np.diag_indices(grid_size)
+        grid[diagonal] = upper[diagonal]
+
+        bins_per_cell = np.concatenate(
+            [
+                np.minimum(
+                    self.factor,
+                    self.chrom_offsets[index + 1] - self.chrom_offsets[index]
+                    - self.factor * np.arange(self.chrom_cells[index]),
+                )
+                for index in chrom_indices
+            ]
+        ).astype(np.float64)
+        return grid / np.outer(bins_per_cell, bins_per_cell)
+
 
 def main() -> None:
     script_dir = Path(__file__).resolve().parent
@@ -184,29 +370,28 @@ def main() -> None:
         if missing:
             fail("以下染色体不在 mcool 中：" + ", ".join(missing))
         selected_chroms = list(CHROMS)
-    bins = contact.bins()[:]
-    selected_mask = bins["chrom"].isin(selected_chroms).to_numpy()
-    selected_indices = np.flatnonzero(selected_mask)
-    n_bins = len(selected_indices)
+    if OUTPUT_PIXELS <= 0 or TILE_PIXELS <= 0:
+        fail("OUTPUT_PIXELS 和 TILE_PIXELS 必须大于 0")
+    selected_set = set(selected_chroms)
+    chrom_indices = [index for index, chrom in enumerate(available_chroms) if chrom in selected_set]
+    with contact.open("r") as handle:
+        chrom_offsets = handle["indexes/chrom_offset"][:].astype(np.int64)
+    chrom_bins = np.diff(chrom_offsets)[chrom_indices]
+    n_bins = int(chrom_bins.sum())
     if n_bins == 0:
         fail("选择结果中没有任何 bins")
-    if n_bins > MAX_BINS:
-        estimated_gib = n_bins * n_bins * 8 / 1024**3
-        suggested = int(np.ceil(RESOLUTION * n_bins / MAX_BINS / 10_000) * 10_000)
-        fail(f"矩阵包含 {n_bins:,} 个 bins，单个矩阵约需 {estimated_gib:.1f} GiB。\n请改用约 {suggested:,} bp 或更粗的已有分辨率，或确认内存充足后提高 MAX_BINS。")
+    factor = choose_factor(chrom_bins)
+    store = TileStore(contact, mcool_path, factor)
     output = choose_output(script_dir)
     print(f"\n读取矩阵：{uri}")
     print(f"染色体 / scaffold 数：{len(selected_chroms):,}")
     print(f"矩阵 bins：{n_bins:,} × {n_bins:,}")
-    try:
-        full_matrix = contact.matrix(balance=BALANCED)[:]
-    except Exception as error:
-        if BALANCED:
-            fail(f"读取 balanced 矩阵失败：{error}\n可将 BALANCED 改为 False。")
-        raise
-    matrix = full_matrix[np.ix_(selected_indices, selected_indices)]
-    del full_matrix
-    matrix = np.asarray(matrix, dtype=np.float64)
+    cells = store.chrom_cells[chrom_indices]
+    grid_size = int(cells.sum())
+    print(f"输出像素格：{grid_size:,} × {grid_size:,}（每格最多合并 {factor} × {factor} bins）")
+    if store.directory is not None:
+        print(f"瓦片缓存：{store.directory}")
+    matrix = store.matrix(chrom_indices)
     matrix[~np.isfinite(matrix)] = 0
     matrix[matrix < 0] = 0
     matrix = np.log1p(matrix)
@@ -216,12 +401,9 @@ def main() -> None:
     color_max = float(np.quantile(positive, CLIP_QUANTILE))
     if not np.isfinite(color_max) or color_max <= 0:
         color_max = float(positive.max())
-    selected_bins = bins.iloc[selected_indices].reset_index(drop=True)
-    chrom_array = selected_bins["chrom"].astype(str).to_numpy()
-    change_points = np.flatnonzero(chrom_array[1:] != chrom_array[:-1]) + 1
-    starts = np.r_[0, change_points]
-    ends = np.r_[change_points, n_bins]
-    names = chrom_array[starts]
+    ends = np.cumsum(cells)
+    starts = ends - cells
+    names = np.array([available_chroms[index] for index in chrom_indices])
     midpoints = (starts + ends) / 2
     lengths = chromsizes.loc[names].to_numpy()
     label_mask = lengths >= LABEL_MIN_LENGTH
@@ -232,10 +414,10 @@ def main() -> None:
             fail("CUSTOM_COLORS 至少需要两种颜色")
         color_map = LinearSegmentedColormap.from_list("hic_custom", CUSTOM_COLORS, N=256)
     figure, axis = plt.subplots(figsize=FIGURE_SIZE)
-    image = axis.imshow(matrix, cmap=color_map, vmin=0, vmax=color_max, origin="upper", interpolation="none", rasterized=True)
+    image = axis.imshow(matrix, cmap=color_map, vmin=0, vmax=color_max, origin="upper", extent=(0, grid_size, grid_size, 0), interpolation="none", rasterized=True)
     for boundary in ends[:-1]:
-        axis.axvline(boundary - 0.5, color="#444444", linewidth=0.35, alpha=0.55)
-        axis.axhline(boundary - 0.5, color="#444444", linewidth=0.35, alpha=0.55)
+        axis.axvline(boundary, color="#444444", linewidth=0.35, alpha=0.55)
+        axis.axhline(boundary, color="#444444", linewidth=0.35, alpha=0.55)
     axis.set_xticks(midpoints[label_mask])
     axis.set_xticklabels(names[label_mask], rotation=90, fontsize=7)
     axis.set_yticks(midpoints[label_mask])